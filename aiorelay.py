@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import concurrent.futures
+
+import aiohttp
+import irc.client
+import irc.client_aio
+import telepot
+import telepot.aio
+import telepot.aio.api
+import telepot.aio.ratelimit
+
+from bot import Bot, log_usage, outbound_options
+from fanout import AsyncFanOut
+from outbound import AsyncOutboundQueue
+from telegrambot import TelegramBot
+
+logger = logging.getLogger(__name__)
+
+
+class LoopScheduler:
+    # the part of the irc scheduler the bots use, on top of the event loop
+    def __init__(self, loop):
+        self.loop = loop
+
+    def execute_after(self, delay, func):
+        return self.loop.call_later(delay, func)
+
+    def execute_every(self, period, func):
+        def repeat():
+            func()
+            self.loop.call_later(period, repeat)
+
+        return self.loop.call_later(period, repeat)
+
+
+class Reactor(irc.client_aio.AioReactor):
+    """
+    An irc reactor on the relay's event loop. Unlike the select based reactor it
+    has no scheduler of its own, so reconnects are scheduled on the loop.
+    """
+
+    def __init__(self, loop):
+        super().__init__(loop=loop)
+        self.scheduler = LoopScheduler(loop)
+
+
+class AioBot(Bot):
+    def connect(self, *args, **kwargs):
+        # the connection is set up by a coroutine, the bot goes on once it is done
+        task = self.reactor.loop.create_task(self.connection.connect(*args, **kwargs))
+        task.add_done_callback(self.connected)
+
+    def connected(self, task):
+        if task.cancelled() or task.exception() is None:
+            return
+
+        logger.error('connecting to {0:s} failed: {1:s}'.format(self.server, repr(task.exception())))
+        # hand over to the reconnect strategy, as the select based bot does
+        self.connection._handle_event(irc.client.Event('disconnect', self.connection.server, '', ['']))
+
+
+class AsyncTelegramBot(TelegramBot):
+    """
+    The TelegramBot on telepot.aio. The relayed lines are sent by tasks sharing the
+    connection pool of telepot.aio instead of by a pool of threads.
+
+    Commands and settings changes write the user store, which syncs to disk. They
+    run on a thread of their own, one after the other, not on the event loop.
+    """
+
+    def __init__(self, token, config, loop):
+        self.telegram = telepot.aio.Bot(token, loop)
+        self.disk = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='telegram-disk')
+
+        self.limiter = telepot.aio.ratelimit.RateLimiter(**self.rate_limits(config))
+        self.fanout = AsyncFanOut(self.limiter.augment_send(self.telegram.send_prepared), loop,
+                                  on_dead=self.prune_later, on_migrated=self.migrate_later,
+                                  transient_errors=(aiohttp.ClientError, asyncio.TimeoutError, EnvironmentError),
+                                  **self.failure_options(config))
+
+        self.init_relay(config)
+
+    def start(self):
+        logger.debug('starting telegram msg loop.')
+        self.telegram.loop.create_task(self.receive_updates())
+
+    async def receive_updates(self):
+        if self.webhook_options is None:
+            await self.delete_webhook()
+            await self.telegram.message_loop(self.telegram_handle)
+            return
+
+        import webhook
+        self.webhook = webhook.WebhookServer(asyncio.Queue(), loop=self.telegram.loop, **self.webhook_options)
+        await self.webhook.start()
+        await self.set_webhook()
+        await self.telegram.message_loop(self.telegram_handle, source=self.webhook.updates)
+
+    async def stop(self):
+        if self.webhook is not None:
+            await self.delete_webhook()
+            await self.webhook.stop()
+        await telepot.aio.api.close()
+
+    async def set_webhook(self):
+        registration = self.webhook.registration()
+        try:
+            await self.telegram.setWebhook(**registration)
+        finally:
+            if registration['certificate'] is not None:
+                registration['certificate'].close()
+        logger.info('webhook set to {0:s}'.format(self.webhook.url))
+
+    async def delete_webhook(self):
+        try:
+            await self.telegram.deleteWebhook()
+        except Exception as e:
+            logger.error('deleting the webhook failed: {0:s}'.format(repr(e)))
+
+    def prune_later(self, chat_id, error):
+        self.disk.submit(self.logged, self.prune, chat_id, error)
+
+    def migrate_later(self, chat_id, new_chat_id):
+        self.disk.submit(self.logged, self.migrate, chat_id, new_chat_id)
+
+    @staticmethod
+    def logged(func, *args):
+        # nobody waits for these, their errors would go unnoticed
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error('{0:s} failed: {1:s}'.format(func.__name__, repr(e)))
+
+    async def telegram_handle(self, msg):
+        content_type, chat_type, chat_id = telepot.glance(msg)
+
+        if content_type == 'text':
+            replies = await self.telegram.loop.run_in_executor(self.disk, self.replies, str(chat_id), msg['text'])
+            for reply in replies:
+                await self.limiter.send(self.telegram.sendMessage, chat_id, reply)
+
+
+def main(config, networks, token):
+    # the irc connections, the telegram polling and every send share this one thread
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    telegram = AsyncTelegramBot(token, config, loop)
+    outbound = AsyncOutboundQueue(telegram, loop=loop, **outbound_options(config))
+
+    reactor = Reactor(loop)
+
+    bots = [AioBot(network=name, server=server, port=port, channels=channels, nickname=nickname,
+                   telegram=telegram, outbound=outbound, reactor=reactor)
+            for name, server, port, channels, nickname in networks]
+
+    backlog_save_interval = config.getint('Relay', 'backlog_save_interval', fallback=60)
+    if telegram.backlog.file_name and backlog_save_interval > 0:
+        reactor.scheduler.execute_every(backlog_save_interval, telegram.backlog.save)
+
+    usage_interval = config.getint('Relay', 'usage_interval', fallback=600)
+    if usage_interval > 0:
+        reactor.scheduler.execute_every(usage_interval, log_usage)
+
+    telegram.start()
+
+    for bot in bots:
+        bot._connect()
+    try:
+        loop.run_forever()
+    finally:
+        loop.run_until_complete(telegram.stop())
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import array
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+kinds = ['msg', 'notification']
+
+
+class ChannelLog:
+    """
+    The recent lines of one channel, oldest first. Timestamps are packed into an
+    array of doubles and nicks are numbers into the backlog's nick table, so a line
+    costs little more than its text. Lines are only appended, once twice the
+    capacity is reached the older half is cut off in one go.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array.array('d')
+        self.kinds = bytearray()
+        self.nicks = array.array('I')
+        self.texts = []
+
+    def __len__(self):
+        return min(len(self.texts), self.capacity)
+
+    def append(self, timestamp, kind, nick, text):
+        self.timestamps.append(timestamp)
+        self.kinds.append(kind)
+        self.nicks.append(nick)
+        self.texts.append(text)
+
+        if len(self.texts) >= 2 * self.capacity:
+            self.trim()
+
+    def trim(self):
+        # cut off the lines beyond the capacity
+        excess = self.first()
+        del self.timestamps[:excess]
+        del self.kinds[:excess]
+        del self.nicks[:excess]
+        del self.texts[:excess]
+
+    def first(self):
+        # index of the oldest line still kept
+        return max(len(self.texts) - self.capacity, 0)
+
+    def range(self, since=None, until=None):
+        # indices of the lines from `since` up to before `until`, by binary search
+        start = self.first()
+        if since is not None:
+            start = bisect.bisect_left(self.timestamps, since, start)
+        end = len(self.texts)
+        if until is not None:
+            end = bisect.bisect_left(self.timestamps, until, start)
+        return start, end
+
+
+class Backlog:
+    """
+    A bounded buffer of the recent lines of every relayed channel, so users can get
+    what they missed: the lines since they stopped the bot when they /start it
+    again, or the last few lines with /backlog.
+
+    With a file name the backlog is saved with every save() and read back when the
+    bot starts.
+
+    Nicks no longer in any channel's lines are dropped from the nick table once it
+    has doubled in size since it was last cleaned up.
+    """
+
+    def __init__(self, size=1000, file_name=None):
+        self.size = size
+        self.file_name = file_name
+
+        self.channels = {}  # channel key -> ChannelLog
+        self.nick_ids = {}  # nick -> index into self.nick_names
+        self.nick_names = []
+        self.nick_limit = 1024  # cleaning up the nick table once it has this many
+        self.lock = threading.Lock()
+        self.changed = False
+
+        if file_name:
+            self.load()
+
+    def nick_id(self, nick):
+        # called with the lock held
+        try:
+            return self.nick_ids[nick]
+        except KeyError:
+            if len(self.nick_names) >= self.nick_limit:
+                self.compact_nicks()
+
+            id = self.nick_ids[nick] = len(self.nick_names)
+            self.nick_names.append(nick)
+            return id
+
+    def compact_nicks(self):
+        # called with the lock held: number the nicks still in use anew
+        renumbered = {}
+        for log in self.channels.values():
+            log.trim()
+            log.nicks = array.array('I', (renumbered.setdefault(id, len(renumbered)) for id in log.nicks))
+
+        names = [None] * len(renumbered)
+        for old, new in renumbered.items():
+            names[new] = self.nick_names[old]
+
+        self.nick_names = names
+        self.nick_ids = {nick: id for id, nick in enumerate(names)}
+        self.nick_limit = max(1024, 2 * len(names))
+
+    def add(self, channel, kind, nick, text, timestamp=None):
+        if self.size <= 0:
+            return
+
+        with self.lock:
+            try:
+                log = self.channels[channel]
+            except KeyError:
+                log = self.channels[channel] = ChannelLog(self.size)
+            log.append(timestamp or time.time(), kinds.index(kind), self.nick_id(nick), text)
+            self.changed = True
+
+    def lines(self, channel, since=None, until=None, last=None):
+        """
+        Return the lines of a channel between `since` and `until`, at most the `last`
+        ones of them, as (timestamp, kind, nick, text) tuples.
+        """
+        with self.lock:
+            log = self.channels.get(channel)
+            if log is None:
+                return []
+
+            start, end = log.range(since, until)
+            if last is not None:
+                start = max(start, end - last)
+
+            return [(log.timestamps[i], kinds[log.kinds[i]], self.nick_names[log.nicks[i]], log.texts[i])
+                    for i in range(start, end)]
+
+    def load(self):
+        try:
+            with open(self.file_name, 'r') as file:
+                channels = json.load(file)
+        except FileNotFoundError:
+            return
+        except (EnvironmentError, ValueError) as e:
+            logger.error('reading the backlog failed: {0:s}'.format(repr(e)))
+            return
+
+        for channel, lines in channels.items():
+            for timestamp, kind, nick, text in lines:
+                self.add(channel, kind, nick, text, timestamp)
+        self.changed = False
+        logger.info('read the backlog of {0:d} channels'.format(len(channels)))
+
+    def save(self):
+        with self.lock:
+            if not self.file_name or not self.changed:
+                return
+            # cleared before reading, so that lines added meanwhile are saved next time
+            self.changed = False
+
+        channels = {channel: self.lines(channel) for channel in list(self.channels)}
+
+        temp_file_name = self.file_name + '.tmp'
+        try:
+            with open(temp_file_name, 'w') as file:
+                json.dump(channels, file)
+            os.replace(temp_file_name, self.file_name)
+        except EnvironmentError as e:
+            logger.error('saving the backlog failed: {0:s}'.format(repr(e)))
+            # try again next time, even if no line comes in meanwhile
+            with self.lock:
+                self.changed = True
+
+    def stats(self):
+        with self.lock:
+            return {'channels': len(self.channels),
+                    'lines': sum(len(log) for log in self.channels.values()),
+                    'nicks': len(self.nick_names)}
@@ -0,0 +1,163 @@
+# Cost of a relayed line fanned out to many telegram users in the threaded and in
+# the asyncio relay: wall time, memory and context switches. Every mode runs in a
+# fresh process. In the first modes the send is replaced by a fixed network
+# latency; the http- modes send through telepot and telepot.aio to a local bot
+# api server answering after that latency.
+#
+#   python benchmarks/bench_modes.py
+
+import os
+import sys
+import time
+import asyncio
+import socket
+import resource
+import threading
+import subprocess
+import concurrent.futures
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [root, os.path.join(root, 'telepot')]
+
+from fanout import FanOut, AsyncFanOut
+
+users = 1000
+lines = 5
+latency = 0.02
+
+
+def run_threads(workers):
+    def send(chat_id, text):
+        time.sleep(latency)
+
+    fanout = FanOut(send, workers)
+    for i in range(lines):
+        concurrent.futures.wait(fanout.broadcast(range(users), 'line'))
+
+    threads = threading.active_count()
+    fanout.shutdown()
+    return threads
+
+
+def run_asyncio():
+    async def send(chat_id, text):
+        await asyncio.sleep(latency)
+
+    async def relay():
+        fanout = AsyncFanOut(send, loop)
+        for i in range(lines):
+            await asyncio.wait(fanout.broadcast(range(users), 'line'))
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(relay())
+    return threading.active_count()
+
+
+def serve(port):
+    # the bot api server of the http- modes, in a process of its own
+    from aiohttp import web
+
+    async def method(request):
+        await request.read()
+        await asyncio.sleep(latency)
+        return web.json_response({'ok': True, 'result': True})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', method)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+def use_server(port):
+    import telepot.api
+    import telepot.aio.api
+
+    def methodurl(req, **user_kw):
+        token, method, params, files = req
+        return 'http://127.0.0.1:{0:d}/bot{1:s}/{2:s}'.format(port, token, method)
+
+    telepot.api._methodurl = telepot.aio.api._methodurl = methodurl
+
+
+def run_http_threads(workers):
+    import telepot
+
+    bot = telepot.Bot('123:abc')
+    fanout = FanOut(bot.sendMessage, workers)
+    for i in range(lines):
+        concurrent.futures.wait(fanout.broadcast(range(users), 'line'))
+
+    threads = threading.active_count()
+    fanout.shutdown()
+    return threads
+
+
+def run_http_asyncio():
+    import telepot.aio
+    import telepot.aio.api
+
+    async def relay():
+        bot = telepot.aio.Bot('123:abc', loop)
+        fanout = AsyncFanOut(bot.sendMessage, loop)
+        for i in range(lines):
+            await asyncio.wait(fanout.broadcast(range(users), 'line'))
+        await telepot.aio.api.close()
+
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(relay())
+    return threading.active_count()
+
+
+def measure(mode):
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.time()
+
+    if mode == 'asyncio':
+        threads = run_asyncio()
+    elif mode == 'http-asyncio':
+        threads = run_http_asyncio()
+    elif mode.startswith('http-'):
+        threads = run_http_threads(int(mode.split('-')[2]))
+    else:
+        threads = run_threads(int(mode.split('-')[1]))
+
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    print('{0:17s} {1:7.2f} s, max rss {2:7d} kB, context switches {3:6d} voluntary {4:6d} involuntary, '
+          'threads {5:d}'.format(mode, time.time() - started, after.ru_maxrss,
+                                 after.ru_nvcsw - before.ru_nvcsw, after.ru_nivcsw - before.ru_nivcsw,
+                                 threads))
+
+
+def main():
+    print('{0:d} lines to {1:d} users, {2:.0f} ms per send'.format(lines, users, latency * 1000))
+    for mode in ['threads-10', 'threads-100', 'asyncio']:
+        subprocess.run([sys.executable, __file__, mode], check=True)
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    server = subprocess.Popen([sys.executable, __file__, 'serve', str(port)])
+    try:
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        for mode in ['http-threads-10', 'http-threads-100', 'http-asyncio']:
+            subprocess.run([sys.executable, __file__, mode, str(port)], check=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == 'serve':
+        serve(int(sys.argv[2]))
+    elif len(sys.argv) == 3:
+        use_server(int(sys.argv[2]))
+        measure(sys.argv[1])
+    elif len(sys.argv) == 2:
+        measure(sys.argv[1])
+    else:
+        main()
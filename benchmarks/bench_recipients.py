@@ -0,0 +1,58 @@
+# Cost per relayed line of picking the telegram recipients: walking the user dict
+# (how send_msg used to do it) against the precomputed subscriber index.
+#
+#   python benchmarks/bench_recipients.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from subscribers import SubscriberRegistry
+from userstore import UserStore
+
+
+class MemoryStore(UserStore):
+    def __init__(self, users):
+        self.users = users
+
+    def load(self):
+        return self.users
+
+    def put(self, id, settings):
+        pass
+
+
+def make_users(n):
+    # every 4th user disabled, every 3rd without notifications
+    return {str(100000000 + i): {'enabled': i % 4 != 0, 'notifications': i % 3 != 0} for i in range(n)}
+
+
+def dict_walk(users):
+    return [int(user) for user, user_settings in users.items() if user_settings['enabled']]
+
+
+def send(recipients):
+    # stands in for handing the chat ids to the fan-out
+    for chat_id in recipients:
+        pass
+
+
+def main():
+    for n in [10000, 100000]:
+        users = make_users(n)
+        registry = SubscriberRegistry(MemoryStore(users))
+        registry.default_channels.append('net/#chan')
+        registry.recipients('net/#chan', 'msg')
+
+        number = 50
+        walk = timeit.timeit(lambda: send(dict_walk(users)), number=number) / number
+        index = timeit.timeit(lambda: send(registry.recipients('net/#chan', 'msg')), number=number) / number
+
+        print('{0:7d} users: dict walk {1:8.3f} ms/line, index {2:8.3f} ms/line ({3:.1f}x)'
+              .format(n, walk * 1000, index * 1000, walk / index))
+
+
+if __name__ == '__main__':
+    main()
@@ -5,12 +5,18 @@
 import sys
 import logging
 import datetime
+import threading
 import configparser
 
 import irc.bot
+import irc.dict
+import irc.modes
 import irc.client
 
 from telegrambot import TelegramBot
+from outbound import OutboundQueue
+from roster import Roster, OPER, VOICED, USER
+from spool import Spool
 
 logger = logging.getLogger(__name__)
 
@@ -19,12 +25,63 @@ logging.getLogger('urllib3').setLevel(level=logging.WARNING)
 logging.getLogger('irc.client').setLevel(level=logging.WARNING)
 
 
+def own_events_only(handler):
+    # with a shared reactor every handler sees the events of every network
+    def filtered(self, c, e):
+        if c is self.connection:
+            return handler(self, c, e)
+    return filtered
+
+
 class Bot(irc.bot.SingleServerIRCBot):
-    def __init__(self, token, channel, nickname, server, port=6667):
-        irc.bot.SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname)
-        self.channel = channel
+    """
+    The connection to one irc network. Any number of them share one TelegramBot,
+    one outbound queue and, when given, one reactor, so a single thread serves
+    every network.
+    """
 
-        self.telegram = TelegramBot(token, self)
+    def __init__(self, network, channels, nickname, server, telegram, outbound, port=6667, reactor=None):
+        if reactor is not None:
+            self.reactor_class = lambda: reactor
+
+        irc.bot.SingleServerIRCBot.__init__(self, [(server, port)], nickname, nickname)
+        self.network = network
+        self.server = server
+        self.relay_channels = channels
+
+        self.telegram = telegram
+        self.outbound = outbound
+
+        for channel in channels:
+            telegram.add_channel(self.channel_key(channel), self, channel)
+
+        # the users of every joined channel, sorted for /users
+        self.rosters = irc.dict.IRCDict()
+
+        # the channels a user leaves by quitting or renames himself in are gone from
+        # self.channels once on_quit/on_nick run, remember them before
+        for event in ['quit', 'nick']:
+            self.connection.add_global_handler(event, self._remember_user_channels, -30)
+
+    _dispatcher = own_events_only(irc.bot.SingleServerIRCBot._dispatcher)
+    _dcc_disconnect = own_events_only(irc.bot.SingleServerIRCBot._dcc_disconnect)
+    _on_disconnect = own_events_only(irc.bot.SingleServerIRCBot._on_disconnect)
+    _on_join = own_events_only(irc.bot.SingleServerIRCBot._on_join)
+    _on_kick = own_events_only(irc.bot.SingleServerIRCBot._on_kick)
+    _on_mode = own_events_only(irc.bot.SingleServerIRCBot._on_mode)
+    _on_namreply = own_events_only(irc.bot.SingleServerIRCBot._on_namreply)
+    _on_nick = own_events_only(irc.bot.SingleServerIRCBot._on_nick)
+    _on_part = own_events_only(irc.bot.SingleServerIRCBot._on_part)
+    _on_quit = own_events_only(irc.bot.SingleServerIRCBot._on_quit)
+
+    @own_events_only
+    def _remember_user_channels(self, c, e):
+        nick = self.get_nick(e.source)
+        e.relay_channels = [channel for channel in self.relay_channels
+                            if channel in self.channels and self.channels[channel].has_user(nick)]
+
+    def channel_key(self, channel):
+        return '{0:s}/{1:s}'.format(self.network, channel.lower())
 
     def on_nicknameinuse(self, c, e):
         logger.info('nickname already in use, add an underscore')
@@ -32,8 +89,9 @@ class Bot(irc.bot.SingleServerIRCBot):
 
     def on_welcome(self, c, e):
         # server welcome
-        logger.info('joining channel: {0:s}'.format(self.channel))
-        c.join(self.channel)
+        for channel in self.relay_channels:
+            logger.info('joining channel: {0:s}'.format(channel))
+            c.join(channel)
 
     def on_privmsg(self, c, e):
         logger.debug('on private message, event: ' + str(e))
@@ -48,9 +106,9 @@ class Bot(irc.bot.SingleServerIRCBot):
         msg = e.arguments[0]
         current_time = datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S")
 
-        logger.info('[{0:s}] <{1:s}> {2:s}'.format(current_time, nick, msg))
+        logger.info('[{0:s}] {1:s} <{2:s}> {3:s}'.format(current_time, e.target, nick, msg))
 
-        self.telegram.send_msg(nick, msg)
+        self.outbound.send_msg(self.channel_key(e.target), nick, msg)
 
     def on_kick(self, c, e):
         # arg[0] was kicked by e.source (arg[1])
@@ -63,7 +121,12 @@ class Bot(irc.bot.SingleServerIRCBot):
         msg = '{0:s} was kicked by {1:s} ({2:s})'.format(kicked_user, kicked_by, reason)
         logger.info('* ' + msg)
 
-        self.telegram.send_notification(msg)
+        if kicked_user == c.get_nickname():
+            self.rosters.pop(e.target, None)
+        else:
+            self.update_roster(e.target, [kicked_user])
+
+        self.outbound.send_notification(self.channel_key(e.target), msg)
 
     def on_join(self, c, e):
         # e.source has joined e.target
@@ -78,7 +141,11 @@ class Bot(irc.bot.SingleServerIRCBot):
 
         # avoid sending telegram users the joined msg when the bot joins the irc channel
         if joined_user != c.get_nickname():
-            self.telegram.send_notification(msg)
+            self.update_roster(e.target, [joined_user])
+            self.outbound.send_notification(self.channel_key(e.target), msg)
+        else:
+            # filled in once the server listed the names
+            self.rosters[e.target] = Roster()
 
     def on_quit(self, c, e):
         # e.source Quit (arg[0])
@@ -91,7 +158,9 @@ class Bot(irc.bot.SingleServerIRCBot):
         msg = '{0:s} ({1:s}) Quit ({2:s})'.format(leaving_user, leaving_user_id, quit_msg)
         logger.info('* ' + msg)
 
-        self.telegram.send_notification(msg)
+        for channel in getattr(e, 'relay_channels', []):
+            self.update_roster(channel, [leaving_user])
+            self.outbound.send_notification(self.channel_key(channel), msg)
 
     def on_part(self, c, e):
         # e.source has left e.target
@@ -104,7 +173,12 @@ class Bot(irc.bot.SingleServerIRCBot):
         msg = '{0:s} ({1:s}) has left {2:s}'.format(leaving_user, leaving_user_id, channel)
         logger.info('* ' + msg)
 
-        self.telegram.send_notification(msg)
+        if leaving_user == c.get_nickname():
+            self.rosters.pop(e.target, None)
+        else:
+            self.update_roster(e.target, [leaving_user])
+
+        self.outbound.send_notification(self.channel_key(e.target), msg)
 
     def on_topic(self, c, e):
         # e.source sets topic arg[0]
@@ -116,7 +190,7 @@ class Bot(irc.bot.SingleServerIRCBot):
         msg = '{0:s} changes topic to \'{1:s}\''.format(topic_changer, new_topic)
         logger.info('* ' + msg)
 
-        self.telegram.send_notification(msg)
+        self.outbound.send_notification(self.channel_key(e.target), msg)
 
     def on_nick(self, c, e):
         # e.source is now known as e.target
@@ -128,19 +202,35 @@ class Bot(irc.bot.SingleServerIRCBot):
         msg = '{0:s} is now known as {1:s}'.format(nick_changer, new_nick)
         logger.info('* ' + msg)
 
-        self.telegram.send_notification(msg)
+        for channel in getattr(e, 'relay_channels', []):
+            self.update_roster(channel, [nick_changer, new_nick])
+            self.outbound.send_notification(self.channel_key(channel), msg)
 
     def on_mode(self, c, e):
         # e.source sets mode arg[0] arg[1]
         logger.debug('on mode, event: ' + str(e))
 
+        # user modes are not relayed
+        if not irc.client.is_channel(e.target):
+            return
+
         mode_changer = self.get_nick(e.source)
         new_mode = ' '.join(e.arguments)
 
+        # the nicks given operator or voice, or having it taken
+        self.update_roster(e.target, [nick for sign, mode, nick in irc.modes.parse_channel_modes(new_mode) if nick])
+
         msg = '{0:s} sets mode: {1:s}'.format(mode_changer, new_mode)
         logger.info('* ' + msg)
 
-        self.telegram.send_notification(msg)
+        self.outbound.send_notification(self.channel_key(e.target), msg)
+
+    def on_endofnames(self, c, e):
+        # the server listed everyone in arg[0], the irc library knows them all now
+        self.reset_roster(e.arguments[0])
+
+    def on_disconnect(self, c, e):
+        self.rosters.clear()
 
     def on_action(self, c, e):
         # no use case for now
@@ -164,23 +254,106 @@ class Bot(irc.bot.SingleServerIRCBot):
     def get_id(full_id):
         return full_id.split('!')[1]
 
-    def get_users(self):
-        logger.debug('getting channel users')
-        users = {}
+    @staticmethod
+    def rank(channel_obj, nick):
+        if channel_obj.is_oper(nick):
+            return OPER
+        if channel_obj.is_voiced(nick):
+            return VOICED
+        return USER
+
+    def update_roster(self, channel, nicks):
+        # called after the irc library updated the channel, the roster follows suit
+        roster = self.rosters.get(channel)
+        channel_obj = self.channels.get(channel)
+        if roster is None or channel_obj is None:
+            return
+
+        for nick in nicks:
+            if channel_obj.has_user(nick):
+                roster.set(nick, self.rank(channel_obj, nick))
+            else:
+                roster.discard(nick)
+
+    def reset_roster(self, channel):
+        roster = self.rosters.get(channel)
+        channel_obj = self.channels.get(channel)
+        if roster is None or channel_obj is None:
+            return
+
+        roster.reset((nick, self.rank(channel_obj, nick)) for nick in channel_obj.users())
+
+    def get_users(self, channel):
+        """
+        The /users reply of a channel as a list of messages, empty if the bot is not in it.
+        """
+        roster = self.rosters.get(channel)
+        return roster.chunks() if roster is not None else []
+
+
+def read_networks(config):
+    # every [Irc] or [Irc <name>] section is a network
+    networks = []
+
+    for section in config.sections():
+        if section != 'Irc' and not section.startswith('Irc '):
+            continue
+
+        server = config[section]['server']
+        port_s = config[section].get('port')
+
+        if port_s:
+            try:
+                port = int(port_s)
+            except ValueError:
+                print('Error: Erroneous port.')
+                sys.exit(1)
+        else:
+            port = 6667
+
+        name = section[len('Irc '):].strip() or server
+        channels = [channel.strip() for channel in config[section]['channel'].split(',') if channel.strip()]
+        nickname = config[section]['nickname']
+
+        networks.append((name, server, port, channels, nickname))
 
-        channel_obj = self.channels[self.channel]
+    return networks
 
-        users['users'] = sorted(
-            set(channel_obj.users()) - set(list(channel_obj.opers()) + list(channel_obj.voiced())),
-            key=self.user_sort_key)
-        users['opers'] = sorted(channel_obj.opers(), key=self.user_sort_key)
-        users['voiced'] = sorted(set(channel_obj.voiced()) - set(channel_obj.opers()), key=self.user_sort_key)
 
-        return users
+def outbound_options(config):
+    return {'maxsize': config.getint('Relay', 'queue_size', fallback=1000),
+            'policy': config.get('Relay', 'backpressure', fallback='drop_oldest'),
+            'workers': config.getint('Relay', 'delivery_workers', fallback=1),
+            'coalesce_window': config.getfloat('Relay', 'coalesce_window', fallback=1.0),
+            'coalesce_idle': config.getfloat('Relay', 'coalesce_idle', fallback=0.3),
+            'coalesce_size': config.getint('Relay', 'coalesce_size', fallback=4096),
+            'spool': open_spool(config),
+            'replay_interval': config.getfloat('Relay', 'replay_interval', fallback=5.0)}
 
-    def user_sort_key(self, user):
-        # TODO fix name ordering
-        return ''.join(c for c in user if c not in '[]{}()<>')
+
+def open_spool(config):
+    directory = config.get('Relay', 'spool', fallback='')
+    if not directory:
+        return None
+
+    return Spool(directory,
+                 max_age=config.getfloat('Relay', 'spool_max_age', fallback=24) * 3600,
+                 max_size=config.getint('Relay', 'spool_max_size', fallback=100) * 1024 * 1024,
+                 sync_interval=config.getfloat('Relay', 'spool_sync_interval', fallback=1.0))
+
+
+def log_usage():
+    # memory and context switches so far, to compare the threaded and the asyncio relay
+    try:
+        import resource
+    except ImportError:
+        # unix only
+        logger.info('threads: {0:d}'.format(threading.active_count()))
+        return
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    logger.info('max rss: {0:d} kB, context switches: {1:d} voluntary, {2:d} involuntary, threads: {3:d}'
+                .format(usage.ru_maxrss, usage.ru_nvcsw, usage.ru_nivcsw, threading.active_count()))
 
 
 def main():
@@ -189,12 +362,12 @@ def main():
     arguments = sys.argv[1:]
 
     config_file = 'config.cfg'
-    config = None
+    config = configparser.ConfigParser(allow_no_value=True)
 
     if len(arguments) == 1:
         config_file = arguments[0]
     elif len(arguments) != 4:
-        print('Usage: ./bot <server[:port]> <channel> <nickname> <telegram-token>\n')
+        print('Usage: ./bot <server[:port]> <channel[,channel...]> <nickname> <telegram-token>\n')
         print('\t or ./bot <configfile>')
         print('\t or ./bot')
 
@@ -213,39 +386,65 @@ def main():
                 sys.exit(1)
         else:
             port = 6667
-        channel = sys.argv[2]
+        channels = sys.argv[2].split(',')
         nickname = sys.argv[3]
         token = sys.argv[4]
+
+        networks = [(server, server, port, channels, nickname)]
     else:
-        config = configparser.ConfigParser(allow_no_value=True)
         config.read(config_file)
 
-        server = config['Irc']['server']
-        port_s = config['Irc']['port']
-
-        if port_s:
-            try:
-                port = int(port_s)
-            except ValueError:
-                print('Error: Erroneous port.')
-                sys.exit(1)
-        else:
-            port = 6667
-
-        channel = config['Irc']['channel']
-        nickname = config['Irc']['nickname']
+        networks = read_networks(config)
         token = config['Telegram']['token']
 
     print('starting irc-telegram bot\n')
-    print('server: ' + server)
-    print('port: ' + str(port))
-    print('channel: ' + channel)
-    print('nick: ' + nickname)
+    for name, server, port, channels, nickname in networks:
+        print('network: ' + name)
+        print('server: ' + server)
+        print('port: ' + str(port))
+        print('channels: ' + ', '.join(channels))
+        print('nick: ' + nickname)
+        print('')
     print('token: ' + token)
     print('')
 
-    bot = Bot(server=server, port=port, channel=channel, nickname=nickname, token=token)
-    bot.start()
+    mode = config.get('Relay', 'mode', fallback='threads')
+    if mode == 'asyncio':
+        import aiorelay
+        aiorelay.main(config, networks, token)
+        return
+    elif mode != 'threads':
+        print('Error: unknown mode: ' + mode)
+        sys.exit(1)
+
+    telegram = TelegramBot(token, config)
+
+    # the irc handlers only enqueue, delivery to telegram happens on the outbound workers
+    outbound = OutboundQueue(telegram, **outbound_options(config))
+
+    # one reactor for all networks
+    reactor = irc.client.Reactor()
+
+    bots = [Bot(network=name, server=server, port=port, channels=channels, nickname=nickname,
+                telegram=telegram, outbound=outbound, reactor=reactor)
+            for name, server, port, channels, nickname in networks]
+
+    backlog_save_interval = config.getint('Relay', 'backlog_save_interval', fallback=60)
+    if telegram.backlog.file_name and backlog_save_interval > 0:
+        reactor.scheduler.execute_every(backlog_save_interval, telegram.backlog.save)
+
+    usage_interval = config.getint('Relay', 'usage_interval', fallback=600)
+    if usage_interval > 0:
+        reactor.scheduler.execute_every(usage_interval, log_usage)
+
+    telegram.start()
+
+    for bot in bots:
+        bot._connect()
+    try:
+        reactor.process_forever()
+    finally:
+        telegram.stop()
 
 
 if __name__ == '__main__':
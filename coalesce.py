@@ -0,0 +1,105 @@
+import time
+
+# telegram refuses messages longer than this
+max_message_length = 4096
+
+
+class Coalescer:
+    """
+    Collects consecutive relayed lines and hands them out as few telegram messages
+    as possible. Lines are kept in order and untouched, so `<nick>` prefixes stay.
+
+    Users with notifications enabled get every line, users without only the channel
+    messages, so a batch with both kinds of lines is rendered twice: once as
+    'notification' for the former and once as 'quiet' for the latter.
+    """
+
+    def __init__(self, window=1.0, idle=0.3, size=max_message_length, header=None):
+        # window: longest time a line is held back
+        # idle: flush as soon as no line came in for this long
+        # size: flush once this many characters are collected
+        # header: first line of every message, telling the channel apart from others
+        self.window = window
+        self.idle = idle
+        self.size = min(size, max_message_length)
+        self.header = header
+
+        self.lines = []
+        self.length = 0
+        self.first = 0.0
+        self.last = 0.0
+
+    def add(self, kind, text):
+        now = time.time()
+        if not self.lines:
+            self.first = now
+        self.last = now
+
+        self.lines.append((kind, text))
+        self.length += len(text) + 1
+
+    def timeout(self):
+        # how long the delivery worker may wait for the next line
+        if not self.lines:
+            return None
+
+        now = time.time()
+        return max(0.0, min(self.last + self.idle, self.first + self.window) - now)
+
+    def due(self):
+        if not self.lines:
+            return False
+
+        now = time.time()
+        return (self.length >= self.size
+                or now - self.first >= self.window
+                or now - self.last >= self.idle)
+
+    def flush(self):
+        """
+        Return the collected lines as a list of (audience, text) tuples and start over.
+        """
+        lines, self.lines, self.length = self.lines, [], 0
+
+        msgs = [text for kind, text in lines if kind == 'msg']
+
+        if len(msgs) == len(lines):
+            return [('msg', text) for text in self.chunk(msgs)]
+
+        batches = [('notification', text) for text in self.chunk([text for kind, text in lines])]
+        if msgs:
+            batches += [('quiet', text) for text in self.chunk(msgs)]
+
+        return batches
+
+    def chunk(self, lines):
+        if self.header:
+            return [self.header + '\n' + chunk for chunk in self.split(lines, self.size - len(self.header) - 1)]
+        return self.split(lines, self.size)
+
+    @staticmethod
+    def split(lines, size):
+        chunks = []
+        current = ''
+
+        for line in lines:
+            # a single line over the limit has to be cut
+            while len(line) > size:
+                if current:
+                    chunks.append(current)
+                    current = ''
+                chunks.append(line[:size])
+                line = line[size:]
+
+            if not current:
+                current = line
+            elif len(current) + 1 + len(line) <= size:
+                current += '\n' + line
+            else:
+                chunks.append(current)
+                current = line
+
+        if current:
+            chunks.append(current)
+
+        return chunks
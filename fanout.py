@@ -0,0 +1,332 @@
+import re
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+import threading
+import concurrent.futures
+
+import urllib3
+import telepot.exception
+
+logger = logging.getLogger(__name__)
+
+# sending to these chats will never work again: blocked by the user, kicked from
+# the group, deleted chat or account
+dead_chat_errors = (telepot.exception.BotWasBlockedError,
+                    telepot.exception.BotWasKickedError,
+                    telepot.exception.ChatNotFoundError,
+                    telepot.exception.UserDeactivatedError)
+
+# errors about the chat rather than the message or the bot: not a member, no rights
+# to write, ... (403 is always the chat). A message too long or badly formatted fails
+# for every chat alike and is no reason to give up on any of them.
+chat_error_codes = (400, 403)
+chat_error_pattern = re.compile(r'forbidden|chat|user|group|channel|member|rights|peer', re.IGNORECASE)
+
+# network trouble, worth another try (telegram server errors are too)
+transient_errors = (urllib3.exceptions.HTTPError, EnvironmentError, telepot.exception.BadHTTPResponse)
+
+
+class Timer:
+    """
+    Calls functions after a delay, all from one thread, so a retry waiting for its
+    turn does not hold up a worker of the fan-out pool.
+    """
+
+    def __init__(self, name='timer'):
+        self.calls = []  # heap of (when, sequence, func, args)
+        self.sequence = itertools.count()
+        self.wakeup = threading.Condition()
+
+        thread = threading.Thread(target=self.run, name=name)
+        thread.daemon = True
+        thread.start()
+
+    def call_later(self, delay, func, *args):
+        with self.wakeup:
+            heapq.heappush(self.calls, (time.time() + delay, next(self.sequence), func, args))
+            self.wakeup.notify()
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                while not self.calls or self.calls[0][0] > time.time():
+                    self.wakeup.wait(self.calls[0][0] - time.time() if self.calls else None)
+                when, sequence, func, args = heapq.heappop(self.calls)
+
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error('timer call failed: {0:s}'.format(repr(e)))
+
+
+class FanOut:
+    """
+    Sends one relayed line to many telegram chats in parallel on a bounded pool
+    of worker threads. `broadcast` only queues the sends and returns right away,
+    so the irc reactor never waits for telegram. A send to retry is queued again
+    after its backoff, the worker moves on to other chats meanwhile.
+    """
+
+    def __init__(self, send, workers=10, on_dead=None, on_migrated=None, retries=3, backoff=1.0,
+                 max_failures=5, transient_errors=transient_errors):
+        # the default of 10 workers matches the size of telepot's default connection
+        # pool, more workers would open throwaway connections
+        self.send = send
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='fanout')
+        self.timer = Timer('fanout-retry')
+        self.init_failures(on_dead, on_migrated, retries, backoff, max_failures, transient_errors)
+        self.init_stats()
+
+    def init_failures(self, on_dead, on_migrated, retries, backoff, max_failures, transient_errors):
+        # on_dead(chat_id, error) is called once a chat is given up on: right away for
+        # dead_chat_errors, after max_failures failed sends in a row for other errors
+        # about the chat. on_migrated(chat_id, new_chat_id) is called for a group that
+        # became a supergroup, the send is then made to the supergroup.
+        self.on_dead = on_dead
+        self.on_migrated = on_migrated
+        self.retries = retries
+        self.backoff = backoff
+        self.max_failures = max_failures
+        self.transient_errors = transient_errors
+
+        # chat id -> failed sends in a row
+        self.failures = {}
+
+    def init_stats(self):
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+        self.total_duration = 0.0
+        self.failed = 0
+        self.retried = 0
+        self.pruned = 0
+        self.migrated = 0
+
+    def broadcast(self, chat_ids, message):
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return []
+
+        batch = Batch(self, len(chat_ids))
+
+        # a future per chat, done once the send succeeded or was given up on, with
+        # retries in between
+        futures = []
+        for chat_id in chat_ids:
+            future = concurrent.futures.Future()
+            future.add_done_callback(batch.done)
+            self.executor.submit(self.send_one, chat_id, message, future)
+            futures.append(future)
+
+        return futures
+
+    def send_one(self, chat_id, message, future, attempt=0):
+        # the future's result is chat_id if the message should be sent again later
+        try:
+            try:
+                self.send(chat_id, message)
+            except Exception as e:
+                # one failing chat must not keep the others from getting the message
+                if self.should_retry(e, attempt):
+                    self.retrying(chat_id, e)
+                    self.timer.call_later(self.backoff * 2 ** attempt,
+                                          self.retry, chat_id, message, future, attempt + 1)
+                    return
+
+                new_chat_id = self.migrate(chat_id, e)
+                if new_chat_id is not None:
+                    self.send_one(new_chat_id, message, future)
+                    return
+
+                future.set_result(self.send_failed(chat_id, e))
+                return
+
+            self.send_succeeded(chat_id)
+            future.set_result(None)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    def retry(self, chat_id, message, future, attempt):
+        try:
+            self.executor.submit(self.send_one, chat_id, message, future, attempt)
+        except RuntimeError:
+            # shut down meanwhile, leave it to the spool
+            future.set_result(chat_id)
+
+    def should_retry(self, e, attempt):
+        return attempt < self.retries and self.is_transient(e)
+
+    def is_transient(self, e):
+        if isinstance(e, telepot.exception.TooManyRequestsError):
+            # the rate limiter has retried already
+            return False
+        if isinstance(e, telepot.exception.TelegramError):
+            return e.error_code >= 500
+        return isinstance(e, self.transient_errors)
+
+    @staticmethod
+    def is_chat_error(e):
+        if isinstance(e, dead_chat_errors):
+            return True
+        return (isinstance(e, telepot.exception.TelegramError) and e.error_code in chat_error_codes and
+                chat_error_pattern.search(e.description or '') is not None)
+
+    def retrying(self, chat_id, e):
+        logger.warning('sending to {0:d} failed, trying again: {1:s}'.format(chat_id, repr(e)))
+        with self.lock:
+            self.retried += 1
+
+    def send_succeeded(self, chat_id):
+        if chat_id in self.failures:
+            with self.lock:
+                self.failures.pop(chat_id, None)
+
+    def migrate(self, chat_id, e):
+        # returns the supergroup a group became, if that is why the send failed
+        if not isinstance(e, telepot.exception.MigratedToSupergroupChatError) or e.migrate_to_chat_id is None:
+            return None
+
+        new_chat_id = e.migrate_to_chat_id
+        logger.info('chat {0:d} moved to supergroup {1:d}'.format(chat_id, new_chat_id))
+        with self.lock:
+            self.migrated += 1
+            self.failures.pop(chat_id, None)
+
+        if self.on_migrated:
+            try:
+                self.on_migrated(chat_id, new_chat_id)
+            except Exception as on_migrated_error:
+                logger.error('moving chat {0:d} failed: {1:s}'.format(chat_id, repr(on_migrated_error)))
+        return new_chat_id
+
+    def send_failed(self, chat_id, e):
+        # only errors about the chat count, not an outage, a flood wait or a bad message
+        counts = self.is_chat_error(e)
+        replay = self.is_transient(e) or isinstance(e, telepot.exception.TooManyRequestsError)
+
+        with self.lock:
+            self.failed += 1
+            failures = self.failures.get(chat_id, 0) + 1 if counts else 0
+
+            dead = isinstance(e, dead_chat_errors) or (counts and failures >= self.max_failures)
+            if dead:
+                self.failures.pop(chat_id, None)
+                self.pruned += 1
+            elif counts:
+                self.failures[chat_id] = failures
+
+        if not dead:
+            logger.error('sending to {0:d} failed: {1:s}'.format(chat_id, repr(e)))
+            # worth another try once telegram is back
+            return chat_id if replay else None
+
+        logger.warning('giving up on chat {0:d}: {1:s}'.format(chat_id, repr(e)))
+        if self.on_dead:
+            try:
+                self.on_dead(chat_id, e)
+            except Exception as on_dead_error:
+                logger.error('removing chat {0:d} failed: {1:s}'.format(chat_id, repr(on_dead_error)))
+        return None
+
+    def batch_done(self, size, duration):
+        with self.lock:
+            self.batches += 1
+            self.last_duration = duration
+            self.max_duration = max(self.max_duration, duration)
+            self.total_duration += duration
+
+        logger.info('fan-out to {0:d} users took {1:.3f}s'.format(size, duration))
+
+    def stats(self):
+        with self.lock:
+            return {'batches': self.batches,
+                    'last_duration': self.last_duration,
+                    'max_duration': self.max_duration,
+                    'avg_duration': self.total_duration / self.batches if self.batches else 0.0,
+                    'failed': self.failed,
+                    'retried': self.retried,
+                    'pruned': self.pruned,
+                    'migrated': self.migrated,
+                    'failing_chats': len(self.failures)}
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+class AsyncFanOut(FanOut):
+    """
+    The fan-out of the asyncio relay: every send is a task on the event loop instead
+    of a job for a worker thread. How many of them talk to telegram at once is bounded
+    by the rate limiter and the connection pool of telepot.aio, a waiting send costs
+    a suspended coroutine instead of a thread.
+    """
+
+    def __init__(self, send, loop=None, on_dead=None, on_migrated=None, retries=3, backoff=1.0, max_failures=5,
+                 transient_errors=(asyncio.TimeoutError, EnvironmentError)):
+        self.send = send
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.init_failures(on_dead, on_migrated, retries, backoff, max_failures, transient_errors)
+        self.init_stats()
+
+    def broadcast(self, chat_ids, message):
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return []
+
+        batch = Batch(self, len(chat_ids))
+
+        tasks = []
+        for chat_id in chat_ids:
+            task = self.loop.create_task(self.send_one(chat_id, message))
+            task.add_done_callback(batch.done)
+            tasks.append(task)
+
+        return tasks
+
+    async def send_one(self, chat_id, message):
+        attempt = 0
+        while True:
+            try:
+                await self.send(chat_id, message)
+            except Exception as e:
+                if self.should_retry(e, attempt):
+                    self.retrying(chat_id, e)
+                    await asyncio.sleep(self.backoff * 2 ** attempt)
+                    attempt += 1
+                    continue
+
+                new_chat_id = self.migrate(chat_id, e)
+                if new_chat_id is not None:
+                    chat_id = new_chat_id
+                    attempt = 0
+                    continue
+
+                return self.send_failed(chat_id, e)
+
+            self.send_succeeded(chat_id)
+            return None
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class Batch:
+    def __init__(self, fanout, size):
+        self.fanout = fanout
+        self.size = size
+        self.pending = size
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def done(self, future):
+        with self.lock:
+            self.pending -= 1
+            finished = self.pending == 0
+
+        if finished:
+            self.fanout.batch_done(self.size, time.time() - self.started)
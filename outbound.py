@@ -0,0 +1,431 @@
+import time
+import asyncio
+import logging
+import itertools
+import threading
+import collections
+import concurrent.futures
+
+from coalesce import Coalescer, max_message_length
+
+logger = logging.getLogger(__name__)
+
+# backpressure policies, applied when an event arrives while the queue is full
+DROP_OLDEST = 'drop_oldest'
+COALESCE = 'coalesce'
+BLOCK = 'block'
+
+policies = [DROP_OLDEST, COALESCE, BLOCK]
+
+Event = collections.namedtuple('Event', ['kind', 'channel', 'text', 'timestamp'])
+
+# spool entries the asyncio replay reads at a time, off the event loop
+replay_batch = 100
+
+
+class OutboundQueue:
+    """
+    Sits between the irc handlers and the telegram delivery. The irc handlers only
+    put events into a bounded queue, separate delivery workers take them out and
+    hand them to telegram, so a slow telegram never stalls the irc reactor.
+
+    With a spool every delivery is written to disk first. Users a send failed to are
+    left to a replay worker, which sends them what they missed once telegram is
+    back, and deliveries cut short by a restart are made again.
+    """
+
+    def __init__(self, telegram, maxsize=1000, policy=DROP_OLDEST, workers=1,
+                 coalesce_window=1.0, coalesce_idle=0.3, coalesce_size=max_message_length,
+                 spool=None, replay_interval=5.0):
+        if policy not in policies:
+            raise ValueError('unknown backpressure policy: {0:s}'.format(policy))
+
+        self.telegram = telegram
+        self.maxsize = maxsize
+        self.policy = policy
+        self.coalesce_spec = (coalesce_window, coalesce_idle, coalesce_size)
+
+        self.events = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+        self.enqueued = 0
+        self.taken = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+        self.spool = spool
+        self.replay_interval = replay_interval
+        self.replayed = 0
+
+        # more than one worker delivers faster but no longer keeps the line order
+        self.workers = self.start_workers(workers)
+        if spool is not None:
+            self.replayer = self.start_replay()
+
+    def start_workers(self, count):
+        workers = []
+        for i in range(count):
+            worker = threading.Thread(target=self.deliver_forever, name='delivery-{0:d}'.format(i))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        return workers
+
+    def start_replay(self):
+        replayer = threading.Thread(target=self.replay_forever, name='replay')
+        replayer.daemon = True
+        replayer.start()
+        return replayer
+
+    def send_msg(self, channel, nick, msg):
+        self.telegram.backlog.add(channel, 'msg', nick, msg)
+        self.put('msg', channel, self.telegram.format_msg(nick, msg))
+
+    def send_notification(self, channel, msg):
+        self.telegram.backlog.add(channel, 'notification', '', msg)
+        self.put('notification', channel, self.telegram.format_notification(msg))
+
+    def put(self, kind, channel, text):
+        event = Event(kind, channel, text, time.time())
+
+        with self.not_full:
+            if len(self.events) >= self.maxsize:
+                if self.policy == BLOCK:
+                    while len(self.events) >= self.maxsize:
+                        self.not_full.wait()
+                elif self.policy == COALESCE and self.coalesce(event):
+                    return
+                else:
+                    self.events.popleft()
+                    self.dropped += 1
+                    logger.warning('outbound queue full, dropped the oldest event')
+
+            self.events.append(event)
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.events))
+            self.not_empty.notify()
+
+    def coalesce(self, event):
+        # merge into the newest queued event, keeping its timestamp so the lag stays honest
+        last = self.events[-1]
+        text = last.text + '\n' + event.text
+
+        if last.kind != event.kind or last.channel != event.channel or len(text) > max_message_length:
+            return False
+
+        self.events[-1] = last._replace(text=text)
+        self.coalesced += 1
+        return True
+
+    def get(self, timeout=None):
+        with self.not_empty:
+            if not self.not_empty.wait_for(lambda: self.events, timeout):
+                return None
+
+            return self.take()
+
+    def take(self):
+        # called with the lock held
+        event = self.events.popleft()
+        self.not_full.notify()
+
+        lag = time.time() - event.timestamp
+        self.taken += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+
+        return event
+
+    def deliver_forever(self):
+        # every worker batches the lines it takes into as few telegram messages as possible,
+        # separately per channel since every channel has its own subscribers
+        coalescers = {}
+
+        while True:
+            event = self.get(self.next_timeout(coalescers))
+
+            if event is not None:
+                self.collect(coalescers, event)
+
+            for channel, audience, text in self.flush_due(coalescers):
+                self.deliver(channel, audience, text)
+
+            if event is not None:
+                with self.lock:
+                    self.delivered += 1
+
+    @staticmethod
+    def next_timeout(coalescers):
+        timeouts = [timeout for timeout in (c.timeout() for c in coalescers.values()) if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def collect(self, coalescers, event):
+        try:
+            coalescer = coalescers[event.channel]
+        except KeyError:
+            coalescer = coalescers[event.channel] = Coalescer(*self.coalesce_spec,
+                                                              header=self.telegram.channel_header(event.channel))
+        coalescer.add(event.kind, event.text)
+
+    @staticmethod
+    def flush_due(coalescers):
+        for channel, coalescer in coalescers.items():
+            if coalescer.due():
+                for audience, text in coalescer.flush():
+                    yield channel, audience, text
+
+    def deliver(self, channel, audience, text):
+        seq = self.spool.append(channel, audience, text) if self.spool is not None else None
+        self.fan_out(seq, channel, audience, text)
+
+    def fan_out(self, seq, channel, audience, text):
+        try:
+            skip = self.spool.skipped() if seq is not None else None
+            futures = self.telegram.deliver(channel, audience, text, skip)
+            # wait for the whole fan-out, so a slow telegram fills up this queue
+            # instead of the fan-out pool
+            concurrent.futures.wait(futures)
+            if seq is not None:
+                self.fell_behind(seq, futures)
+        except Exception as e:
+            logger.error('delivering to {0:s} of {1:s} failed: {2:s}'.format(audience, channel, repr(e)))
+        finally:
+            if seq is not None:
+                self.spool.done(seq)
+
+    def fell_behind(self, seq, futures):
+        # the fan-out returns the chat id of every send worth trying again later
+        for future in futures:
+            chat_id = future.result()
+            if chat_id is not None:
+                self.spool.fell_behind(chat_id, seq)
+
+    def replay_forever(self):
+        self.recover()
+
+        while True:
+            try:
+                # right on while it makes progress, otherwise give telegram some time
+                if self.spool.lagging and self.replay():
+                    continue
+            except Exception as e:
+                logger.error('replaying the spool failed: {0:s}'.format(repr(e)))
+            time.sleep(self.replay_interval)
+
+    def recover(self):
+        # deliveries a restart cut short are made again, to everyone
+        for seq, timestamp, channel, audience, text in self.spool.unfinished():
+            logger.info('delivering spool entry {0:d} again'.format(seq))
+            self.fan_out(seq, channel, audience, text)
+
+    def replay(self):
+        """
+        Send the lagging users everything after their cursor, in order. A user a send
+        fails to again is left for the next round. Returns False if any send failed.
+        """
+        progress = ReplayRound(self.spool.cursors(), self.telegram.users)
+
+        for seq, due, text in self.replay_due(progress, self.spool.read(progress.start())):
+            futures = self.telegram.send_to(due, text)
+            concurrent.futures.wait(futures)
+            self.replay_sent(progress, seq, due, (future.result() for future in futures))
+
+        self.replay_done(progress)
+        return not progress.failed
+
+    @staticmethod
+    def replay_due(progress, entries):
+        # yields (seq, chat ids, text) for the spool entries a lagging user still has to get
+        for seq, timestamp, channel, audience, text in entries:
+            due = progress.due(seq, channel, audience)
+            if due:
+                yield seq, due, text
+
+    def replay_sent(self, progress, seq, due, results):
+        for chat_id in progress.sent(due, results):
+            self.spool.advance(chat_id, seq)
+        with self.lock:
+            self.replayed += 1
+
+    def replay_done(self, progress):
+        # past the entries read, there was nothing more for them in there
+        for chat_id in progress.behind:
+            self.spool.advance(chat_id, progress.last)
+
+        for chat_id in progress.cursors:
+            if chat_id not in progress.failed and self.spool.caught_up(chat_id):
+                logger.info('chat {0:d} caught up with the spool'.format(chat_id))
+
+    def stats(self):
+        with self.lock:
+            return {'depth': len(self.events),
+                    'max_depth': self.max_depth,
+                    'enqueued': self.enqueued,
+                    'delivered': self.delivered,
+                    'dropped': self.dropped,
+                    'coalesced': self.coalesced,
+                    'last_lag': self.last_lag,
+                    'max_lag': self.max_lag,
+                    'avg_lag': self.total_lag / self.taken if self.taken else 0.0,
+                    'replayed': self.replayed}
+
+
+class ReplayRound:
+    """
+    One pass of the replay over the spool. A lagging user is behind from the entry
+    after its cursor on, and stays so unless a send to it fails; the entries it gets
+    are those of its channels, whose recipients are looked up once per round. Every
+    entry costs the users it is due to, not all the lagging ones.
+    """
+
+    def __init__(self, cursors, users):
+        self.cursors = cursors
+        self.users = users
+        self.waiting = sorted(cursors, key=cursors.get, reverse=True)  # not yet behind, lowest cursor last
+        self.behind = set()
+        self.failed = set()
+        self.recipients = {}  # (channel, audience) -> chat ids
+        self.last = None
+
+    def start(self):
+        # the spool is read after this entry
+        return min(self.cursors.values())
+
+    def due(self, seq, channel, audience):
+        while self.waiting and self.cursors[self.waiting[-1]] < seq:
+            self.behind.add(self.waiting.pop())
+        self.last = seq
+
+        try:
+            recipients = self.recipients[channel, audience]
+        except KeyError:
+            recipients = self.recipients[channel, audience] = frozenset(self.users.recipients(channel, audience))
+
+        return list(self.behind & recipients)
+
+    def sent(self, due, results):
+        # returns the chat ids the entry was sent to
+        failed = set(chat_id for chat_id in results if chat_id is not None)
+        self.failed |= failed
+        self.behind -= failed
+        return [chat_id for chat_id in due if chat_id not in failed]
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    """
+    The outbound queue of the asyncio relay. The irc handlers run on the event loop
+    as well, so putting an event never waits: the block policy is not available.
+    The delivery workers are tasks instead of threads, the spool is written and
+    read on a thread of its own.
+    """
+
+    def __init__(self, telegram, maxsize=1000, policy=DROP_OLDEST, workers=1,
+                 coalesce_window=1.0, coalesce_idle=0.3, coalesce_size=max_message_length,
+                 spool=None, replay_interval=5.0, loop=None):
+        if policy == BLOCK:
+            raise ValueError('the block backpressure policy would stall the event loop')
+
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.wakeup = asyncio.Event()
+        self.disk = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='spool')
+
+        super().__init__(telegram, maxsize, policy, workers, coalesce_window, coalesce_idle, coalesce_size,
+                         spool, replay_interval)
+
+    def start_workers(self, count):
+        return [self.loop.create_task(self.deliver_forever()) for i in range(count)]
+
+    def start_replay(self):
+        return self.loop.create_task(self.replay_forever())
+
+    def put(self, kind, channel, text):
+        super().put(kind, channel, text)
+        self.wakeup.set()
+
+    async def get(self, timeout=None):
+        if not self.events:
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+
+        with self.lock:
+            return self.take() if self.events else None
+
+    async def deliver_forever(self):
+        coalescers = {}
+
+        while True:
+            event = await self.get(self.next_timeout(coalescers))
+
+            if event is not None:
+                self.collect(coalescers, event)
+
+            for channel, audience, text in self.flush_due(coalescers):
+                await self.deliver(channel, audience, text)
+
+            if event is not None:
+                self.delivered += 1
+
+    async def deliver(self, channel, audience, text):
+        seq = None
+        if self.spool is not None:
+            seq = await self.loop.run_in_executor(self.disk, self.spool.append, channel, audience, text)
+        await self.fan_out(seq, channel, audience, text)
+
+    async def fan_out(self, seq, channel, audience, text):
+        try:
+            skip = self.spool.skipped() if seq is not None else None
+            tasks = self.telegram.deliver(channel, audience, text, skip)
+            if tasks:
+                await asyncio.wait(tasks)
+            if seq is not None:
+                self.fell_behind(seq, tasks)
+        except Exception as e:
+            logger.error('delivering to {0:s} of {1:s} failed: {2:s}'.format(audience, channel, repr(e)))
+        finally:
+            if seq is not None:
+                self.spool.done(seq)
+
+    async def replay_forever(self):
+        await self.recover()
+
+        while True:
+            try:
+                if self.spool.lagging and await self.replay():
+                    continue
+            except Exception as e:
+                logger.error('replaying the spool failed: {0:s}'.format(repr(e)))
+            await asyncio.sleep(self.replay_interval)
+
+    async def recover(self):
+        unfinished = await self.loop.run_in_executor(self.disk, list, self.spool.unfinished())
+        for seq, timestamp, channel, audience, text in unfinished:
+            logger.info('delivering spool entry {0:d} again'.format(seq))
+            await self.fan_out(seq, channel, audience, text)
+
+    async def replay(self):
+        progress = ReplayRound(self.spool.cursors(), self.telegram.users)
+
+        entries = self.spool.read(progress.start())
+        while True:
+            batch = await self.loop.run_in_executor(self.disk, list, itertools.islice(entries, replay_batch))
+            if not batch:
+                break
+
+            for seq, due, text in self.replay_due(progress, batch):
+                tasks = self.telegram.send_to(due, text)
+                await asyncio.wait(tasks)
+                self.replay_sent(progress, seq, due, (task.result() for task in tasks))
+
+        self.replay_done(progress)
+        return not progress.failed
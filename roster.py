@@ -0,0 +1,114 @@
+import bisect
+import threading
+
+import irc.strings
+
+from coalesce import max_message_length
+
+# the sections of the /users reply, by rank
+sections = ['Operators:', 'Moderators:', 'Users:']
+OPER, VOICED, USER = range(len(sections))
+
+# brackets are left out when sorting nicks
+sort_table = str.maketrans('', '', '[]{}()<>')
+
+
+def sort_key(nick):
+    return nick.translate(sort_table)
+
+
+class Roster:
+    """
+    The users of one irc channel by rank, every rank kept sorted. The irc handlers
+    update it one nick at a time, which keeps the order with a binary search
+    instead of sorting the channel again. The /users reply is rendered, already split
+    into telegram messages, on the first request after a change.
+
+    Nicks are told apart as irc does, without regard to case; a user is listed by
+    the nick as last set.
+    """
+
+    def __init__(self, size=max_message_length):
+        self.size = size
+        self.ranks = {}  # lower case nick -> (rank, nick)
+        self.sorted = [[] for section in sections]  # per rank, (sort key, nick) in order
+        self.lock = threading.Lock()
+        self.reply = None
+
+    def __len__(self):
+        return len(self.ranks)
+
+    def __contains__(self, nick):
+        return irc.strings.lower(nick) in self.ranks
+
+    def set(self, nick, rank):
+        key = irc.strings.lower(nick)
+        with self.lock:
+            old = self.ranks.get(key)
+            if old == (rank, nick):
+                return
+            if old is not None:
+                self.remove(old[1], old[0])
+
+            self.ranks[key] = (rank, nick)
+            bisect.insort(self.sorted[rank], (sort_key(nick), nick))
+            self.reply = None
+
+    def discard(self, nick):
+        with self.lock:
+            old = self.ranks.pop(irc.strings.lower(nick), None)
+            if old is not None:
+                self.remove(old[1], old[0])
+                self.reply = None
+
+    def remove(self, nick, rank):
+        # called with the lock held
+        entries = self.sorted[rank]
+        del entries[bisect.bisect_left(entries, (sort_key(nick), nick))]
+
+    def reset(self, members):
+        # members: (nick, rank) of everyone in the channel, as after joining it
+        with self.lock:
+            self.ranks = {irc.strings.lower(nick): (rank, nick) for nick, rank in members}
+            self.sorted = [[] for section in sections]
+            for rank, nick in self.ranks.values():
+                self.sorted[rank].append((sort_key(nick), nick))
+            for entries in self.sorted:
+                entries.sort()
+            self.reply = None
+
+    def nicks(self, rank):
+        with self.lock:
+            return [nick for key, nick in self.sorted[rank]]
+
+    def chunks(self):
+        """
+        The /users reply as a list of messages, none longer than telegram allows.
+        """
+        with self.lock:
+            if self.reply is None:
+                self.reply = self.render()
+            return self.reply
+
+    def render(self):
+        # called with the lock held
+        chunks = ['']
+
+        def add(text, separator):
+            if chunks[-1] and len(chunks[-1]) + len(separator) + len(text) > self.size:
+                chunks.append(text)
+            else:
+                chunks[-1] += separator + text if chunks[-1] else text
+
+        for rank, title in enumerate(sections):
+            # the users are listed even if there are none, operators and moderators not
+            if not self.sorted[rank] and rank != USER:
+                continue
+
+            add(title, '\n')
+            separator = '\n'
+            for key, nick in self.sorted[rank]:
+                add(nick, separator)
+                separator = ', '
+
+        return chunks
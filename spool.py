@@ -0,0 +1,255 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Spool:
+    """
+    A disk log of everything delivered to telegram, so lines relayed while telegram
+    is down, or while the bot restarts, are sent once it is back.
+
+    Every delivery gets a sequence number and is appended to the current segment
+    file; segments are dropped once they are older or the spool bigger than allowed.
+    Appends are flushed right away but only synced to disk every `sync_interval`
+    seconds, one fsync covering all lines appended meanwhile.
+
+    Subscribers are at the head (the last fully delivered entry) unless a send to
+    them failed. Those get a cursor of their own, the last entry they received, and
+    are skipped by the live delivery until the replay caught them up. The head and
+    the cursors are saved along with every sync.
+    """
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, max_age=24 * 3600, max_size=100 * 1024 * 1024,
+                 sync_interval=1.0):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_age = max_age
+        self.max_size = max_size
+        self.sync_interval = sync_interval
+
+        self.cursor_file_name = os.path.join(directory, 'cursors.json')
+
+        self.lock = threading.Lock()
+        self.segments = []  # first sequence number of every segment file, ascending
+        self.segment = None  # file of the last segment, appended to
+        self.last = 0  # sequence number of the last entry
+        self.dirty = False
+
+        self.head = 0
+        self.in_flight = set()
+        self.unfinished_last = 0
+        self.lagging = {}  # chat id -> sequence number of the last entry it received
+        self.cursors_changed = False
+
+        os.makedirs(directory, exist_ok=True)
+        self.open()
+
+        syncer = threading.Thread(target=self.sync_forever, name='spool-sync')
+        syncer.daemon = True
+        syncer.start()
+
+    def segment_file_name(self, first):
+        return os.path.join(self.directory, '{0:020d}.log'.format(first))
+
+    def open(self):
+        self.segments = sorted(int(name[:-len('.log')]) for name in os.listdir(self.directory)
+                               if name.endswith('.log'))
+
+        try:
+            with open(self.cursor_file_name, 'r') as file:
+                cursors = json.load(file)
+            self.head = cursors['head']
+            self.lagging = {int(chat_id): seq for chat_id, seq in cursors['lagging'].items()}
+        except FileNotFoundError:
+            pass
+
+        if not self.segments:
+            self.last = self.head
+            self.roll()
+            return
+
+        file_name = self.segment_file_name(self.segments[-1])
+        self.last = self.segments[-1] - 1
+
+        with open(file_name, 'rb') as file:
+            data = file.read()
+
+        # a crash in the middle of an append leaves a torn last line, cut it off
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            logger.warning('cutting a broken entry off the end of {0:s}'.format(file_name))
+            with open(file_name, 'r+b') as file:
+                file.truncate(end)
+
+        for line in data[:end].splitlines():
+            self.last = json.loads(line.decode('utf-8'))[0]
+
+        # entries spooled but not known to be delivered everywhere, see unfinished()
+        self.unfinished_last = self.last
+        self.in_flight = set(range(self.head + 1, self.last + 1))
+
+        self.segment = open(file_name, 'a', encoding='utf-8')
+        logger.info('spool at {0:d}, delivered up to {1:d}, {2:d} subscribers behind'
+                    .format(self.last, self.head, len(self.lagging)))
+
+    def roll(self):
+        # called with the lock held, or before the spool is used
+        if self.segment is not None:
+            self.segment.flush()
+            os.fsync(self.segment.fileno())
+            self.segment.close()
+
+        self.segments.append(self.last + 1)
+        self.segment = open(self.segment_file_name(self.last + 1), 'a', encoding='utf-8')
+        self.retain()
+
+    def retain(self):
+        # drop old segments, never the one being appended to
+        sizes = [os.path.getsize(self.segment_file_name(first)) for first in self.segments]
+        total = sum(sizes)
+        deadline = time.time() - self.max_age
+
+        while len(self.segments) > 1:
+            file_name = self.segment_file_name(self.segments[0])
+            if total <= self.max_size and os.path.getmtime(file_name) >= deadline:
+                break
+
+            dropped = self.segments.pop(0)
+            total -= sizes.pop(0)
+            os.remove(file_name)
+
+            if self.lagging and min(self.lagging.values()) < self.segments[0] - 1:
+                logger.warning('dropped spool entries from {0:d} on, some subscribers never got them'
+                               .format(dropped))
+
+    def append(self, channel, audience, text):
+        """
+        Write a delivery to the spool, returns its sequence number. The delivery
+        has to be reported done() once sent.
+        """
+        with self.lock:
+            self.last += 1
+            self.segment.write(json.dumps([self.last, time.time(), channel, audience, text]) + '\n')
+            self.segment.flush()
+            self.dirty = True
+            self.in_flight.add(self.last)
+
+            if self.segment.tell() >= self.segment_size:
+                self.roll()
+
+            return self.last
+
+    def done(self, seq):
+        with self.lock:
+            self.in_flight.discard(seq)
+            head = min(self.in_flight) - 1 if self.in_flight else self.last
+            if head != self.head:
+                self.head = head
+                self.cursors_changed = True
+
+    def unfinished(self):
+        """
+        Yield the entries the bot was delivering when it stopped. They have to be
+        delivered again and reported done().
+        """
+        for entry in self.read(self.head):
+            if entry[0] > self.unfinished_last:
+                return
+            yield entry
+
+    def cursors(self):
+        with self.lock:
+            return dict(self.lagging)
+
+    def skipped(self):
+        # the subscribers the live delivery leaves to the replay
+        return self.lagging
+
+    def fell_behind(self, chat_id, seq):
+        # chat_id did not get entry seq, it will be replayed from there
+        with self.lock:
+            if chat_id not in self.lagging:
+                self.lagging[chat_id] = seq - 1
+                self.cursors_changed = True
+
+    def advance(self, chat_id, seq):
+        with self.lock:
+            if chat_id in self.lagging:
+                self.lagging[chat_id] = seq
+                self.cursors_changed = True
+
+    def caught_up(self, chat_id):
+        """
+        Back to live delivery for chat_id, unless entries came in after its cursor.
+        """
+        with self.lock:
+            if self.lagging.get(chat_id) == self.last:
+                del self.lagging[chat_id]
+                self.cursors_changed = True
+                return True
+            return False
+
+    def read(self, after):
+        """
+        Yield (seq, timestamp, channel, audience, text) of every entry after `after`.
+        """
+        with self.lock:
+            segments = list(self.segments)
+            last = self.last
+
+        # the segment holding after + 1, or the oldest one left
+        start = max(bisect.bisect_right(segments, after + 1) - 1, 0)
+
+        for first in segments[start:]:
+            try:
+                with open(self.segment_file_name(first), 'r', encoding='utf-8') as file:
+                    for line in file:
+                        if not line.endswith('\n'):
+                            return
+                        entry = json.loads(line)
+                        if entry[0] > last:
+                            return
+                        if entry[0] > after:
+                            yield entry
+            except FileNotFoundError:
+                # dropped by the retention meanwhile
+                continue
+
+    def sync(self):
+        with self.lock:
+            if self.dirty:
+                os.fsync(self.segment.fileno())
+                self.dirty = False
+
+            if not self.cursors_changed:
+                return
+
+            cursors = {'head': self.head, 'lagging': {str(chat_id): seq for chat_id, seq in self.lagging.items()}}
+            self.cursors_changed = False
+
+        temp_file_name = self.cursor_file_name + '.tmp'
+        with open(temp_file_name, 'w') as file:
+            json.dump(cursors, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file_name, self.cursor_file_name)
+
+    def sync_forever(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync()
+            except EnvironmentError as e:
+                logger.error('syncing the spool failed: {0:s}'.format(repr(e)))
+
+    def stats(self):
+        with self.lock:
+            return {'last': self.last,
+                    'head': self.head,
+                    'segments': len(self.segments),
+                    'lagging': len(self.lagging)}
@@ -0,0 +1,149 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+defaultBotUserSettings = {'enabled': True, 'notifications': True}
+
+# who receives what:
+#   msg           every enabled user
+#   notification  enabled users with notifications
+#   quiet         enabled users without notifications
+audiences = ['msg', 'notification', 'quiet']
+
+
+class SubscriberRegistry:
+    """
+    The telegram users and their settings, backed by a user store. Besides the
+    settings it keeps, per channel and audience, the set of integer chat ids
+    receiving it. The sets are updated on every settings change, so a fan-out only
+    walks the users it actually sends to, without looking at settings or converting
+    ids.
+
+    A user's 'channels' setting lists the channels subscribed to. Users saved before
+    there was such a setting, and new users, get the default channels.
+    """
+
+    def __init__(self, store, on_load_error=None):
+        self.store = store
+        self.on_load_error = on_load_error
+        self.default_channels = []
+
+        self.users = None
+        self.lock = threading.RLock()
+
+        self.chat_ids = {}  # (channel, audience) -> set of chat ids
+        self.indexed = {}  # chat id -> keys of self.chat_ids it is in
+        # tuples handed out to the fan-out, rebuilt on the first fan-out after a change
+        self.recipient_cache = {}
+
+    def loaded(self):
+        # the users are read on first use, not while starting up
+        if self.users is None:
+            with self.lock:
+                if self.users is None:
+                    self.load()
+        return self.users
+
+    def load(self):
+        logger.debug('reading telegram user settings from: {0:s}'.format(type(self.store).__name__))
+        try:
+            users = self.store.load()
+            logger.debug('read {0:d} users'.format(len(users)))
+        except (EnvironmentError, ValueError):
+            logger.debug('error reading telegram user settings')
+            users = {}
+            if self.on_load_error:
+                self.on_load_error('Unable to read the user settings ({0:s})'.format(type(self.store).__name__))
+
+        for id, settings in users.items():
+            settings.setdefault('channels', list(self.default_channels))
+            self.index(id, settings)
+        self.users = users
+
+    def index(self, id, settings):
+        chat_id = int(id)
+
+        for key in self.indexed.pop(chat_id, []):
+            self.chat_ids[key].discard(chat_id)
+
+        if settings['enabled']:
+            keys = []
+            for channel in settings['channels']:
+                keys.append((channel, 'msg'))
+                keys.append((channel, 'notification' if settings['notifications'] else 'quiet'))
+
+            for key in keys:
+                self.chat_ids.setdefault(key, set()).add(chat_id)
+            self.indexed[chat_id] = keys
+
+        self.recipient_cache.clear()
+
+    def __contains__(self, id):
+        return id in self.loaded()
+
+    def __getitem__(self, id):
+        return self.loaded()[id]
+
+    def __len__(self):
+        return len(self.loaded())
+
+    def add(self, id):
+        with self.lock:
+            if id in self.loaded():
+                return False
+
+            logger.info('New bot user, id: {0:s}'.format(id))
+            self.users[id] = dict(defaultBotUserSettings, channels=list(self.default_channels))
+            self.index(id, self.users[id])
+            self.store.put(id, self.users[id])
+            return True
+
+    def update(self, id, **changes):
+        with self.lock:
+            settings = self.loaded()[id]
+            settings.update(changes)
+            self.index(id, settings)
+
+            logger.debug('writing telegram user settings of {0:s}: {1:s}'.format(id, str(settings)))
+            self.store.put(id, settings)
+
+    def migrate(self, id, new_id):
+        # the settings are copied to the new id, the old one is disabled
+        with self.lock:
+            if id not in self.loaded():
+                return False
+
+            if new_id not in self.users:
+                settings = self.users[new_id] = dict(self.users[id], channels=list(self.users[id]['channels']))
+                self.index(new_id, settings)
+                self.store.put(new_id, settings)
+
+            self.update(id, enabled=False, migrated_to=new_id)
+            return True
+
+    def subscribe(self, id, channel):
+        with self.lock:
+            channels = self.loaded()[id]['channels']
+            if channel in channels:
+                return False
+            self.update(id, channels=channels + [channel])
+            return True
+
+    def unsubscribe(self, id, channel):
+        with self.lock:
+            channels = self.loaded()[id]['channels']
+            if channel not in channels:
+                return False
+            self.update(id, channels=[c for c in channels if c != channel])
+            return True
+
+    def recipients(self, channel, audience):
+        key = (channel, audience)
+        try:
+            return self.recipient_cache[key]
+        except KeyError:
+            with self.lock:
+                self.loaded()
+                recipients = self.recipient_cache[key] = tuple(self.chat_ids.get(key, ()))
+                return recipients
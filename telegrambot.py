@@ -2,130 +2,313 @@
 #            -
 # Created: 13 March 2017
 
+import time
+import queue
 import logging
-import json
 
 import telepot
+import telepot.ratelimit
 
-logger = logging.getLogger(__name__)
+import userstore
+from backlog import Backlog
+from coalesce import Coalescer
+from fanout import FanOut
+from subscribers import SubscriberRegistry
 
-defaultBotUserSettings = {'enabled': True, 'notifications': True}
+logger = logging.getLogger(__name__)
 
 
 class TelegramBot:
-    def __init__(self, token, irc):
+    def __init__(self, token, config):
         self.telegram = telepot.Bot(token)
 
+        # stay within telegram's flood limits, sends over the limit are delayed instead of lost
+        self.limiter = telepot.ratelimit.RateLimiter(**self.rate_limits(config))
+        self.fanout = FanOut(self.limiter.augment_send(self.telegram.send_prepared),
+                             config.getint('Relay', 'fanout_workers', fallback=10),
+                             on_dead=self.prune, on_migrated=self.migrate, **self.failure_options(config))
+
+        self.init_relay(config)
+
+    @staticmethod
+    def rate_limits(config):
+        return {'rate': config.getfloat('Relay', 'rate', fallback=30),
+                'per_chat_rate': config.getfloat('Relay', 'per_chat_rate', fallback=1)}
+
+    @staticmethod
+    def failure_options(config):
+        return {'retries': config.getint('Relay', 'send_retries', fallback=3),
+                'max_failures': config.getint('Relay', 'max_failures', fallback=5)}
+
+    def init_relay(self, config):
+        # relayed channels: channel key -> (irc bot of the network, channel name)
+        self.channels = {}
+
+        self.user_store = userstore.create(config.get('Telegram', 'user_store', fallback='journal'),
+                                           config.get('Telegram', 'user_file', fallback=None))
+        self.users = SubscriberRegistry(self.user_store, on_load_error=self.notify_owner)
+
+        # recent lines of every channel, for users who missed them
+        self.backlog = Backlog(config.getint('Relay', 'backlog_size', fallback=1000),
+                               config.get('Relay', 'backlog_file', fallback='') or None)
+        self.backlog_replay = config.getint('Relay', 'backlog_replay', fallback=100)
+
+        # commands of different users are handled in parallel, those of one user in order
+        self.command_workers = config.getint('Relay', 'command_workers', fallback=4)
+
+        # updates are posted to a webhook if it is configured, polled otherwise
+        self.webhook_options = self.read_webhook_options(config)
+        self.webhook = None
+
+    @staticmethod
+    def read_webhook_options(config):
+        if not config.get('Telegram', 'webhook_url', fallback=''):
+            return None
+
+        # aiohttp is only needed with a webhook
+        import webhook
+        return webhook.webhook_options(config)
+
+    def start(self):
         logger.debug('starting telegram msg loop.')
-        self.telegram.message_loop(self.telegram_handle)
 
-        self.users = {}
+        if self.webhook_options is None:
+            # a webhook left over from an earlier run keeps getUpdates from working
+            self.delete_webhook()
+            self.telegram.message_loop(self.telegram_handle, workers=self.command_workers)
+            return
 
-        self.irc = irc
+        import webhook
+        self.webhook = webhook.WebhookServer(queue.Queue(), **self.webhook_options)
+        self.webhook.start_thread()
+        self.set_webhook()
+        self.telegram.message_loop(self.telegram_handle, source=self.webhook.updates, workers=self.command_workers)
 
-        self.user_settings_file_name = 'telegram_bot_users.save'
-        self.read_settings()
+    def stop(self):
+        if self.webhook is not None:
+            self.delete_webhook()
+
+    def set_webhook(self):
+        registration = self.webhook.registration()
+        try:
+            self.telegram.setWebhook(**registration)
+        finally:
+            if registration['certificate'] is not None:
+                registration['certificate'].close()
+        logger.info('webhook set to {0:s}'.format(self.webhook.url))
+
+    def delete_webhook(self):
+        try:
+            self.telegram.deleteWebhook()
+        except Exception as e:
+            logger.error('deleting the webhook failed: {0:s}'.format(repr(e)))
+
+    def add_channel(self, key, irc, channel):
+        self.channels[key] = (irc, channel)
+
+        # users who never picked channels get the first one, as before there were several
+        if not self.users.default_channels:
+            self.users.default_channels.append(key)
+
+    def find_channel(self, name):
+        # a channel key, or a channel name as long as only one network has it
+        if name in self.channels:
+            return name
+
+        matches = [key for key, (irc, channel) in self.channels.items() if channel.lower() == name.lower()]
+        return matches[0] if len(matches) == 1 else None
+
+    def channel_name(self, key):
+        irc, channel = self.channels[key]
+        return channel if self.find_channel(channel) == key else key
+
+    def channel_header(self, key):
+        # with only one channel there is nothing to tell apart
+        return self.channel_name(key) if len(self.channels) > 1 else None
 
     def telegram_handle(self, msg):
         content_type, chat_type, chat_id = telepot.glance(msg)
 
         if content_type == 'text':
-            self.do_command(str(chat_id), msg['text'])
+            # replies may take several messages, they keep to the flood limits like the relayed lines
+            for reply in self.replies(str(chat_id), msg['text']):
+                self.limiter.send(self.telegram.sendMessage, chat_id, reply)
+
+    def prune(self, chat_id, error):
+        # the chat is gone or blocked the bot, stop relaying to it until it sends /start again
+        id = str(chat_id)
+        if id in self.users:
+            logger.info('disabling telegram user {0:s}: {1:s}'.format(id, repr(error)))
+            self.users.update(id, enabled=False, disabled_at=time.time())
+
+    def migrate(self, chat_id, new_chat_id):
+        # a group became a supergroup, its settings go on under the new chat id
+        if self.users.migrate(str(chat_id), str(new_chat_id)):
+            logger.info('telegram user {0:d} is now {1:d}'.format(chat_id, new_chat_id))
+
+    def send_msg(self, channel, nick, msg):
+        return self.deliver(channel, 'msg', self.format_msg(nick, msg))
+
+    def send_notification(self, channel, msg):
+        return self.deliver(channel, 'notification', self.format_notification(msg))
 
-    def send_msg(self, nick, msg):
-        for user, user_settings in self.users.items():
-            if user_settings['enabled']:
-                logger.debug('send_msg user: {0:s} - {1:s}'.format(user, nick + ': ' + msg))
-                self.telegram.sendMessage(int(user), '<{0:s}> {1:s}'.format(nick, msg))
+    def deliver(self, channel, audience, text, skip=None):
+        logger.debug('deliver to {0:s} of {1:s}: {2:s}'.format(audience, channel, text))
+        chat_ids = self.users.recipients(channel, audience)
+        if skip:
+            chat_ids = [chat_id for chat_id in chat_ids if chat_id not in skip]
+        return self.send_to(chat_ids, text)
 
-    def send_notification(self, msg):
-        for user, user_settings in self.users.items():
-            if user_settings['enabled'] and user_settings['notifications']:
-                logger.debug('send_notification user: {0:s} - {1:s}'.format(user, msg))
-                self.telegram.sendMessage(int(user), '* {0:s}'.format(msg))
+    def send_to(self, chat_ids, text):
+        # encoded once, every recipient only adds its chat id
+        return self.fanout.broadcast(chat_ids, self.telegram.prepare_message(text))
+
+    def replies(self, id, text):
+        """
+        The messages answering a command: the reply of do_command, followed by the
+        lines missed while disabled on /start. /backlog and /users, whose answers may
+        take several messages, are answered here entirely.
+        """
+        self.users.add(id)
+
+        cmd, _, arg = text.partition(' ')
+        arg = arg.strip()
+        if cmd == '/backlog':
+            return self.backlog_command(id, arg.split()) or ['Nothing to catch up on.']
+        elif cmd == '/users':
+            return self.users_command(id, arg) or ['I don\'t have this information currently :(']
+
+        settings = self.users[id]
+        since = settings.get('disabled_at') if cmd == '/start' and not settings['enabled'] else None
+
+        replies = [self.do_command(id, text)]
+        if since is not None and self.backlog_replay > 0:
+            replies += self.missed(id, since=since, last=self.backlog_replay)
+        return replies
+
+    def users_command(self, id, arg):
+        # /users [#channel], the reply is kept by the irc bot until someone joins, leaves or changes
+        key = self.find_channel(arg) if arg else next(iter(self.users[id]['channels']), None)
+        if key not in self.channels:
+            return []
+
+        irc, channel = self.channels[key]
+        return irc.get_users(channel)
+
+    def backlog_command(self, id, args):
+        # /backlog [n] [#channel], 0 lines are nothing to catch up on
+        last = 20
+        channels = None
+        for arg in args:
+            if arg.isdigit():
+                last = min(int(arg), self.backlog.size)
+            else:
+                key = self.find_channel(arg)
+                if key is None:
+                    return ['I don\'t relay the channel \'{0:s}\', see /channels'.format(arg)]
+                channels = [key]
+        return self.missed(id, last=last, channels=channels)
+
+    def missed(self, id, since=None, last=None, channels=None):
+        """
+        The backlog of a user's channels (or of `channels`) from `since` on, at most the
+        `last` lines per channel, coalesced into as few messages as possible.
+        """
+        settings = self.users[id]
+
+        messages = []
+        for key in channels or settings['channels']:
+            if key not in self.channels:
+                continue
+
+            lines = [self.format_backlog_line(timestamp, kind, nick, text)
+                     for timestamp, kind, nick, text in self.backlog.lines(key, since=since)
+                     if kind == 'msg' or settings['notifications']]
+            if last is not None:
+                lines = lines[-last:] if last > 0 else []
+
+            if lines:
+                messages += Coalescer(header=self.channel_header(key)).chunk(lines)
+        return messages
+
+    def format_backlog_line(self, timestamp, kind, nick, text):
+        line = self.format_msg(nick, text) if kind == 'msg' else self.format_notification(text)
+        return '[{0:s}] {1:s}'.format(time.strftime('%H:%M', time.localtime(timestamp)), line)
+
+    @staticmethod
+    def format_msg(nick, msg):
+        return '<{0:s}> {1:s}'.format(nick, msg)
+
+    @staticmethod
+    def format_notification(msg):
+        return '* {0:s}'.format(msg)
 
     def do_command(self, id, cmd='no command'):
+        # returns the reply to send back
         logger.debug('user: {0:s} sent cmd: {1:s}'.format(id, cmd))
 
-        if id not in self.users:
-            logger.info('New bot user, id: {0:s}'.format(id))
-            self.users[id] = defaultBotUserSettings
-            self.write_settings()
+        self.users.add(id)
+
+        cmd, _, arg = cmd.partition(' ')
+        arg = arg.strip()
 
         if cmd == '/start':
-            msg = ''
+            subscribed = [self.channel_name(key) for key in self.users[id]['channels'] if key in self.channels]
 
-            if self.channel:
-                msg = 'the channel ' + self.channel
+            if subscribed:
+                msg = 'the channel ' + ', '.join(subscribed)
             else:
                 msg = 'the irc'
 
-            self.telegram.sendMessage(id, 'You will now receive messages from ' + msg + '.')
-            self.users[id]['enabled'] = True
-            self.write_settings()
+            self.users.update(id, enabled=True)
+            return 'You will now receive messages from ' + msg + '.'
         elif cmd == '/stop':
-            self.telegram.sendMessage(id, 'You will no longer receive any messages from the irc!')
-            self.users[id]['enabled'] = False
-            self.write_settings()
+            self.users.update(id, enabled=False, disabled_at=time.time())
+            return 'You will no longer receive any messages from the irc!'
         elif cmd == '/notifications':
             if self.users[id]['notifications']:
-                self.telegram.sendMessage(id, 'Notifications disabled!')
-                self.users[id]['notifications'] = False
+                self.users.update(id, notifications=False)
+                return 'Notifications disabled!'
             else:
-                self.telegram.sendMessage(id, 'Notifications enabled!')
-                self.users[id]['notifications'] = True
-
-            self.write_settings()
-        elif cmd == '/channel':
-            if self.irc.channel and self.irc.server:
-                self.telegram.sendMessage(id,
-                                          'You are getting messages from {0:s} on {1:s}'
-                                          .format(self.irc.channel, self.irc.server.replace('#', '')))
+                self.users.update(id, notifications=True)
+                return 'Notifications enabled!'
+        elif cmd == '/subscribe' or cmd == '/unsubscribe':
+            key = self.find_channel(arg)
+            if key is None:
+                return 'I don\'t relay the channel \'{0:s}\', see /channels'.format(arg)
+            elif cmd == '/subscribe':
+                self.users.subscribe(id, key)
+                return 'You will now receive messages from {0:s}.'.format(self.channel_name(key))
             else:
-                self.telegram.sendMessage(id, 'I don\'t have this information currently :(')
-        elif cmd == '/users':
-            irc_users = self.irc.get_users()
-            if len(irc_users) > 0:
-                users = irc_users['users']
-                opers = irc_users['opers']
-                voiced = irc_users['voiced']
-
-                opers_s = ('Operators:\n' + ', '.join(opers) + '\n') if opers else ''
-                voiced_s = ('Moderators:\n' + ', '.join(voiced) + '\n') if voiced else ''
-                users_s = 'Users:\n' + ', '.join(users) + '\n'
-
-                self.telegram.sendMessage(id, opers_s + voiced_s + users_s)
+                self.users.unsubscribe(id, key)
+                return 'You will no longer receive messages from {0:s}.'.format(self.channel_name(key))
+        elif cmd == '/channels':
+            subscribed = self.users[id]['channels']
+            return ('Channels (* subscribed):\n' +
+                    '\n'.join(('* ' if key in subscribed else '  ') + self.channel_name(key)
+                              for key in self.channels))
+        elif cmd == '/channel':
+            subscribed = [key for key in self.users[id]['channels'] if key in self.channels]
+            if subscribed:
+                return '\n'.join('You are getting messages from {0:s} on {1:s}'
+                                 .format(self.channels[key][1], self.channels[key][0].server)
+                                 for key in subscribed)
             else:
-                self.telegram.sendMessage(id, 'I don\'t have this information currently :(')
+                return 'I don\'t have this information currently :('
         elif cmd == '/help' or cmd == '/commands':
-            self.telegram.sendMessage(id,
-                                      '/start - enable the bot to relay messages from the irc channel\n'
-                                      '/stop - stop the bot from sending you any messages\n'
-                                      '(all irc conversation while disabled will be lost)\n'
-                                      '/notifications - enable/disable irc notifications\n'
-                                      '/channel - display basic irc channel information\n'
-                                      '/users - lists all the irc users in the channel\n'
-                                      '/help or /commands - prints this message\n'
-                                      )
+            return ('/start - enable the bot to relay messages from the irc channel\n'
+                    '/stop - stop the bot from sending you any messages\n'
+                    '(/start sends you up to {0:d} lines you missed meanwhile)\n'
+                    '/notifications - enable/disable irc notifications\n'
+                    '/channels - lists all the channels relayed by the bot\n'
+                    '/subscribe #channel - receive messages from another channel\n'
+                    '/unsubscribe #channel - stop receiving messages from a channel\n'
+                    '/channel - display basic irc channel information\n'
+                    '/users [#channel] - lists all the irc users in the channel\n'
+                    '/backlog [n] [#channel] - the last n lines of your channels\n'
+                    '/help or /commands - prints this message\n'.format(self.backlog_replay))
         else:
-            self.telegram.sendMessage(id, 'Unknown command - you might want to take a look at /help')
-
-    def write_settings(self):
-        logger.debug('writing telegram user settings to file: {0:s}'.format(self.user_settings_file_name))
-        logger.debug('users:' + json.dumps(self.users))
-
-        with open(self.user_settings_file_name, 'w') as file:
-            json.dump(self.users, file)
-
-    def read_settings(self):
-        logger.debug('reading telegram user settings to file: {0:s}'.format(self.user_settings_file_name))
-        try:
-            with open(self.user_settings_file_name, 'r') as file:
-                self.users = json.load(file)
-                logger.debug('read:' + str(self.users))
-        except EnvironmentError:
-            logger.debug('error reading telegram user settings file: {0:s}'.format(self.user_settings_file_name))
-            self.notify_owner('Unable to open the user settings file ({0:s})'.format(self.user_settings_file_name))
+            return 'Unknown command - you might want to take a look at /help'
 
     def notify_owner(self, msg):
         logger.debug('notify the bot owner about: {0:s}'.format(msg))
@@ -8,7 +8,7 @@ import re
 def _not_async(filepath):
     return filepath.find('aio/') < 0
 
-# Do not copy async module for Python 3.3 or below.
+# Do not copy async module for Python 3.6 or below.
 class nocopy_async(build_py):
     def find_all_modules(self):
         modules = build_py.find_all_modules(self)
@@ -20,23 +20,23 @@ class nocopy_async(build_py):
         modules = list(filter(lambda m: _not_async(m[-1]), modules))
         return modules
 
-# Do not compile async.py for Python 3.3 or below.
+# Do not compile async.py for Python 3.6 or below.
 class nocompile_async(install_lib):
     def byte_compile(self, files):
         files = list(filter(_not_async, files))
         install_lib.byte_compile(self, files)
 
 
-PY_35 = sys.version_info >= (3,5)
+PY_37 = sys.version_info >= (3,7)
 
 here = path.abspath(path.dirname(__file__))
 
 install_requires = ['urllib3>=1.9.1']
 cmdclass = {}
 
-if PY_35:
-    # one more dependency for Python 3.5 (async version)
-    install_requires += ['aiohttp==1.3']
+if PY_37:
+    # one more dependency for Python 3.7 (async version)
+    install_requires += ['aiohttp>=3.8,<4']
 else:
     # do not copy/compile async version for older Python
     cmdclass['build_py'] = nocopy_async
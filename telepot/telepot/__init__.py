@@ -5,7 +5,14 @@ import json
 import threading
 import traceback
 import collections
-import bisect
+import itertools
+import heapq
+import random
+
+try:
+    from collections.abc import Hashable as _Hashable
+except ImportError:
+    from collections import Hashable as _Hashable
 
 try:
     import Queue as queue
@@ -258,21 +265,237 @@ def _rectify(params):
 
 from . import api
 
+def _shard_key(msg, shard_by='chat'):
+    """
+    :return:
+        the chat id (or the sender's id if ``shard_by`` is ``'from'``) a message or
+        event belongs to, ``None`` if it has none
+    """
+    if shard_by == 'from' and 'from' in msg:
+        return msg['from']['id']
+    if 'chat' in msg:
+        return msg['chat']['id']
+    if 'message' in msg and 'chat' in msg['message']:  # callback query
+        return msg['message']['chat']['id']
+    if 'from' in msg:
+        return msg['from']['id']
+
+    # An event, it belongs to the chat or user the delegate producing it serves
+    for v in msg.values():
+        if isinstance(v, dict) and 'source' in v:
+            return v['source']['id']
+    return None
+
+class _PollPolicy(object):
+    """
+    Decides how long ``message_loop`` waits before the next ``getUpdates``: not at
+    all after updates came in, since more are likely to follow, ``relax`` seconds
+    after an empty result, and an exponentially growing, jittered delay after
+    consecutive errors. Also keeps statistics of the polls.
+    """
+    def __init__(self, relax=0.1, backoff=1.0, max_backoff=60.0):
+        self._relax = relax
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._errors = 0  # consecutive
+        self._lock = threading.Lock()
+        self._stats = {'polls': 0, 'updates': 0, 'errors': 0,
+                       'last_rtt': 0.0, 'max_rtt': 0.0, 'total_rtt': 0.0}
+
+    def succeeded(self, n, rtt):
+        """ :return: seconds to wait after a poll returning ``n`` updates in ``rtt`` seconds """
+        self._errors = 0
+        with self._lock:
+            self._stats['polls'] += 1
+            self._stats['updates'] += n
+            self._stats['last_rtt'] = rtt
+            self._stats['max_rtt'] = max(self._stats['max_rtt'], rtt)
+            self._stats['total_rtt'] += rtt
+        return 0 if n > 0 else self._relax
+
+    def failed(self, e):
+        """ :return: seconds to wait after a failed poll """
+        with self._lock:
+            self._stats['errors'] += 1
+
+        retry_after = getattr(e, 'retry_after', None)
+        if retry_after:
+            return retry_after
+
+        delay = min(self._backoff * 2 ** self._errors, self._max_backoff)
+        self._errors += 1
+        # Many bots coming back after an outage should not all poll at the same moment
+        return random.uniform(delay / 2, delay)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        s['avg_rtt'] = s['total_rtt'] / s['polls'] if s['polls'] else 0.0
+        s['consecutive_errors'] = self._errors
+        return s
+
+class _DelegateRegistry(object):
+    """
+    The delegates of a :class:`DelegatorBot` by seed, least recently used first.
+
+    Finished delegates are reaped when their seed comes up again, and all at once
+    by a sweep whenever the registry has doubled in size, or is full, and at least
+    half as many delegates as it holds were added since the last sweep. That keeps
+    the sweeps' cost proportional to the number of delegates added. With ``maxsize``,
+    the least recently used delegates are forgotten beyond that many. A forgotten
+    delegate that is still alive keeps running, but the next message with its seed
+    gets a new delegate.
+    """
+    def __init__(self, is_alive, maxsize=None):
+        self._is_alive = is_alive
+        self._maxsize = maxsize
+        self._delegates = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._sweep_at = 64
+        self._added = 0  # since the last sweep
+        self._reaped = 0
+        self._evicted = 0
+
+    def __len__(self):
+        return len(self._delegates)
+
+    def setdefault(self, key, create):
+        """
+        :return:
+            ``(delegate, created)``, the live delegate of ``key``, or a new one made by
+            calling ``create()``. The new delegate must be started by ``create()``,
+            one not yet alive would be reaped as finished.
+        """
+        with self._lock:
+            d = self._delegates.pop(key, None)
+            if d is not None:
+                if self._is_alive(d):
+                    self._delegates[key] = d  # now the most recently used
+                    return d, False
+                self._reaped += 1
+
+            d = self._delegates[key] = create()
+            self._added += 1
+            self._shrink()
+            return d, True
+
+    def discard(self, key, delegate):
+        """ Forget ``delegate`` right away, e.g. once its task is done """
+        with self._lock:
+            if self._delegates.get(key) is delegate:
+                del self._delegates[key]
+                self._reaped += 1
+
+    def _shrink(self):
+        n = len(self._delegates)
+        full = self._maxsize is not None and n > self._maxsize
+        if n >= self._sweep_at or (full and self._added >= n // 2):
+            dead = [k for k, d in self._delegates.items() if not self._is_alive(d)]
+            for k in dead:
+                del self._delegates[k]
+            self._reaped += len(dead)
+            self._sweep_at = max(64, 2 * len(self._delegates))
+            self._added = 0
+
+        if self._maxsize is not None:
+            while len(self._delegates) > self._maxsize:
+                k, d = self._delegates.popitem(last=False)
+                if self._is_alive(d):
+                    self._evicted += 1
+                else:
+                    self._reaped += 1
+
+    def stats(self):
+        """
+        :return:
+            a dictionary of the numbers of delegates alive and finished but not yet
+            reaped, and of how many were reaped and evicted (forgotten while alive)
+        """
+        with self._lock:
+            live = sum(1 for d in self._delegates.values() if self._is_alive(d))
+            return {'live': live,
+                    'dead': len(self._delegates) - live,
+                    'reaped': self._reaped,
+                    'evicted': self._evicted}
+
 class Bot(_BotBase):
+    class Collector(object):
+        """
+        Applies a callback to messages on a number of worker threads. Messages of one
+        chat (or one sender) always go to the same worker, so they are handled in
+        order, while a slow handler only holds up the chats sharing its worker.
+        """
+        def __init__(self, callback, workers=1, shard_by='chat'):
+            self._callback = callback
+            self._shard_by = shard_by
+            self._queues = [queue.Queue() for i in range(workers)]
+            self._lock = threading.Lock()
+            self._stats = [{'handled': 0, 'handler_time': 0.0, 'max_handler_time': 0.0, 'max_depth': 0}
+                           for i in range(workers)]
+
+        def put(self, msg):
+            n = len(self._queues)
+            if n == 1:
+                i = 0
+            else:
+                key = _shard_key(msg, self._shard_by)
+                i = (key if isinstance(key, int) else hash(key)) % n
+
+            qu = self._queues[i]
+            qu.put(msg)
+
+            depth = qu.qsize()
+            if depth > self._stats[i]['max_depth']:
+                with self._lock:
+                    self._stats[i]['max_depth'] = max(self._stats[i]['max_depth'], depth)
+
+        def start(self):
+            for i in range(len(self._queues)):
+                t = threading.Thread(target=self._work, args=(i,), name='collector-%d' % i)
+                t.daemon = True
+                t.start()
+
+        def _work(self, i):
+            qu, stats = self._queues[i], self._stats[i]
+            while 1:
+                item = qu.get(block=True)
+                start = time.time()
+                try:
+                    self._callback(item)
+                except:
+                    # Localize error so thread can keep going.
+                    traceback.print_exc()
+                finally:
+                    elapsed = time.time() - start
+                    with self._lock:
+                        stats['handled'] += 1
+                        stats['handler_time'] += elapsed
+                        stats['max_handler_time'] = max(stats['max_handler_time'], elapsed)
+
+        def stats(self):
+            """
+            :return:
+                a list with a dictionary per worker: its queue depth (now and at most),
+                the number of messages handled, their average and maximum handler latency
+            """
+            with self._lock:
+                return [dict(s, depth=qu.qsize(),
+                             avg_handler_time=s['handler_time'] / s['handled'] if s['handled'] else 0.0)
+                        for qu, s in zip(self._queues, self._stats)]
+
     class Scheduler(threading.Thread):
-        # A class that is sorted by timestamp. Use `bisect` module to ensure order in event queue.
+        # Events are kept in a heap ordered by timestamp. A cancelled event stays in the
+        # heap until it comes to the top or the heap is compacted.
         Event = collections.namedtuple('Event', ['timestamp', 'data'])
-        Event.__eq__ = lambda self, other: self.timestamp == other.timestamp
-        Event.__ne__ = lambda self, other: self.timestamp != other.timestamp
-        Event.__gt__ = lambda self, other: self.timestamp > other.timestamp
-        Event.__ge__ = lambda self, other: self.timestamp >= other.timestamp
-        Event.__lt__ = lambda self, other: self.timestamp < other.timestamp
-        Event.__le__ = lambda self, other: self.timestamp <= other.timestamp
 
         def __init__(self):
             super(Bot.Scheduler, self).__init__()
-            self._eventq = []
+            self._eventq = []  # heap of (timestamp, sequence, event)
+            self._pending = {}  # id(event) -> event, for events not yet emitted or cancelled
+            self._cancelled = 0  # cancelled events still in heap
+            self._sequence = itertools.count()  # keeps events with identical timestamp in order
             self._lock = threading.RLock()  # reentrant lock to allow locked method calling locked method
+            self._wakeup = threading.Condition(self._lock)
             self._output_queue = None
 
         def _locked(fn):
@@ -284,40 +507,53 @@ class Bot(_BotBase):
         @_locked
         def _insert_event(self, data, when):
             ev = self.Event(when, data)
-            bisect.insort(self._eventq, ev)
+            heapq.heappush(self._eventq, (when, next(self._sequence), ev))
+            self._pending[id(ev)] = ev
+
+            # The thread may be sleeping until a later event
+            if self._eventq[0][2] is ev:
+                self._wakeup.notify()
             return ev
 
         @_locked
         def _remove_event(self, event):
-            # Find event according to its timestamp.
-            # Index returned should be one behind.
-            i = bisect.bisect(self._eventq, event)
+            if self._pending.get(id(event)) is not event:
+                raise exception.EventNotFound(event)
 
-            # Having two events with identical timestamp is unlikely but possible.
-            # I am going to move forward and compare timestamp AND object address
-            # to make sure the correct object is found.
+            del self._pending[id(event)]
+            self._cancelled += 1
 
-            while i > 0:
-                i -= 1
-                e = self._eventq[i]
-
-                if e.timestamp != event.timestamp:
-                    raise exception.EventNotFound(event)
-                elif id(e) == id(event):
-                    self._eventq.pop(i)
-                    return
-
-            raise exception.EventNotFound(event)
+            # Don't let cancelled events pile up, e.g. idle timers refreshed on every message
+            if self._cancelled > 1000 and self._cancelled > len(self._pending):
+                self._eventq = [entry for entry in self._eventq if self._pending.get(id(entry[2])) is entry[2]]
+                heapq.heapify(self._eventq)
+                self._cancelled = 0
 
         @_locked
         def _pop_expired_event(self):
-            if not self._eventq:
-                return None
+            while self._eventq:
+                timestamp, _, ev = self._eventq[0]
 
-            if self._eventq[0].timestamp <= time.time():
-                return self._eventq.pop(0)
-            else:
-                return None
+                if self._pending.get(id(ev)) is not ev:
+                    heapq.heappop(self._eventq)
+                    self._cancelled -= 1
+                elif timestamp <= time.time():
+                    heapq.heappop(self._eventq)
+                    del self._pending[id(ev)]
+                    return ev
+                else:
+                    return None
+
+            return None
+
+        @_locked
+        def _wait_for_event(self):
+            e = self._pop_expired_event()
+            while e is None:
+                # Sleep until the earliest event is due, or until an earlier one is inserted
+                self._wakeup.wait(self._eventq[0][0] - time.time() if self._eventq else None)
+                e = self._pop_expired_event()
+            return e
 
         def event_at(self, when, data):
             """
@@ -358,22 +594,20 @@ class Bot(_BotBase):
 
         def run(self):
             while 1:
-                e = self._pop_expired_event()
-                while e:
-                    if callable(e.data):
-                        d = e.data()
-                        if d is not None:
-                            self._output_queue.put(d)
-                    else:
-                        self._output_queue.put(e.data)
-
-                    e = self._pop_expired_event()
-                time.sleep(0.1)
+                e = self._wait_for_event()
+                if callable(e.data):
+                    d = e.data()
+                    if d is not None:
+                        self._output_queue.put(d)
+                else:
+                    self._output_queue.put(e.data)
 
     def __init__(self, token):
         super(Bot, self).__init__(token)
 
         self._scheduler = self.Scheduler()
+        self._collector = None
+        self._poll_policy = None
 
         self._router = helper.Router(flavor, {'chat': lambda msg: self.on_chat_message(msg),
                                               'callback_query': lambda msg: self.on_callback_query(msg),
@@ -390,6 +624,23 @@ class Bot(_BotBase):
     def router(self):
         return self._router
 
+    def collector_stats(self):
+        """
+        :return:
+            statistics of the threads :meth:`.message_loop` applies the callback on,
+            see :meth:`telepot.Bot.Collector.stats`, ``None`` before the loop is started
+        """
+        return self._collector.stats() if self._collector is not None else None
+
+    def poll_stats(self):
+        """
+        :return:
+            statistics of the ``getUpdates`` polls of :meth:`.message_loop`: polls,
+            updates and errors so far, consecutive errors, last, average and maximum
+            round-trip time. ``None`` unless the loop polls.
+        """
+        return self._poll_policy.stats() if self._poll_policy is not None else None
+
     def handle(self, msg):
         self._router.route(msg)
 
@@ -407,6 +658,20 @@ class Bot(_BotBase):
         p = _strip(locals())
         return self._api_request('sendMessage', _rectify(p))
 
+    def prepare_message(self, text,
+                        parse_mode=None, disable_web_page_preview=None,
+                        disable_notification=None, reply_to_message_id=None, reply_markup=None):
+        """
+        Render a message once to send it to many chats by :meth:`send_prepared`.
+        Parameters are those of :meth:`sendMessage`, without ``chat_id``.
+        """
+        p = _strip(locals())
+        return api.prepare((self._token, 'sendMessage', _rectify(p), None))
+
+    def send_prepared(self, chat_id, prepared):
+        """ Send a message from :meth:`prepare_message` to ``chat_id`` """
+        return api.request_prepared(prepared, chat_id)
+
     def forwardMessage(self, chat_id, from_chat_id, message_id, disable_notification=None):
         """ See: https://core.telegram.org/bots/api#forwardmessage """
         p = _strip(locals())
@@ -629,7 +894,8 @@ class Bot(_BotBase):
         p = _strip(locals())
         return self._api_request('getUpdates', _rectify(p))
 
-    def setWebhook(self, url=None, certificate=None, max_connections=None, allowed_updates=None):
+    def setWebhook(self, url=None, certificate=None, max_connections=None, allowed_updates=None,
+                   secret_token=None):
         """ See: https://core.telegram.org/bots/api#setwebhook """
         p = _strip(locals(), more=['certificate'])
 
@@ -695,6 +961,7 @@ class Bot(_BotBase):
     def message_loop(self, callback=None, relax=0.1,
                      timeout=20, allowed_updates=None,
                      source=None, ordered=True, maxhold=3,
+                     workers=1, shard_by='chat',
                      run_forever=False):
         """
         Spawn a thread to constantly ``getUpdates`` or pull updates from a queue.
@@ -728,7 +995,9 @@ class Bot(_BotBase):
         When ``source`` is ``None``, these parameters are meaningful:
 
         :type relax: float
-        :param relax: seconds between each ``getUpdates``
+        :param relax:
+            seconds to wait after a ``getUpdates`` returning nothing. After updates
+            the next one is made right away, after errors the wait grows exponentially.
 
         :type timeout: int
         :param timeout:
@@ -758,7 +1027,18 @@ class Bot(_BotBase):
             even if some smaller ``update_id``\s have not yet arrived. If those smaller
             ``update_id``\s arrive at some later time, they are discarded.
 
-        Finally, there is this parameter, meaningful always:
+        Finally, these parameters are meaningful always:
+
+        :type workers: int
+        :param workers:
+            number of threads applying ``callback``. Messages of one chat are always
+            handled by the same thread, in order; messages of different chats may be
+            handled in parallel.
+
+        :type shard_by: str
+        :param shard_by:
+            ``'chat'`` to keep the messages of a chat in order, ``'from'`` to keep the
+            messages of a sender in order. See :meth:`telepot.Bot.collector_stats`.
 
         :type run_forever: bool or str
         :param run_forever:
@@ -772,16 +1052,7 @@ class Bot(_BotBase):
         elif isinstance(callback, dict):
             callback = flavor_router(callback)
 
-        collect_queue = queue.Queue()
-
-        def collector():
-            while 1:
-                try:
-                    item = collect_queue.get(block=True)
-                    callback(item)
-                except:
-                    # Localize error so thread can keep going.
-                    traceback.print_exc()
+        collect_queue = self._collector = self.Collector(callback, workers, shard_by)
 
         def relay_to_collector(update):
             key = _find_first_key(update, ['message',
@@ -794,14 +1065,18 @@ class Bot(_BotBase):
             collect_queue.put(update[key])
             return update['update_id']
 
+        poll = self._poll_policy = _PollPolicy(relax) if source is None else None
+
         def get_from_telegram_server():
             offset = None  # running offset
             allowed_upd = allowed_updates
             while 1:
                 try:
+                    start = time.time()
                     result = self.getUpdates(offset=offset,
                                              timeout=timeout,
                                              allowed_updates=allowed_upd)
+                    wait = poll.succeeded(len(result), time.time() - start)
 
                     # Once passed, this parameter is no longer needed.
                     allowed_upd = None
@@ -811,16 +1086,13 @@ class Bot(_BotBase):
                         # Update offset to max(update_id) + 1
                         offset = max([relay_to_collector(update) for update in result]) + 1
 
-                except exception.BadHTTPResponse as e:
+                except Exception as e:
+                    # Servers probably down, or the network. Wait longer every time.
                     traceback.print_exc()
+                    wait = poll.failed(e)
 
-                    # Servers probably down. Wait longer.
-                    if e.status == 502:
-                        time.sleep(30)
-                except:
-                    traceback.print_exc()
-                finally:
-                    time.sleep(relax)
+                if wait:
+                    time.sleep(wait)
 
         def dictify3(data):
             if type(data) is bytes:
@@ -934,9 +1206,7 @@ class Bot(_BotBase):
                     # debug message
                     # print ('Buffer:', str(buffer), ', To Wait:', qwait, ', Max ID:', max_id)
 
-        collector_thread = threading.Thread(target=collector)
-        collector_thread.daemon = True
-        collector_thread.start()
+        collect_queue.start()
 
         if source is None:
             message_thread = threading.Thread(target=get_from_telegram_server)
@@ -981,12 +1251,32 @@ class SpeakerBot(Bot):
 
 
 class DelegatorBot(SpeakerBot):
-    def __init__(self, token, delegation_patterns):
+    def __init__(self, token, delegation_patterns, max_delegates=None, actor_pool=None):
         """
         :param delegation_patterns: a list of (seeder, delegator) tuples.
+
+        :param max_delegates:
+            the most delegates kept track of, the least recently used ones are
+            forgotten beyond that. ``None`` for no limit; finished delegates are
+            reaped either way.
+
+        :param actor_pool:
+            a :class:`.helper.ActorPool`. Delegates that are functions run on it once
+            instead of on a thread each, as does the :class:`.helper.Answerer`. Make
+            handlers actors with :func:`telepot.delegate.create_actor`.
         """
         super(DelegatorBot, self).__init__(token)
-        self._delegate_records = [p+({},) for p in delegation_patterns]
+        self._delegation_patterns = list(delegation_patterns)
+        self._delegates = _DelegateRegistry(lambda d: d.is_alive(), max_delegates)
+        self._actor_pool = actor_pool
+
+    @property
+    def actor_pool(self):
+        return self._actor_pool
+
+    def delegate_stats(self):
+        """ See :meth:`telepot._DelegateRegistry.stats` """
+        return self._delegates.stats()
 
     def _startable(self, delegate):
         return ((hasattr(delegate, 'start') and inspect.ismethod(delegate.start)) and
@@ -995,32 +1285,39 @@ class DelegatorBot(SpeakerBot):
     def _tuple_is_valid(self, t):
         return len(t) == 3 and callable(t[0]) and type(t[1]) in [list, tuple] and type(t[2]) is dict
 
+    def _runner(self, func, args=(), kwargs=None):
+        if self._actor_pool is not None:
+            return helper.Job(self._actor_pool, func, args, kwargs)
+        return threading.Thread(target=func, args=args, kwargs=kwargs or {})
+
     def _ensure_startable(self, delegate):
         if self._startable(delegate):
             return delegate
         elif callable(delegate):
-            return threading.Thread(target=delegate)
+            return self._runner(delegate)
         elif type(delegate) is tuple and self._tuple_is_valid(delegate):
             func, args, kwargs = delegate
-            return threading.Thread(target=func, args=args, kwargs=kwargs)
+            return self._runner(func, args, kwargs)
         else:
             raise RuntimeError('Delegate does not have the required methods, is not callable, and is not a valid tuple.')
 
+    def _start_delegate(self, delegate):
+        d = self._ensure_startable(delegate)
+        d.start()
+        return d
+
     def handle(self, msg):
         self._mic.send(msg)
 
-        for calculate_seed, make_delegate, dict in self._delegate_records:
+        for i, (calculate_seed, make_delegate) in enumerate(self._delegation_patterns):
             id = calculate_seed(msg)
 
             if id is None:
                 continue
-            elif isinstance(id, collections.Hashable):
-                if id not in dict or not dict[id].is_alive():
-                    d = make_delegate((self, msg, id))
-                    d = self._ensure_startable(d)
-
-                    dict[id] = d
-                    dict[id].start()
+            elif isinstance(id, _Hashable):
+                # every pattern has its own seeds
+                self._delegates.setdefault(
+                    (i, id), lambda: self._start_delegate(make_delegate((self, msg, id))))
             else:
                 d = make_delegate((self, msg, id))
                 d = self._ensure_startable(d)
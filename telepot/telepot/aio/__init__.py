@@ -6,13 +6,13 @@ import traceback
 import collections
 from concurrent.futures._base import CancelledError
 from . import helper, api
-from .. import _BotBase, flavor, _find_first_key, _isstring, _dismantle_message_identifier, _strip, _rectify
+from .. import _BotBase, flavor, _find_first_key, _isstring, _dismantle_message_identifier, _strip, _rectify, \
+               _PollPolicy, _DelegateRegistry, _Hashable
+from ..api import prepare
 
 # Patch aiohttp for sending unicode filename
 from . import hack
 
-from .. import exception
-
 
 def flavor_router(routing_table):
     router = helper.Router(flavor, routing_table)
@@ -45,6 +45,7 @@ class Bot(_BotBase):
         self._loop = loop if loop is not None else asyncio.get_event_loop()
 
         self._scheduler = self.Scheduler(self._loop)
+        self._poll_policy = None
 
         self._router = helper.Router(flavor, {'chat': helper._delay_yell(self, 'on_chat_message'),
                                               'callback_query': helper._delay_yell(self, 'on_callback_query'),
@@ -55,6 +56,10 @@ class Bot(_BotBase):
     def loop(self):
         return self._loop
 
+    def poll_stats(self):
+        """ See :meth:`telepot.Bot.poll_stats` """
+        return self._poll_policy.stats() if self._poll_policy is not None else None
+
     @property
     def scheduler(self):
         return self._scheduler
@@ -80,6 +85,21 @@ class Bot(_BotBase):
         p = _strip(locals())
         return await self._api_request('sendMessage', _rectify(p))
 
+    def prepare_message(self, text,
+                        parse_mode=None, disable_web_page_preview=None,
+                        disable_notification=None, reply_to_message_id=None, reply_markup=None):
+        """
+        Render a message once to send it to many chats by :meth:`send_prepared`.
+        Parameters are those of :meth:`sendMessage`, without ``chat_id``.
+        """
+        p = _strip(locals())
+        # the traditional version's rendering, it does no i/o
+        return prepare((self._token, 'sendMessage', _rectify(p), None))
+
+    async def send_prepared(self, chat_id, prepared):
+        """ Send a message from :meth:`prepare_message` to ``chat_id`` """
+        return await api.request_prepared(prepared, chat_id)
+
     async def forwardMessage(self, chat_id, from_chat_id, message_id, disable_notification=None):
         """ See: https://core.telegram.org/bots/api#forwardmessage """
         p = _strip(locals())
@@ -302,7 +322,8 @@ class Bot(_BotBase):
         p = _strip(locals())
         return await self._api_request('getUpdates', _rectify(p))
 
-    async def setWebhook(self, url=None, certificate=None, max_connections=None, allowed_updates=None):
+    async def setWebhook(self, url=None, certificate=None, max_connections=None, allowed_updates=None,
+                         secret_token=None):
         """ See: https://core.telegram.org/bots/api#setwebhook """
         p = _strip(locals(), more=['certificate'])
 
@@ -443,14 +464,18 @@ class Bot(_BotBase):
             finally:
                 return update['update_id']
 
+        poll = self._poll_policy = _PollPolicy(relax) if source is None else None
+
         async def get_from_telegram_server():
             offset = None  # running offset
             allowed_upd = allowed_updates
             while 1:
                 try:
+                    start = time.time()
                     result = await self.getUpdates(offset=offset,
                                                    timeout=timeout,
                                                    allowed_updates=allowed_upd)
+                    wait = poll.succeeded(len(result), time.time() - start)
 
                     # Once passed, this parameter is no longer needed.
                     allowed_upd = None
@@ -461,17 +486,13 @@ class Bot(_BotBase):
                         offset = max([handle(update) for update in result]) + 1
                 except CancelledError:
                     raise
-                except exception.BadHTTPResponse as e:
+                except Exception as e:
+                    # Servers probably down, or the network. Wait longer every time.
                     traceback.print_exc()
+                    wait = poll.failed(e)
 
-                    # Servers probably down. Wait longer.
-                    if e.status == 502:
-                        await asyncio.sleep(30)
-                except:
-                    traceback.print_exc()
-                    await asyncio.sleep(relax)
-                else:
-                    await asyncio.sleep(relax)
+                if wait:
+                    await asyncio.sleep(wait)
 
         def dictify(data):
             if type(data) is bytes:
@@ -604,29 +625,41 @@ class SpeakerBot(Bot):
 
 
 class DelegatorBot(SpeakerBot):
-    def __init__(self, token, delegation_patterns, loop=None):
+    def __init__(self, token, delegation_patterns, loop=None, max_delegates=None):
         """
         :param delegation_patterns: a list of (seeder, delegator) tuples.
+
+        :param max_delegates: See :class:`telepot.DelegatorBot`
         """
         super(DelegatorBot, self).__init__(token, loop)
-        self._delegate_records = [p+({},) for p in delegation_patterns]
+        self._delegation_patterns = list(delegation_patterns)
+        self._delegates = _DelegateRegistry(lambda task: not task.done(), max_delegates)
+
+    def delegate_stats(self):
+        """ See :meth:`telepot._DelegateRegistry.stats` """
+        return self._delegates.stats()
+
+    def _create_delegate_task(self, key, c):
+        if not asyncio.iscoroutine(c):
+            raise RuntimeError('You must produce a coroutine *object* as delegate.')
+
+        task = self._loop.create_task(c)
+        # a task says when it is done, no need to wait for a sweep
+        task.add_done_callback(lambda task: self._delegates.discard(key, task))
+        return task
 
     def handle(self, msg):
         self._mic.send(msg)
 
-        for calculate_seed, make_coroutine_obj, dict in self._delegate_records:
+        for i, (calculate_seed, make_coroutine_obj) in enumerate(self._delegation_patterns):
             id = calculate_seed(msg)
 
             if id is None:
                 continue
-            elif isinstance(id, collections.Hashable):
-                if id not in dict or dict[id].done():
-                    c = make_coroutine_obj((self, msg, id))
-
-                    if not asyncio.iscoroutine(c):
-                        raise RuntimeError('You must produce a coroutine *object* as delegate.')
-
-                    dict[id] = self._loop.create_task(c)
+            elif isinstance(id, _Hashable):
+                key = (i, id)
+                self._delegates.setdefault(
+                    key, lambda: self._create_delegate_task(key, make_coroutine_obj((self, msg, id))))
             else:
                 c = make_coroutine_obj((self, msg, id))
                 self._loop.create_task(c)
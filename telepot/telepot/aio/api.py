@@ -1,15 +1,23 @@
 import aiohttp
-import re
-import json
+import time
+import asyncio
+import contextlib
 from .. import exception
-from ..api import _methodurl, _which_pool, _fileurl, _guess_filename
+from ..api import (_methodurl, _which_pool, _fileurl, _fileparts, _filesize, _MultipartBody, _record,
+                   _classify_error, _prepared_body, _form_headers)
 
+# The connectors of the pools, by name. aiohttp ties a connector to the running
+# event loop, so each pool's connector and session are created on first use.
 _pools = {
-    'default': aiohttp.TCPConnector(limit=10)
+    'default': (aiohttp.TCPConnector, dict(limit=10)),
+    # Uploads and downloads, kept apart so a large file doesn't hold up the API calls
+    'file': (aiohttp.TCPConnector, dict(limit=4)),
 }
 
 _onetime_pool_spec = (aiohttp.TCPConnector, dict(force_close=True))
 
+_sessions = {}  # pool name -> (event loop, session)
+
 _timeout = 30
 
 
@@ -17,9 +25,47 @@ def _create_onetime_pool():
     cls, kw = _onetime_pool_spec
     return cls(**kw)
 
+def _session(name):
+    """
+    :return: the session of pool ``name`` on the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    if name in _sessions:
+        owner, session = _sessions[name]
+        if owner is loop and not session.closed:
+            return session
+
+    cls, kw = _pools[name]
+    session = aiohttp.ClientSession(connector=cls(**kw))
+    _sessions[name] = (loop, session)
+    return session
+
+@contextlib.asynccontextmanager
+async def _pool(name):
+    # the pool's shared session, or one closed after the request if `name` is None
+    if name is None:
+        async with aiohttp.ClientSession(connector=_create_onetime_pool()) as session:
+            yield session
+    else:
+        yield _session(name)
+
+async def close():
+    """
+    Close the sessions of the pools opened on the running event loop.
+    Call it before closing the loop.
+    """
+    loop = asyncio.get_running_loop()
+    for name, (owner, session) in list(_sessions.items()):
+        if owner is loop:
+            del _sessions[name]
+            await session.close()
+
 def _default_timeout(req, **user_kw):
     return _timeout
 
+# The slowest upload rate (bytes per second) tolerated before an upload times out
+_upload_rate = 64 * 1024
+
 def _compose_timeout(req, **user_kw):
     token, method, params, files = req
 
@@ -27,34 +73,25 @@ def _compose_timeout(req, **user_kw):
         # Ensure HTTP timeout is longer than getUpdates timeout
         return params['timeout'] + _default_timeout(req, **user_kw)
     elif files:
-        # Disable timeout if uploading files. For some reason, the larger the file,
-        # the longer it takes for the server to respond (after upload is finished).
-        # It is unclear how long timeout should be.
-        return None
+        # Telegram answers only after processing the whole file, allow for the file size
+        size = sum(_filesize(_fileparts(k, f)[1]) or 0 for k, f in files.items())
+        return _default_timeout(req, **user_kw) + size / _upload_rate
     else:
         return _default_timeout(req, **user_kw)
 
 def _compose_data(req, **user_kw):
     token, method, params, files = req
 
-    data = aiohttp.helpers.FormData()
+    if files:
+        # Stream the files in chunks, same as the traditional version
+        return _MultipartBody({k: str(v) for k, v in params.items()} if params else {}, files)
+
+    data = aiohttp.FormData()
 
     if params:
         for key,value in params.items():
             data.add_field(key, str(value))
 
-    if files:
-        for key,f in files.items():
-            if isinstance(f, tuple):
-                if len(f) == 2:
-                    filename, fileobj = f
-                else:
-                    raise ValueError('Tuple must have exactly 2 elements: filename, fileobj')
-            else:
-                filename, fileobj = _guess_filename(f) or key, f
-
-            data.add_field(key, fileobj, filename=filename)
-
     return data
 
 def _transform(req, **user_kw):
@@ -66,22 +103,26 @@ def _transform(req, **user_kw):
 
     name = _which_pool(req, **user_kw)
 
-    if name is None:
-        connector = _create_onetime_pool()
-    else:
-        connector = _pools[name]
-
-    kwargs = {'data':data, 'connector':connector}
+    kwargs = {'data':data}
+    if timeout is not None:
+        kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+    if isinstance(data, _MultipartBody):
+        # The files are sent as they are read, chunked if the size is unknown
+        kwargs.update(data=_chunks(data), headers=data.headers())
     kwargs.update(user_kw)
 
-    return aiohttp.post, (url,), kwargs, timeout
+    return name, (url,), kwargs
+
+async def _chunks(body):
+    for chunk in body.chunks():
+        yield chunk
 
 async def _parse(response):
     try:
         data = await response.json()
         if data is None:
             raise ValueError()
-    except (ValueError, json.JSONDecodeError):
+    except (ValueError, aiohttp.ContentTypeError):
         text = await response.text()
         raise exception.BadHTTPResponse(response.status, text, response)
 
@@ -90,26 +131,38 @@ async def _parse(response):
     else:
         description, error_code = data['description'], data['error_code']
 
-        # Look for specific error ...
-        for e in exception.TelegramError.__subclasses__():
-            n = len(e.DESCRIPTION_PATTERNS)
-            if any(map(re.search, e.DESCRIPTION_PATTERNS, n*[description], n*[re.IGNORECASE])):
-                raise e(description, error_code, data)
-
-        # ... or raise generic error
-        raise exception.TelegramError(description, error_code, data)
+        # Raise specific error, or generic error if none matches
+        raise _classify_error(description, error_code)(description, error_code, data)
 
 async def request(req, **user_kw):
-    fn, args, kwargs, timeout = _transform(req, **user_kw)
+    name, args, kwargs = _transform(req, **user_kw)
+
+    token, method, params, files = req
+    start = time.time()
+
+    async with _pool(name) as session:
+        async with session.post(*args, **kwargs) as r:
+            result = await _parse(r)
 
-    if timeout is None:
-        async with fn(*args, **kwargs) as r:
+    if files:
+        _record('upload', time.time() - start)
+    return result
+
+async def request_prepared(prepared, chat_id, **user_kw):
+    kwargs = {'data':_prepared_body(prepared, chat_id), 'headers':_form_headers,
+              'timeout':aiohttp.ClientTimeout(total=_timeout)}
+    kwargs.update(user_kw)
+
+    async with _pool(prepared.pool) as session:
+        async with session.post(prepared.url, **kwargs) as r:
             return await _parse(r)
-    else:
-        with aiohttp.Timeout(timeout):
-            async with fn(*args, **kwargs) as r:
-                return await _parse(r)
 
 def download(req):
-    with aiohttp.Timeout(_timeout):
-        return aiohttp.get(_fileurl(req))
+    """
+    :return: the response of the file pool's session, to be used as ``async with``.
+        It has to be called on the running event loop.
+    """
+    _record('download')
+    # no limit on the whole download, only on connecting and on every read
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=_timeout, sock_read=_timeout)
+    return _session('file').get(_fileurl(req), timeout=timeout)
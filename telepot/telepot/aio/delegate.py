@@ -101,5 +101,10 @@ def create_open(cls, *args, **kwargs):
                 traceback.print_exc()
                 await helper._yell(j.on_close, e)
 
+            # Stop routing messages to the object now, not once its listener
+            # happens to be garbage collected.
+            finally:
+                j.listener.close()
+
         return wait_loop()
     return f
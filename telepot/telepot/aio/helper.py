@@ -1,6 +1,6 @@
 import asyncio
 import traceback
-from .. import filtering, helper, exception
+from .. import helper, exception
 from .. import (
     flavor, chat_flavors, inline_flavors, is_event,
     message_identifier, origin_identifier)
@@ -27,16 +27,28 @@ def _delay_yell(obj, method_name):
 
 class Microphone(object):
     def __init__(self):
-        self._queues = set()
+        self._routes = helper._Routes()
 
     def add(self, q):
-        self._queues.add(q)
+        self._routes.remove_collected()
+        self._routes.add(q)
 
     def remove(self, q):
-        self._queues.remove(q)
+        self._routes.remove_collected()
+        self._routes.remove(q)
+
+    def remove_later(self, q):
+        """ See :meth:`telepot.helper.Microphone.remove_later` """
+        self._routes.remove_later(q)
+
+    def route(self, q, patterns):
+        """ Send ``q`` only messages that may match one of ``patterns`` """
+        self._routes.remove_collected()
+        self._routes.route(q, patterns)
 
     def send(self, msg):
-        for q in self._queues:
+        self._routes.remove_collected()
+        for q in self._routes.targets(msg):
             try:
                 q.put_nowait(msg)
             except asyncio.QueueFull:
@@ -55,7 +67,7 @@ class Listener(helper.Listener):
         while 1:
             msg = await self._queue.get()
 
-            if any(map(lambda p: filtering.match_all(msg, p), self._patterns)):
+            if self.matches(msg):
                 return msg
 
 
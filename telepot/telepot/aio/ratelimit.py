@@ -0,0 +1,29 @@
+import asyncio
+from .. import ratelimit, exception
+
+
+class RateLimiter(ratelimit.RateLimiter):
+    async def send(self, send_func, chat_id, *args, **kwargs):
+        """
+        Wait for the rate limits, then call ``send_func(chat_id, *args, **kwargs)``,
+        e.g. :meth:`telepot.aio.Bot.sendMessage`. Only the calling task waits.
+        """
+        retries = 0
+        while 1:
+            delay = self.reserve(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            try:
+                return await send_func(chat_id, *args, **kwargs)
+            except exception.TooManyRequestsError as e:
+                if retries >= self._max_retries:
+                    raise
+
+                retries += 1
+                self.retry_later(chat_id, e)
+
+    def augment_send(self, send_func):
+        async def augmented(chat_id, *aa, **kw):
+            return await self.send(send_func, chat_id, *aa, **kw)
+        return augmented
@@ -1,15 +1,28 @@
 import urllib3
+import urllib3.fields
 import json
 import re
 import os
+import io
+import time
+import binascii
+import threading
+import collections
 from . import exception, _isstring
 
+try:
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib import urlencode
+
 # Suppress InsecurePlatformWarning
 urllib3.disable_warnings()
 
 
 _pools = {
     'default': urllib3.PoolManager(num_pools=3, maxsize=10, retries=3, timeout=30),
+    # Uploads and downloads, kept apart so a large file doesn't hold up the API calls
+    'file': urllib3.PoolManager(num_pools=1, maxsize=4, retries=3, timeout=30),
 }
 
 _onetime_pool_spec = (urllib3.PoolManager, dict(num_pools=1, maxsize=1, retries=3, timeout=30))
@@ -25,25 +38,119 @@ def _methodurl(req, **user_kw):
 
 def _which_pool(req, **user_kw):
     token, method, params, files = req
-    return None if files else 'default'
+    return 'file' if files else 'default'
 
 def _guess_filename(obj):
     name = getattr(obj, 'name', None)
     if name and _isstring(name) and name[0] != '<' and name[-1] != '>':
         return os.path.basename(name)
 
-def _filetuple(key, f):
+def _fileparts(key, f):
     if not isinstance(f, tuple):
-        return (_guess_filename(f) or key, f.read())
+        return (_guess_filename(f) or key, f, None)
     elif len(f) == 1:
-        return (_guess_filename(f[0]) or key, f[0].read())
+        return (_guess_filename(f[0]) or key, f[0], None)
     elif len(f) == 2:
-        return (f[0], f[1].read())
+        return (f[0], f[1], None)
     elif len(f) == 3:
-        return (f[0], f[1].read(), f[2])
+        return f
     else:
         raise ValueError()
 
+def _filesize(fileobj):
+    """
+    :return: number of bytes left to read from ``fileobj``, or ``None`` if unknown
+    """
+    try:
+        pos = fileobj.tell()
+        fileobj.seek(0, 2)
+        size = fileobj.tell() - pos
+        fileobj.seek(pos)
+        return size
+    except (AttributeError, EnvironmentError, io.UnsupportedOperation):
+        return None
+
+# Files are read and sent in chunks of this many bytes, the most of a file an upload
+# holds in memory at once
+_upload_buffer_size = 64 * 1024
+
+class _MultipartBody(object):
+    """
+    A ``multipart/form-data`` body streaming its files instead of reading them into
+    memory. It can be iterated more than once (as when a request is retried), files
+    are rewound to where they were at the start.
+    """
+    def __init__(self, fields, files, buffer_size=None):
+        self._boundary = binascii.hexlify(os.urandom(16)).decode('ascii')
+        self._buffer_size = buffer_size or _upload_buffer_size
+        self._parts = []
+
+        for key, value in fields.items():
+            field = urllib3.fields.RequestField(key, value)
+            field.make_multipart()
+            self._add_part(field, _encode(value))
+
+        for key, f in files.items():
+            filename, fileobj, content_type = _fileparts(key, f)
+            field = urllib3.fields.RequestField(key, None, filename)
+            field.make_multipart(content_type=content_type or urllib3.fields.guess_content_type(filename))
+            self._add_part(field, fileobj)
+
+        self._parts.append(('--%s--\r\n' % self._boundary).encode('ascii'))
+
+        self._starts = {}
+        for part in self._parts:
+            if not isinstance(part, bytes):
+                try:
+                    self._starts[id(part)] = part.tell()
+                except (AttributeError, EnvironmentError, io.UnsupportedOperation):
+                    pass
+
+    def _add_part(self, field, data):
+        self._parts.append(('--%s\r\n' % self._boundary).encode('ascii') + field.render_headers().encode('utf-8'))
+        self._parts.append(data)
+        self._parts.append(b'\r\n')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self._boundary
+
+    @property
+    def content_length(self):
+        """ ``None`` if a file doesn't tell its size, the body is then sent chunked. """
+        n = 0
+        for part in self._parts:
+            size = len(part) if isinstance(part, bytes) else _filesize(part)
+            if size is None:
+                return None
+            n += size
+        return n
+
+    def headers(self):
+        length = self.content_length
+        h = {'Content-Type': self.content_type}
+        if length is not None:
+            h['Content-Length'] = str(length)
+        return h
+
+    def chunks(self):
+        for part in self._parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+
+            if id(part) in self._starts:
+                part.seek(self._starts[id(part)])
+
+            while 1:
+                chunk = part.read(self._buffer_size)
+                if not chunk:
+                    break
+                yield chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+
+    def __iter__(self):
+        return self.chunks()
+
 import sys
 PY_3 = sys.version_info.major >= 3
 def _fix_type(v):
@@ -52,14 +159,18 @@ def _fix_type(v):
     else:
         return v
 
+def _encode(v):
+    v = _fix_type(v)
+    if isinstance(v, bytes):
+        return v
+    elif not _isstring(v):
+        v = str(v)
+    return v.encode('utf-8')
+
 def _compose_fields(req, **user_kw):
     token, method, params, files = req
 
-    fields = {k:_fix_type(v) for k,v in params.items()} if params is not None else {}
-    if files:
-        fields.update({k:_filetuple(k,v) for k,v in files.items()})
-
-    return fields
+    return {k:_fix_type(v) for k,v in params.items()} if params is not None else {}
 
 def _default_timeout(req, **user_kw):
     name = _which_pool(req, **user_kw)
@@ -68,6 +179,18 @@ def _default_timeout(req, **user_kw):
     else:
         return _pools[name].connection_pool_kw['timeout']
 
+# The slowest upload rate (bytes per second) tolerated before an upload times out
+_upload_rate = 64 * 1024
+
+def _upload_timeout(req, **user_kw):
+    """
+    Telegram answers an upload only after processing the whole file, which takes
+    longer the larger the file is. Allow for that on top of the default timeout.
+    """
+    token, method, params, files = req
+    size = sum(_filesize(_fileparts(k, f)[1]) or 0 for k, f in files.items())
+    return _default_timeout(req, **user_kw) + size / float(_upload_rate)
+
 def _compose_kwargs(req, **user_kw):
     token, method, params, files = req
     kw = {}
@@ -79,10 +202,9 @@ def _compose_kwargs(req, **user_kw):
         # Ensure HTTP timeout is longer than getUpdates timeout
         kw['timeout'] = params['timeout'] + _default_timeout(req, **user_kw)
     elif files:
-        # Disable timeout if uploading files. For some reason, the larger the file,
-        # the longer it takes for the server to respond (after upload is finished).
-        # It is unclear how long timeout should be.
-        kw['timeout'] = None
+        # Connecting takes no longer than usual, waiting for the response grows with file size
+        kw['timeout'] = urllib3.Timeout(connect=_default_timeout(req, **user_kw),
+                                        read=_upload_timeout(req, **user_kw))
 
     # Let user-supplied arguments override
     kw.update(user_kw)
@@ -102,8 +224,65 @@ def _transform(req, **user_kw):
     else:
         pool = _pools[name]
 
+    token, method, params, files = req
+    if files:
+        # Stream the files, sent chunked if their size is unknown
+        body = _MultipartBody(fields, files)
+        headers = body.headers()
+        kwargs.update(body=body, headers=headers, chunked='Content-Length' not in headers)
+        return pool.urlopen, ('POST', url), kwargs
+
     return pool.request_encode_body, ('POST', url, fields), kwargs
 
+class _ErrorClassifier(object):
+    """
+    Finds the :class:`.TelegramError` subclass for an error in one pass: by error code
+    if a subclass claims it, otherwise by a single regular expression joining every
+    subclass's ``DESCRIPTION_PATTERNS``. Both are built once, and again only when
+    new subclasses have been defined.
+    """
+    def __init__(self):
+        self._built = None
+        self._lock = threading.Lock()
+
+    def _build(self, subclasses):
+        codes = {}
+        branches = []
+        for i, e in enumerate(subclasses):
+            code = getattr(e, 'ERROR_CODE', None)
+            if code is not None:
+                codes.setdefault(code, e)
+
+            if e.DESCRIPTION_PATTERNS:
+                # Branches are tried in order, so the first subclass matching wins, as
+                # if each one was searched for in turn
+                patterns = '|'.join('(?:%s)' % p for p in e.DESCRIPTION_PATTERNS)
+                branches.append('[\\s\\S]*?(?:%s)(?P<e%d>)' % (patterns, i))
+
+        regex = re.compile('(?:%s)' % '|'.join(branches), re.IGNORECASE) if branches else None
+        return subclasses, codes, regex
+
+    def __call__(self, description, error_code):
+        subclasses = exception.TelegramError.__subclasses__()
+
+        built = self._built
+        if built is None or built[0] != subclasses:
+            with self._lock:
+                built = self._built = self._build(subclasses)
+
+        subclasses, codes, regex = built
+
+        if error_code in codes:
+            return codes[error_code]
+
+        m = regex.match(description) if regex else None
+        if m:
+            return subclasses[int(m.lastgroup[1:])]
+
+        return exception.TelegramError
+
+_classify_error = _ErrorClassifier()
+
 def _parse(response):
     try:
         text = response.data.decode('utf-8')
@@ -116,18 +295,84 @@ def _parse(response):
     else:
         description, error_code = data['description'], data['error_code']
 
-        # Look for specific error ...
-        for e in exception.TelegramError.__subclasses__():
-            n = len(e.DESCRIPTION_PATTERNS)
-            if any(map(re.search, e.DESCRIPTION_PATTERNS, n*[description], n*[re.IGNORECASE])):
-                raise e(description, error_code, data)
+        # Raise specific error, or generic error if none matches
+        raise _classify_error(description, error_code)(description, error_code, data)
+
+_stats_lock = threading.Lock()
+_stats = {
+    'uploads': 0,
+    'upload_time': 0.0,
+    'max_upload_time': 0.0,
+    'downloads': 0,
+}
 
-        # ... or raise generic error
-        raise exception.TelegramError(description, error_code, data)
+def _record(key, seconds=None):
+    with _stats_lock:
+        _stats[key + 's'] += 1
+        if seconds is not None:
+            _stats[key + '_time'] += seconds
+            _stats['max_' + key + '_time'] = max(_stats['max_' + key + '_time'], seconds)
+
+def _handshakes(pool):
+    # New connections made by a PoolManager, each one a TCP and TLS handshake
+    n = 0
+    for key in pool.pools.keys():
+        try:
+            n += pool.pools[key].num_connections
+        except KeyError:  # evicted meanwhile
+            pass
+    return n
+
+def stats():
+    """
+    :return:
+        a dictionary of connection and upload statistics: the number of handshakes
+        per pool, the number of uploads and downloads, total and maximum upload time
+    """
+    with _stats_lock:
+        s = dict(_stats)
+    s['handshakes'] = {name: _handshakes(pool) for name, pool in _pools.items()
+                       if isinstance(pool, urllib3.PoolManager)}
+    return s
 
 def request(req, **user_kw):
     fn, args, kwargs = _transform(req, **user_kw)
+
+    start = time.time()
     r = fn(*args, **kwargs)  # `fn` must be thread-safe
+
+    token, method, params, files = req
+    if files:
+        _record('upload', time.time() - start)
+
+    return _parse(r)
+
+_PreparedRequest = collections.namedtuple('_PreparedRequest', ['url', 'pool', 'body'])
+
+_form_headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+def prepare(req, **user_kw):
+    """
+    Encode a request once, to be sent to many chats: :func:`request_prepared`
+    only has to put the ``chat_id`` in front.
+    """
+    token, method, params, files = req
+    if files:
+        raise ValueError('Requests with files cannot be prepared')
+
+    body = urlencode([(k, _encode(v)) for k,v in params.items()]) if params else ''
+    return _PreparedRequest(_methodurl(req, **user_kw), _which_pool(req, **user_kw), body.encode('ascii'))
+
+def _prepared_body(prepared, chat_id):
+    if isinstance(chat_id, int):
+        head = ('chat_id=%d' % chat_id).encode('ascii')
+    else:
+        head = urlencode([('chat_id', _encode(chat_id))]).encode('ascii')
+    return head + b'&' + prepared.body if prepared.body else head
+
+def request_prepared(prepared, chat_id, **user_kw):
+    pool = _create_onetime_pool() if prepared.pool is None else _pools[prepared.pool]
+    r = pool.urlopen('POST', prepared.url, body=_prepared_body(prepared, chat_id), headers=_form_headers, **user_kw)
     return _parse(r)
 
 def _fileurl(req):
@@ -135,6 +380,7 @@ def _fileurl(req):
     return 'https://api.telegram.org/file/bot%s/%s' % (token, path)
 
 def download(req, **user_kw):
-    pool = _create_onetime_pool()
+    pool = _pools['file']
     r = pool.request('GET', _fileurl(req), **user_kw)
+    _record('download')
     return r
@@ -266,9 +266,27 @@ def create_open(cls, *args, **kwargs):
                 traceback.print_exc()
                 j.on_close(e)
 
+            # Stop routing messages to the object now, not once its listener
+            # happens to be garbage collected.
+            finally:
+                j.listener.close()
+
         return wait_loop
     return f
 
+def create_actor(pool, cls, *args, **kwargs):
+    """
+    :return:
+        a delegator function like :func:`create_open`'s, except that the object
+        runs as an :class:`.helper.Actor` on ``pool``, an :class:`.helper.ActorPool`,
+        instead of on a thread of its own. The object's ``open``, ``on_message`` and
+        ``on_close`` must not block for long, since they hold up other actors.
+    """
+    def f(seed_tuple):
+        j = cls(seed_tuple, *args, **kwargs)
+        return helper.Actor(pool, j, seed_tuple)
+    return f
+
 def until(condition, fns):
     """
     Try a list of seeder functions until a condition is met.
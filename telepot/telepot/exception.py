@@ -83,7 +83,9 @@ class TelegramError(TelepotException):
 
     Subclasses must define a class variable ``DESCRIPTION_PATTERNS`` which is a list
     of regular expressions. If an error's *description* matches any of the regular expressions,
-    an exception of that subclass is raised.
+    an exception of that subclass is raised. A subclass may also define a class variable
+    ``ERROR_CODE``, an error code always meaning that subclass, which is then raised without
+    looking at the description.
     """
 
     def __init__(self, description, error_code, json):
@@ -101,8 +103,27 @@ class TelegramError(TelepotException):
     def json(self):
         return self.args[2]
 
+    @property
+    def parameters(self):
+        """ The error's ``ResponseParameters`` as a dictionary, empty if none were given """
+        try:
+            return self.json.get('parameters') or {}
+        except AttributeError:
+            return {}
+
+    @property
+    def retry_after(self):
+        """ Seconds to wait before repeating the request, or ``None`` """
+        return self.parameters.get('retry_after')
+
+    @property
+    def migrate_to_chat_id(self):
+        """ The supergroup a group has been migrated to, or ``None`` """
+        return self.parameters.get('migrate_to_chat_id')
+
 class UnauthorizedError(TelegramError):
     DESCRIPTION_PATTERNS = ['unauthorized']
+    ERROR_CODE = 401
 
 class BotWasKickedError(TelegramError):
     DESCRIPTION_PATTERNS = ['bot.*kicked']
@@ -112,6 +133,13 @@ class BotWasBlockedError(TelegramError):
 
 class TooManyRequestsError(TelegramError):
     DESCRIPTION_PATTERNS = ['too *many *requests']
+    ERROR_CODE = 429
 
 class MigratedToSupergroupChatError(TelegramError):
     DESCRIPTION_PATTERNS = ['migrated.*supergroup *chat']
+
+class ChatNotFoundError(TelegramError):
+    DESCRIPTION_PATTERNS = ['chat *not *found']
+
+class UserDeactivatedError(TelegramError):
+    DESCRIPTION_PATTERNS = ['user *is *deactivated']
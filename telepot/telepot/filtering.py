@@ -32,3 +32,66 @@ def match(data, template):
 
 def match_all(msg, templates):
     return all(map(lambda t: match(msg, t), templates))
+
+
+def compile_template(template):
+    """
+    :return:
+        a function of one message that tells whether it matches ``template``, as
+        :func:`match` would, with the template's structure worked out beforehand.
+    """
+    if isinstance(template, dict):
+        checks = [_compile_item(k, v) for k, v in template.items()]
+
+        def match_dict(data):
+            if not isinstance(data, dict):
+                return data == template
+            for check in checks:
+                if not check(data):
+                    return False
+            return True
+        return match_dict
+    elif callable(template):
+        return template
+    else:
+        return lambda data: data == template
+
+def _compile_item(key, template):
+    if hasattr(key, 'search'):  # regex
+        value_matches = compile_template(template)
+        hits = {}  # data key -> whether the regex finds it
+
+        def match_regex_key(data):
+            for data_key in data:
+                try:
+                    found = hits[data_key]
+                except KeyError:
+                    found = bool(key.search(data_key))
+                    if len(hits) < 1000:
+                        hits[data_key] = found
+                if found and value_matches(data[data_key]):
+                    return True
+            return False
+        return match_regex_key
+    elif isinstance(template, dict) or callable(template):
+        value_matches = compile_template(template)
+        return lambda data: key in data and value_matches(data[key])
+    else:
+        return lambda data: key in data and data[key] == template
+
+def compile_all(templates):
+    """
+    :return:
+        a function of one message that tells whether it matches all ``templates``,
+        as :func:`match_all` would.
+    """
+    matchers = [compile_template(t) for t in templates]
+    if len(matchers) == 1:
+        return matchers[0]
+
+    def match_every(msg):
+        for m in matchers:
+            if not m(msg):
+                return False
+        return True
+    return match_every
@@ -17,28 +17,153 @@ except ImportError:
     import queue
 
 
+def _route_key(pattern):
+    """
+    :return:
+        ``(path, value)``: a message matches ``pattern`` only if the value found in it
+        along ``path`` (a tuple of keys, strings or regular expressions) equals
+        ``value``. ``None`` if the pattern has no such key. Ids are preferred, they
+        tell listeners apart best.
+    """
+    def find(template, path):
+        if isinstance(template, dict):
+            for k, v in template.items():
+                for found in find(v, path + (k,)):
+                    yield found
+        elif not callable(template) and path:
+            try:
+                hash(template)
+            except TypeError:
+                return
+            yield path, template
+
+    keys = [key for template in pattern for key in find(template, ())]
+    for key in keys:
+        if key[0][-1] == 'id':
+            return key
+    return keys[0] if keys else None
+
+def _lookup(msg, path):
+    """ :return: the values found in ``msg`` along ``path``, as :func:`.filtering.match` would """
+    nodes = [msg]
+    for k in path:
+        selected = []
+        for node in nodes:
+            if not isinstance(node, dict):
+                continue
+            if hasattr(k, 'search'):  # regex
+                selected.extend(v for dk, v in node.items() if k.search(dk))
+            elif k in node:
+                selected.append(node[k])
+        nodes = selected
+    return nodes
+
+
+class _Routes(object):
+    """
+    Which queues of a microphone may want a message. A queue whose listener's
+    patterns all require a certain value somewhere in a message (a chat id, a sender
+    id, an event source) is only given messages with one of those values; the others
+    get every message.
+    """
+    def __init__(self):
+        self.broadcast = set()  # queues getting every message
+        self.routes = {}  # (path, value) -> queues
+        self.paths = {}  # path -> number of queues routed by it
+        self.queue_keys = {}  # queue -> its (path, value) keys
+        self.collected = []  # queues of listeners garbage collected, not removed yet
+
+    def add(self, q):
+        self.broadcast.add(q)
+
+    def remove(self, q):
+        self._unroute(q)
+        self.broadcast.discard(q)
+
+    def remove_later(self, q):
+        # only appends, so it is safe while the routes are being used or changed
+        self.collected.append(q)
+
+    def remove_collected(self):
+        while self.collected:
+            self.remove(self.collected.pop())
+
+    def route(self, q, patterns):
+        self._unroute(q)
+
+        keys = [_route_key(p) for p in patterns]
+        if not keys or None in keys:
+            self.broadcast.add(q)
+            return
+
+        self.broadcast.discard(q)
+        self.queue_keys[q] = keys
+        for key in keys:
+            self.routes.setdefault(key, set()).add(q)
+            self.paths[key[0]] = self.paths.get(key[0], 0) + 1
+
+    def _unroute(self, q):
+        for path, value in self.queue_keys.pop(q, []):
+            queues = self.routes[path, value]
+            queues.discard(q)
+            if not queues:
+                del self.routes[path, value]
+
+            self.paths[path] -= 1
+            if not self.paths[path]:
+                del self.paths[path]
+
+        self.broadcast.add(q)
+
+    def targets(self, msg):
+        if not self.paths:
+            return self.broadcast
+
+        targets = set(self.broadcast)
+        for path in self.paths:
+            for value in _lookup(msg, path):
+                try:
+                    targets.update(self.routes.get((path, value), ()))
+                except TypeError:  # unhashable, cannot equal a routed value
+                    pass
+        return targets
+
+
 class Microphone(object):
     def __init__(self):
-        self._queues = set()
+        self._routes = _Routes()
         self._lock = threading.Lock()
 
     def _locked(func):
         def k(self, *args, **kwargs):
             with self._lock:
+                self._routes.remove_collected()
                 return func(self, *args, **kwargs)
         return k
 
     @_locked
     def add(self, q):
-        self._queues.add(q)
+        self._routes.add(q)
 
     @_locked
     def remove(self, q):
-        self._queues.remove(q)
+        self._routes.remove(q)
+
+    def remove_later(self, q):
+        """
+        Remove ``q`` on the next call. For a listener's ``__del__``, which runs
+        whenever the garbage collector does, maybe on a thread holding the lock.
+        """
+        self._routes.remove_later(q)
+
+    @_locked
+    def route(self, q, patterns):
+        """ Send ``q`` only messages that may match one of ``patterns`` """
+        self._routes.route(q, patterns)
 
     @_locked
     def send(self, msg):
-        for q in self._queues:
+        for q in self._routes.targets(msg):
             try:
                 q.put_nowait(msg)
             except queue.Full:
@@ -50,8 +175,16 @@ class Listener(object):
         self._mic = mic
         self._queue = q
         self._patterns = []
+        self._matchers = []
 
     def __del__(self):
+        self._mic.remove_later(self._queue)
+
+    def close(self):
+        """
+        Have the microphone stop putting messages into the queue, for a listener
+        whose owner is done with it but may not be garbage collected yet.
+        """
         self._mic.remove(self._queue)
 
     def capture(self, pattern):
@@ -73,6 +206,15 @@ class Listener(object):
         All templates must produce a match for a message to be considered a match.
         """
         self._patterns.append(pattern)
+        self._matchers.append(filtering.compile_all(pattern))
+        self._mic.route(self._queue, self._patterns)
+
+    def matches(self, msg):
+        """ :return: whether ``msg`` matches a captured pattern """
+        for m in self._matchers:
+            if m(msg):
+                return True
+        return False
 
     def wait(self):
         """
@@ -84,9 +226,200 @@ class Listener(object):
         while 1:
             msg = self._queue.get(block=True)
 
-            if any(map(lambda p: filtering.match_all(msg, p), self._patterns)):
+            if self.matches(msg):
                 return msg
 
+    def redirect(self, q):
+        """
+        Have the microphone put messages into ``q`` (anything with a ``put_nowait``
+        method) instead of the queue :meth:`.wait` takes them from.
+        """
+        self._mic.remove(self._queue)
+        self._queue = q
+        self._mic.add(q)
+        self._mic.route(q, self._patterns)
+
+
+class ActorPool(object):
+    """
+    A fixed number of threads running actors (:class:`.Actor`) and one-off jobs, instead of
+    a thread for each. An actor is run by one thread at a time, which handles a few
+    messages of its mailbox before moving on to the next actor with mail, so actors
+    take turns and none is left waiting for long.
+
+    :param workers: the number of threads, the most actors and jobs running at once
+    :param batch: messages an actor handles in a row before others get a turn
+    """
+    def __init__(self, workers=8, batch=10):
+        self._ready = queue.Queue()  # callables to run, returning True to be run again
+        self._batch = batch
+        self._lock = threading.Lock()
+        self._stats = {'runs': 0, 'jobs': 0}
+        self._threads = []
+
+        for i in range(workers):
+            t = threading.Thread(target=self._work, name='actor-pool-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    @property
+    def batch(self):
+        return self._batch
+
+    def schedule(self, run):
+        self._ready.put(run)
+
+    def submit(self, fn, *args, **kwargs):
+        """ Run ``fn(*args, **kwargs)`` on the pool once """
+        def run():
+            fn(*args, **kwargs)
+            return False
+
+        with self._lock:
+            self._stats['jobs'] += 1
+        self._ready.put(run)
+
+    def _work(self):
+        while 1:
+            run = self._ready.get(block=True)
+            try:
+                again = run()
+            except:
+                # Localize error so thread can keep going.
+                traceback.print_exc()
+                again = False
+
+            with self._lock:
+                self._stats['runs'] += 1
+
+            if again:
+                self._ready.put(run)
+
+    def stats(self):
+        """
+        :return:
+            a dictionary of the number of threads, of actors and jobs waiting for a
+            thread, and of runs and jobs so far
+        """
+        with self._lock:
+            return dict(self._stats, workers=len(self._threads), ready=self._ready.qsize())
+
+
+class Job(object):
+    """
+    A function run once on an :class:`.ActorPool`, with the ``start`` and
+    ``is_alive`` methods of the thread it replaces.
+    """
+    def __init__(self, pool, target, args=(), kwargs=None):
+        self._pool = pool
+        self._target = target
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._alive = False
+
+    def start(self):
+        self._alive = True
+        self._pool.submit(self._run)
+
+    def _run(self):
+        try:
+            self._target(*self._args, **self._kwargs)
+        finally:
+            self._alive = False
+
+    def is_alive(self):
+        return self._alive
+
+
+_OPEN = object()  # first mail of every actor, the message it was created for
+
+class Actor(object):
+    """
+    Runs an object usable by :func:`telepot.delegate.create_open` on an
+    :class:`.ActorPool` instead of a thread of its own. Messages captured by the
+    object's listener go to the actor's mailbox rather than a queue a thread blocks
+    on, and the pool calls ``open``, ``on_message`` and ``on_close`` as the thread
+    would have, in order.
+
+    It has ``start`` and ``is_alive`` methods, so :class:`.DelegatorBot` takes it
+    for a delegate as it is.
+    """
+    def __init__(self, pool, obj, seed_tuple):
+        self._pool = pool
+        self._obj = obj
+        self._seed_tuple = seed_tuple
+        self._mailbox = collections.deque()
+        self._lock = threading.Lock()
+        self._scheduled = False
+        self._alive = False
+
+        obj.listener.redirect(self)
+
+    def start(self):
+        self._alive = True
+        self.put_nowait(_OPEN)
+
+    def is_alive(self):
+        return self._alive
+
+    def put_nowait(self, msg):
+        with self._lock:
+            if not self._alive:
+                return
+            self._mailbox.append(msg)
+            if self._scheduled:
+                return
+            self._scheduled = True
+
+        self._pool.schedule(self._run)
+
+    def _run(self):
+        for i in range(self._pool.batch):
+            with self._lock:
+                if not self._mailbox or not self._alive:
+                    self._scheduled = False
+                    return False
+                msg = self._mailbox.popleft()
+
+            self._handle(msg)
+
+        # More mail, stay scheduled and let other actors have a turn first
+        with self._lock:
+            self._scheduled = bool(self._mailbox) and self._alive
+            return self._scheduled
+
+    def _handle(self, msg):
+        j = self._obj
+        try:
+            if msg is _OPEN:
+                bot, msg, seed = self._seed_tuple
+                handled = j.open(msg, seed)
+                if not handled:
+                    j.on_message(msg)
+            elif j.listener.matches(msg):
+                j.on_message(msg)
+
+        # These exceptions are "normal" exits.
+        except (exception.IdleTerminate, exception.StopListening) as e:
+            self._stop()
+            j.on_close(e)
+
+        # Any other exceptions are accidents. **Print it out.**
+        except Exception as e:
+            traceback.print_exc()
+            self._stop()
+            j.on_close(e)
+
+    def _stop(self):
+        with self._lock:
+            self._alive = False
+            self._mailbox.clear()
+
+        # The microphone holds the actor, which holds the object and its listener,
+        # so the listener is never collected and has to be closed.
+        self._obj.listener.close()
+
 
 class Sender(object):
     """
@@ -201,8 +534,14 @@ class Answerer(object):
     When processing inline queries, ensure **at most one active thread** per user id.
     """
 
-    def __init__(self, bot):
+    def __init__(self, bot, pool=None):
+        """
+        :param pool:
+            an :class:`.ActorPool` to compute the answers on, instead of a thread
+            for every inline query. Defaults to the bot's ``actor_pool``, if any.
+        """
         self._bot = bot
+        self._pool = pool if pool is not None else getattr(bot, 'actor_pool', None)
         self._workers = {}  # map: user id --> worker thread
         self._lock = threading.Lock()  # control access to `self._workers`
 
@@ -237,6 +576,12 @@ class Answerer(object):
                 super(Worker, innerself).__init__()
                 innerself._cancelled = False
 
+            def start(innerself):
+                if outerself._pool is None:
+                    super(Worker, innerself).start()
+                else:
+                    outerself._pool.submit(innerself.run)
+
             def cancel(innerself):
                 innerself._cancelled = True
 
@@ -37,16 +37,7 @@ def _create_class(typename, fields):
                 for k in unexpected:
                     del kwargs[k]
 
-                s = ('Unexpected fields: ' + ', '.join(unexpected) + ''
-                     '\nBot API seems to have added new fields to the returned data.'
-                     ' This version of namedtuple is not able to capture them.'
-                     '\n\nPlease upgrade telepot by:'
-                     '\n  sudo pip install telepot --upgrade'
-                     '\n\nIf you still see this message after upgrade, that means I am still working to bring the code up-to-date.'
-                     ' Please try upgrade again a few days later.'
-                     ' In the meantime, you can access the new fields the old-fashioned way, through the raw dictionary.')
-
-                warnings.warn(s, UserWarning)
+                _warn_unexpected(unexpected)
 
             # Convert non-simple values to namedtuples.
             for key, func in conversions:
@@ -69,9 +60,98 @@ def _create_class(typename, fields):
         sub._asdict = _asdict
 
     sub.__name__ = typename
+    sub.View = _create_view(typename, field_names, defaults, conversions)
 
     return sub
 
+def _warn_unexpected(unexpected):
+    s = ('Unexpected fields: ' + ', '.join(unexpected) + ''
+         '\nBot API seems to have added new fields to the returned data.'
+         ' This version of namedtuple is not able to capture them.'
+         '\n\nPlease upgrade telepot by:'
+         '\n  sudo pip install telepot --upgrade'
+         '\n\nIf you still see this message after upgrade, that means I am still working to bring the code up-to-date.'
+         ' Please try upgrade again a few days later.'
+         ' In the meantime, you can access the new fields the old-fashioned way, through the raw dictionary.')
+
+    warnings.warn(s, UserWarning)
+
+# Function to produce view classes, e.g. `Message.View(msg)`.
+#
+# A view wraps the raw dictionary instead of copying it into a tuple. Fields are read
+# from the dictionary when accessed; nested objects are converted to views on first
+# access and kept. Unknown fields are warned about once per class.
+def _create_view(typename, field_names, defaults, conversions):
+    # dictionary key of every field, e.g. namedtuple.from_ => dict['from']
+    keys = [k.rstrip('_') if k in ['from_'] else k for k in field_names]
+    # the fields known, plus the unexpected ones already warned about
+    expected = set(keys)
+
+    converted = dict(conversions)
+
+    def simple_field(key, default):
+        return property(lambda self: self._data.get(key, default))
+
+    def nested_field(key, default, func, slot):
+        # `func` is looked up on access, it may refer to classes defined later
+        def get(self):
+            try:
+                return getattr(self, slot)
+            except AttributeError:
+                pass
+
+            value = self._data.get(key, default)
+            if value is not default:
+                if type(value) is dict or type(value) is list:
+                    value = func.View(value)
+                else:
+                    raise RuntimeError('Can only convert dict or list')
+
+            setattr(self, slot, value)
+            return value
+        return property(get)
+
+    def __init__(self, data):
+        self._data = data
+
+        # a set operation in C, the fields are only compared one by one to warn
+        if not expected.issuperset(data):
+            unexpected = set(data) - expected
+            expected.update(unexpected)
+            _warn_unexpected(unexpected)
+
+    def _asdict(self):
+        return collections.OrderedDict((f, getattr(self, f)) for f in field_names)
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other._data == self._data
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s.View(%s)' % (typename, ', '.join('%s=%r' % (f, getattr(self, f))
+                                                    for f, k in zip(field_names, keys) if k in self._data))
+
+    namespace = {
+        '__slots__': ('_data',) + tuple('_view_' + f for f in field_names if f in converted),
+        '__init__': __init__,
+        '__eq__': __eq__,
+        '__ne__': __ne__,
+        '__hash__': None,
+        '__repr__': __repr__,
+        '_asdict': _asdict,
+        '_fields': tuple(field_names),
+    }
+
+    for f, k, default in zip(field_names, keys, defaults):
+        if f in converted:
+            namespace[f] = nested_field(k, default, converted[f], '_view_' + f)
+        else:
+            namespace[f] = simple_field(k, default)
+
+    return type(typename + 'View', (object,), namespace)
+
 """
 Different treatments for incoming and outgoing namedtuples:
 
@@ -188,9 +268,11 @@ File = _create_class('File', [
 
 def PhotoSizeArray(data):
     return [PhotoSize(**p) for p in data]
+PhotoSizeArray.View = lambda data: [PhotoSize.View(p) for p in data]
 
 def PhotoSizeArrayArray(data):
     return [[PhotoSize(**p) for p in array] for array in data]
+PhotoSizeArrayArray.View = lambda data: [[PhotoSize.View(p) for p in array] for array in data]
 
 # incoming
 UserProfilePhotos = _create_class('UserProfilePhotos', [
@@ -206,6 +288,7 @@ ChatMember = _create_class('ChatMember', [
 
 def ChatMemberArray(data):
     return [ChatMember(**p) for p in data]
+ChatMemberArray.View = lambda data: [ChatMember.View(p) for p in data]
 
 # outgoing
 ReplyKeyboardMarkup = _create_class('ReplyKeyboardMarkup', [
@@ -261,6 +344,7 @@ MessageEntity = _create_class('MessageEntity', [
 # incoming
 def MessageEntityArray(data):
     return [MessageEntity(**p) for p in data]
+MessageEntityArray.View = lambda data: [MessageEntity.View(p) for p in data]
 
 # incoming
 GameHighScore = _create_class('GameHighScore', [
@@ -288,6 +372,11 @@ Game = _create_class('Game', [
            ('animation', Animation),
        ])
 
+# get around the fact that `Message` is not yet defined
+def _Message(**kwargs):
+    return Message(**kwargs)
+_Message.View = lambda data: Message.View(data)
+
 # incoming
 Message = _create_class('Message', [
               'message_id',
@@ -297,8 +386,8 @@ Message = _create_class('Message', [
               ('forward_from', User),
               ('forward_from_chat', Chat),
               'forward_from_message_id',
-              'forward_date',                     # get around the fact that `Message` is not yet defined
-              ('reply_to_message', lambda **kwargs: getattr(sys.modules[__name__], 'Message')(**kwargs)),
+              'forward_date',
+              ('reply_to_message', _Message),
               'edit_date',
               'text',
               ('entities', MessageEntityArray),
@@ -323,7 +412,7 @@ Message = _create_class('Message', [
               'channel_chat_created',
               'migrate_to_chat_id',
               'migrate_from_chat_id',
-              ('pinned_message', lambda **kwargs: getattr(sys.modules[__name__], 'Message')(**kwargs)),
+              ('pinned_message', _Message),
           ])
 
 # incoming
@@ -370,6 +459,7 @@ Update = _create_class('Update', [
 # incoming
 def UpdateArray(data):
     return [Update(**u) for u in data]
+UpdateArray.View = lambda data: [Update.View(u) for u in data]
 
 # incoming
 WebhookInfo = _create_class('WebhookInfo', [
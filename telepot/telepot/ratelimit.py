@@ -0,0 +1,145 @@
+import time
+import threading
+from . import exception
+
+
+class TokenBucket(object):
+    """
+    A token bucket kept as a *theoretical arrival time*, i.e. the time at which the
+    bucket would be full again. Taking a token never fails. It just tells how long
+    to wait before the token may be used.
+    """
+
+    def __init__(self, rate, burst=1):
+        """
+        :param rate: tokens per second
+        :param burst: number of tokens that may be used at once after being idle
+        """
+        self._interval = 1.0 / rate
+        self._tolerance = (burst - 1) * self._interval
+        self._tat = 0.0
+
+    def earliest(self, now):
+        """ Return the earliest time a token is available. """
+        return max(now, self._tat - self._tolerance)
+
+    def take(self, when):
+        """ Use a token at time ``when``, which must not be earlier than :meth:`earliest`. """
+        self._tat = max(self._tat, when) + self._interval
+
+    def hold(self, until):
+        """ Make no token available before ``until``. """
+        self._tat = max(self._tat, until + self._tolerance)
+
+    def idle(self, now):
+        """ Whether the bucket is full, thus indistinguishable from a new bucket. """
+        return self._tat <= now
+
+
+class RateLimiter(object):
+    """
+    Schedule sends so they stay within Telegram's flood limits: a global bucket
+    shared by all chats, plus one bucket per chat. A send is delayed until both
+    buckets allow it. If Telegram still answers with a :class:`.TooManyRequestsError`,
+    the chat is held for the ``retry_after`` seconds given in the error and the send
+    is tried again, instead of being dropped.
+    """
+
+    # Telegram's limits are roughly 30 messages per second overall and 1 message
+    # per second to the same chat.
+    def __init__(self, rate=30, per_chat_rate=1, burst=30, per_chat_burst=1, max_retries=5):
+        """
+        :param rate: messages per second, overall
+        :param per_chat_rate: messages per second, to each chat
+        :param burst: messages that may go out at once overall after being idle
+        :param per_chat_burst: messages that may go out at once to a chat after being idle
+        :param max_retries:
+            how many times a send is retried on :class:`.TooManyRequestsError`
+            before the error is raised to the caller
+        """
+        self._global = TokenBucket(rate, burst)
+        self._chats = {}  # map: chat id --> bucket
+        self._per_chat_spec = (per_chat_rate, per_chat_burst)
+        self._max_retries = max_retries
+        self._lock = threading.Lock()  # the aio version shares this, it is never held for long
+        self._reservations = 0
+
+    def _chat_bucket(self, chat_id):
+        try:
+            return self._chats[chat_id]
+        except KeyError:
+            b = self._chats[chat_id] = TokenBucket(*self._per_chat_spec)
+            return b
+
+    def _prune(self, now):
+        # Idle buckets carry no information. Drop them so the dictionary does
+        # not grow with every chat ever sent to.
+        for chat_id in [c for c,b in self._chats.items() if b.idle(now)]:
+            del self._chats[chat_id]
+
+    def reserve(self, chat_id):
+        """
+        Reserve a send to ``chat_id``.
+
+        :return: number of seconds to wait before sending
+        """
+        with self._lock:
+            now = time.time()
+
+            self._reservations += 1
+            if self._reservations % 1000 == 0:
+                self._prune(now)
+
+            chat = self._chat_bucket(chat_id)
+            when = max(self._global.earliest(now), chat.earliest(now))
+
+            self._global.take(when)
+            chat.take(when)
+
+            return when - now
+
+    def retry_later(self, chat_id, error):
+        """
+        Hold ``chat_id`` for as long as a :class:`.TooManyRequestsError` asks.
+
+        :return: number of seconds to wait before trying again
+        """
+        retry_after = error.retry_after or 1
+
+        with self._lock:
+            self._chat_bucket(chat_id).hold(time.time() + retry_after)
+
+        return retry_after
+
+    def send(self, send_func, chat_id, *args, **kwargs):
+        """
+        Wait for the rate limits, then call ``send_func(chat_id, *args, **kwargs)``,
+        e.g. :meth:`.Bot.sendMessage`. Blocks the calling thread while waiting.
+        """
+        retries = 0
+        while 1:
+            delay = self.reserve(chat_id)
+            if delay > 0:
+                time.sleep(delay)
+
+            try:
+                return send_func(chat_id, *args, **kwargs)
+            except exception.TooManyRequestsError as e:
+                if retries >= self._max_retries:
+                    raise
+
+                retries += 1
+                self.retry_later(chat_id, e)
+
+    def augment_send(self, send_func):
+        """
+        :param send_func:
+            functions that send messages, such as :meth:`.Bot.send\*`
+
+        :return:
+            a function that wraps around ``send_func`` and passes every call
+            through :meth:`send`
+        """
+        def augmented(chat_id, *aa, **kw):
+            return self.send(send_func, chat_id, *aa, **kw)
+        return augmented
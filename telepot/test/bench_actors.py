@@ -0,0 +1,75 @@
+import gc
+import sys
+import time
+import queue
+import resource
+import threading
+import telepot
+import telepot.helper
+from telepot.delegate import per_chat_id, create_open, create_actor, pave_event_space
+
+"""
+$ python3 bench_actors.py [chats]
+
+Starts a chat handler for every one of [chats] chats and sends each of them a few
+messages, once with a thread per handler (create_open) and once with the handlers
+as actors on a pool of 8 threads (create_actor). Every run is in a process of its
+own, see the thread count and memory use. The handlers then time out, their threads
+end and nothing is left listening.
+"""
+
+class Counter(telepot.helper.ChatHandler):
+    def __init__(self, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        self.count = 0
+
+    def on_chat_message(self, msg):
+        self.count += 1
+        handled.append(msg['chat']['id'])
+
+    def on_close(self, ex):
+        closed.append(self.chat_id)
+
+handled = []
+closed = []
+
+def run(mode, chats):
+    if mode == 'actors':
+        pool = telepot.helper.ActorPool(8)
+        pattern = pave_event_space()(per_chat_id(), create_actor, pool, Counter, timeout=1)
+    else:
+        pool = None
+        pattern = pave_event_space()(per_chat_id(), create_open, Counter, timeout=1)
+
+    bot = telepot.DelegatorBot('123:abc', [pattern], actor_pool=pool)
+    # nothing comes from the queue, the loop only runs the scheduler timing handlers out
+    bot.message_loop(source=queue.Queue())
+
+    start = time.time()
+    for n in range(3):
+        for i in range(chats):
+            bot.handle({'message_id': n, 'chat': {'id': i, 'type': 'private'}, 'date': 0, 'text': 'x'})
+
+    while len(handled) < 3 * chats:
+        time.sleep(0.01)
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    print('%-7s %d chats: %.2fs, %d threads, max rss %d kB'
+          % (mode, chats, time.time() - start, threading.active_count(), usage.ru_maxrss))
+
+    while len(closed) < chats:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    gc.collect()
+
+    print('%-7s %d closed, %d threads, %d still listening'
+          % (mode, len(closed), threading.active_count(), len(bot._mic._routes.queue_keys)))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        run(sys.argv[2], int(sys.argv[1]))
+    else:
+        import subprocess
+        chats = sys.argv[1] if len(sys.argv) > 1 else '500'
+        for mode in ['threads', 'actors']:
+            subprocess.check_call([sys.executable, __file__, chats, mode])
@@ -0,0 +1,64 @@
+# Compare compiled templates (filtering.compile_all) with interpreting them on every
+# message (filtering.match_all), for the patterns the handlers capture with.
+#
+#   python bench_filtering.py
+
+import re
+import time
+from telepot import filtering, flavor
+
+N = 200000
+
+updates = [
+    {'message_id': 1021, 'date': 1500000000, 'text': '/users',
+     'from': {'id': 12345, 'is_bot': False, 'first_name': 'Ada', 'username': 'ada'},
+     'chat': {'id': 12345, 'type': 'private', 'first_name': 'Ada', 'username': 'ada'},
+     'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]},
+    {'message_id': 1022, 'date': 1500000001, 'text': 'hello',
+     'from': {'id': 999, 'is_bot': False, 'first_name': 'Bob'},
+     'chat': {'id': -10042, 'type': 'supergroup', 'title': 'relay'}},
+    {'id': '4433', 'chat_instance': '-88', 'data': 'next',
+     'from': {'id': 12345, 'is_bot': False, 'first_name': 'Ada'},
+     'message': {'message_id': 77, 'date': 1500000002, 'text': 'page 1',
+                 'chat': {'id': 12345, 'type': 'private'}}},
+    {'id': '5566', 'query': 'irc', 'offset': '',
+     'from': {'id': 999, 'is_bot': False, 'first_name': 'Bob'}},
+    {'_idle': {'source': {'space': 'relay', 'id': 12345}, 'timeout': 10}},
+]
+
+patterns = [
+    [{'chat': {'id': 12345}}],
+    [{'message': {'chat': {'id': 12345}}}],
+    [lambda msg: flavor(msg) in ['inline_query', 'chosen_inline_result'], {'from': {'id': 999}}],
+    [{re.compile('^_.+'): {'source': {'space': 'relay', 'id': 12345}}}],
+]
+
+
+def interpreted():
+    start = time.time()
+    for i in range(N):
+        msg = updates[i % len(updates)]
+        for p in patterns:
+            filtering.match_all(msg, p)
+    return time.time() - start
+
+
+def compiled():
+    matchers = [filtering.compile_all(p) for p in patterns]
+
+    start = time.time()
+    for i in range(N):
+        msg = updates[i % len(updates)]
+        for m in matchers:
+            m(msg)
+    return time.time() - start
+
+
+for msg in updates:
+    for p in patterns:
+        assert filtering.compile_all(p)(msg) == filtering.match_all(msg, p)
+
+for run in [interpreted, compiled]:
+    t = run()
+    print('%-12s %d updates x %d patterns: %.2fs, %.2f us per match'
+          % (run.__name__, N, len(patterns), t, t / N / len(patterns) * 1e6))
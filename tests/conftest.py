@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the relay modules, and the telepot they are built on
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(root, 'telepot'), root]
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import unittest.mock
+
+from aiohttp import web
+
+import telepot.api
+import telepot.aio.api
+
+
+class FakeTelegram:
+    """
+    A bot api server on a thread of its own. It records the calls it gets and
+    answers them with `results`, True for a method not in there. Files are
+    downloaded from `files`, by path.
+    """
+
+    def __init__(self, results=None, files=None):
+        self.results = dict(results or {})
+        self.files = dict(files or {})
+        self.calls = []
+        self.loop = asyncio.new_event_loop()
+        self.runner = None
+        self.port = None
+
+    def start(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.method)
+        app.router.add_get('/file/bot{token}/{path:.+}', self.file)
+
+        async def serve():
+            self.runner = web.AppRunner(app, access_log=None)
+            await self.runner.setup()
+            site = web.TCPSite(self.runner, '127.0.0.1', 0)
+            await site.start()
+            self.port = site._server.sockets[0].getsockname()[1]
+
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            self.loop.run_until_complete(serve())
+            started.set()
+            self.loop.run_forever()
+            self.loop.run_until_complete(self.runner.cleanup())
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run, name='fake-telegram', daemon=True)
+        self.thread.start()
+        started.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+    def patch(self, testcase):
+        """ Send the requests of `testcase`, traditional and aio, to this server. """
+        def methodurl(req, **user_kw):
+            token, method, params, files = req
+            return 'http://127.0.0.1:{0:d}/bot{1:s}/{2:s}'.format(self.port, token, method)
+
+        def fileurl(req):
+            token, path = req
+            return 'http://127.0.0.1:{0:d}/file/bot{1:s}/{2:s}'.format(self.port, token, path)
+
+        for module in [telepot.api, telepot.aio.api]:
+            for name, url in [('_methodurl', methodurl), ('_fileurl', fileurl)]:
+                patcher = unittest.mock.patch.object(module, name, url)
+                patcher.start()
+                testcase.addCleanup(patcher.stop)
+
+    async def method(self, request):
+        form = await request.post()
+        # uploaded files are recorded by their content
+        self.calls.append((request.match_info['method'],
+                           {k: v.file.read() if isinstance(v, web.FileField) else v for k, v in form.items()}))
+        result = self.results.get(request.match_info['method'], True)
+        if isinstance(result, tuple):
+            error_code, description = result
+            return web.json_response({'ok': False, 'error_code': error_code, 'description': description})
+        return web.json_response({'ok': True, 'result': result})
+
+    async def file(self, request):
+        self.calls.append(('file', request.match_info['path']))
+        return web.Response(body=self.files[request.match_info['path']])
@@ -0,0 +1,119 @@
+import gc
+import time
+import threading
+import unittest
+
+import telepot
+import telepot.helper
+from telepot import exception
+from telepot.delegate import per_chat_id, create_open, create_actor, pave_event_space
+
+
+def message(chat_id, text='x'):
+    return {'message_id': 1, 'date': 0, 'text': text, 'chat': {'id': chat_id, 'type': 'private'}}
+
+
+class Handler(telepot.helper.ChatHandler):
+    opened = []
+    closed = []
+
+    def __init__(self, *args, **kwargs):
+        super(Handler, self).__init__(*args, **kwargs)
+        self.opened.append(self.chat_id)
+
+    def on_chat_message(self, msg):
+        if msg['text'] == 'stop':
+            raise exception.StopListening()
+
+    def on_close(self, ex):
+        self.closed.append(self.chat_id)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(0.01)
+
+
+class ActorTest(unittest.TestCase):
+    def setUp(self):
+        Handler.opened = []
+        Handler.closed = []
+        self.pool = telepot.helper.ActorPool(4)
+        self.bot = telepot.DelegatorBot(
+            '123:abc', [pave_event_space()(per_chat_id(), create_actor, self.pool, Handler, timeout=60)],
+            actor_pool=self.pool)
+
+    def test_one_actor_per_chat(self):
+        for n in range(2):
+            for chat_id in range(200):
+                self.bot.handle(message(chat_id))
+
+        wait_until(lambda: self.pool.stats()['ready'] == 0)
+        self.assertEqual(sorted(Handler.opened), list(range(200)))
+
+    def test_stopped_actors_stop_listening(self):
+        for chat_id in range(100):
+            self.bot.handle(message(chat_id))
+            self.bot.handle(message(chat_id, 'stop'))
+
+        # an actor may stop on 'stop' before handle() looks up its chat, which then
+        # gets another actor for the same message, stopping on it as well
+        wait_until(lambda: self.bot._delegates.stats()['live'] == 0 and set(Handler.closed) == set(range(100)))
+        gc.collect()
+        routes = self.bot._mic._routes
+        self.assertEqual(routes.queue_keys, {})
+        self.assertEqual(routes.broadcast, set())
+
+    def test_job_is_alive_until_done(self):
+        release = threading.Event()
+        job = telepot.helper.Job(self.pool, release.wait)
+        job.start()
+        self.assertTrue(job.is_alive())
+
+        release.set()
+        wait_until(lambda: not job.is_alive())
+
+
+class ThreadedHandlerTest(unittest.TestCase):
+    def test_finished_handlers_stop_listening(self):
+        Handler.opened = []
+        Handler.closed = []
+        bot = telepot.DelegatorBot('123:abc', [pave_event_space()(per_chat_id(), create_open, Handler, timeout=60)])
+        for chat_id in range(20):
+            bot.handle(message(chat_id))
+            bot.handle(message(chat_id, 'stop'))
+
+        wait_until(lambda: bot._delegates.stats()['live'] == 0 and set(Handler.closed) == set(range(20)))
+        # the registry still holds the finished threads, and so their listeners
+        routes = bot._mic._routes
+        self.assertEqual(routes.queue_keys, {})
+        self.assertEqual(routes.broadcast, set())
+
+class MicrophoneTest(unittest.TestCase):
+    def test_listener_collected_while_sending(self):
+        mic = telepot.helper.Microphone()
+        listeners = []
+
+        class Queue:
+            # the last reference to the listener goes while the microphone is locked
+            def put_nowait(self, msg):
+                listeners.clear()
+
+        q = Queue()
+        mic.add(q)
+        listeners.append(telepot.helper.Listener(mic, q))
+
+        sender = threading.Thread(target=mic.send, args=(message(1),), daemon=True)
+        sender.start()
+        sender.join(5)
+        self.assertFalse(sender.is_alive())
+
+        mic.send(message(1))
+        self.assertEqual(mic._routes.broadcast, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+import configparser
+
+import aiorelay
+import telepot.aio.api
+
+from fake_telegram import FakeTelegram
+
+
+class AsyncTelegramBotTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        self.config = configparser.ConfigParser()
+        self.config.read_dict({'Telegram': {'user_file': os.path.join(directory, 'users.json')}})
+
+        self.server = FakeTelegram({'getMe': {'id': 42, 'is_bot': True, 'first_name': 'relay'},
+                                    'sendMessage': {'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'}}})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.server.patch(self)
+
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def run_relay(self, coroutine):
+        # the relay is built on its loop, as aiorelay.main does, and stopped after `coroutine`
+        async def run():
+            telegram = aiorelay.AsyncTelegramBot('123:abc', self.config, self.loop)
+            try:
+                return await coroutine(telegram)
+            finally:
+                await telegram.stop()
+                telegram.disk.shutdown()
+
+        return self.loop.run_until_complete(run())
+
+    def test_calls_the_bot_api(self):
+        async def get_me(telegram):
+            return await telegram.telegram.getMe()
+
+        self.assertEqual(self.run_relay(get_me)['id'], 42)
+        self.assertEqual(self.server.calls, [('getMe', {})])
+
+    def test_answers_a_command(self):
+        async def start(telegram):
+            await telegram.telegram_handle({'message_id': 1, 'date': 0, 'text': '/start',
+                                            'from': {'id': 7, 'is_bot': False, 'first_name': 'Ada'},
+                                            'chat': {'id': 7, 'type': 'private'}})
+            return telegram.users['7']['enabled']
+
+        self.assertTrue(self.run_relay(start))
+        [(method, form)] = self.server.calls
+        self.assertEqual((method, form['chat_id']), ('sendMessage', '7'))
+
+    def test_fans_out_a_line(self):
+        async def send_to(telegram):
+            await asyncio.gather(*telegram.send_to([7, 8, 9], 'line'))
+
+        self.run_relay(send_to)
+        self.assertEqual(sorted((method, form['chat_id'], form['text']) for method, form in self.server.calls),
+                         [('sendMessage', str(chat_id), 'line') for chat_id in [7, 8, 9]])
+
+    def test_uploads_a_file(self):
+        async def send_document(telegram):
+            with open(__file__, 'rb') as f:
+                await telegram.telegram.sendDocument(7, f)
+
+        self.run_relay(send_document)
+        [(method, form)] = self.server.calls
+        self.assertEqual(method, 'sendDocument')
+        with open(__file__, 'rb') as f:
+            self.assertEqual(form['document'], f.read())
+
+    def test_stop_closes_the_sessions(self):
+        async def get_me(telegram):
+            await telegram.telegram.getMe()
+            return telepot.aio.api._sessions['default'][1]
+
+        self.assertTrue(self.run_relay(get_me).closed)
+
+
+if __name__ == '__main__':
+    unittest.main()
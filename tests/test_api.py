@@ -0,0 +1,105 @@
+import io
+import os
+import asyncio
+import unittest
+
+import telepot
+import telepot.aio
+import telepot.aio.api
+from telepot import exception
+
+from fake_telegram import FakeTelegram
+
+
+class PreparedTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeTelegram({'sendMessage': {'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'}}})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.server.patch(self)
+
+    def check_sent(self, chat_ids):
+        self.assertEqual([(method, form['chat_id'], form['text'], form['parse_mode'])
+                          for method, form in self.server.calls],
+                         [('sendMessage', str(chat_id), 'a & b', 'HTML') for chat_id in chat_ids])
+
+    def test_send_prepared(self):
+        bot = telepot.Bot('123:abc')
+        prepared = bot.prepare_message('a & b', parse_mode='HTML')
+        for chat_id in [7, -1001, '@channel']:
+            self.assertEqual(bot.send_prepared(chat_id, prepared)['message_id'], 1)
+
+        self.check_sent([7, -1001, '@channel'])
+
+    def test_send_prepared_aio(self):
+        async def send():
+            bot = telepot.aio.Bot('123:abc', loop)
+            prepared = bot.prepare_message('a & b', parse_mode='HTML')
+            try:
+                return await asyncio.gather(*[bot.send_prepared(chat_id, prepared)
+                                              for chat_id in [7, -1001, '@channel']])
+            finally:
+                await telepot.aio.api.close()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.assertEqual([r['message_id'] for r in loop.run_until_complete(send())], [1, 1, 1])
+
+        self.server.calls.sort(key=lambda call: ['7', '-1001', '@channel'].index(call[1]['chat_id']))
+        self.check_sent([7, -1001, '@channel'])
+
+    def test_send_prepared_error(self):
+        self.server.results['sendMessage'] = (403, 'Forbidden: bot was blocked by the user')
+
+        async def send():
+            bot = telepot.aio.Bot('123:abc', loop)
+            try:
+                await bot.send_prepared(7, bot.prepare_message('a & b'))
+            finally:
+                await telepot.aio.api.close()
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        with self.assertRaises(exception.BotWasBlockedError):
+            loop.run_until_complete(send())
+
+        bot = telepot.Bot('123:abc')
+        with self.assertRaises(exception.BotWasBlockedError):
+            bot.send_prepared(7, bot.prepare_message('a & b'))
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.content = os.urandom(200000)
+        self.server = FakeTelegram({'getFile': {'file_id': 'f1', 'file_path': 'documents/file_1.bin'}},
+                                   files={'documents/file_1.bin': self.content})
+        self.server.start()
+        self.addCleanup(self.server.stop)
+        self.server.patch(self)
+
+    def test_download_file(self):
+        dest = io.BytesIO()
+        telepot.Bot('123:abc').download_file('f1', dest)
+        self.assertEqual(dest.getvalue(), self.content)
+
+    def test_download_file_aio(self):
+        async def download():
+            bot = telepot.aio.Bot('123:abc', loop)
+            try:
+                await bot.download_file('f1', dest)
+                sessions = telepot.aio.api._sessions
+                return sessions['file'][1] is not sessions['default'][1]
+            finally:
+                await telepot.aio.api.close()
+
+        dest = io.BytesIO()
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        # the api call and the download go through different pools
+        self.assertTrue(loop.run_until_complete(download()))
+        self.assertEqual(dest.getvalue(), self.content)
+        self.assertEqual(self.server.calls[-1], ('file', 'documents/file_1.bin'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+import configparser
+
+from backlog import Backlog
+from telegrambot import TelegramBot
+
+
+class BacklogTest(unittest.TestCase):
+    def test_lines_by_time_and_count(self):
+        backlog = Backlog(size=5)
+        for i in range(12):
+            backlog.add('#c', 'msg', 'nick{0:d}'.format(i), 'line {0:d}'.format(i), timestamp=100 + i)
+
+        self.assertEqual([text for t, k, n, text in backlog.lines('#c')], ['line {0:d}'.format(i) for i in range(7, 12)])
+        self.assertEqual([text for t, k, n, text in backlog.lines('#c', since=110)], ['line 10', 'line 11'])
+        self.assertEqual([nick for t, k, nick, x in backlog.lines('#c', last=2)], ['nick10', 'nick11'])
+        self.assertEqual(backlog.lines('#other'), [])
+
+    def test_nick_table_is_bounded(self):
+        backlog = Backlog(size=100)
+        for i in range(50000):
+            backlog.add('#c', 'msg', 'nick{0:d}'.format(i), 'line {0:d}'.format(i), timestamp=i)
+
+        self.assertLess(len(backlog.nick_names), 2048)
+        self.assertEqual(len(backlog.nick_ids), len(backlog.nick_names))
+        lines = backlog.lines('#c')
+        self.assertEqual(len(lines), 100)
+        self.assertTrue(all(nick == 'nick' + text[len('line '):] for t, k, nick, text in lines))
+
+    def test_saved_and_read_back(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        file_name = os.path.join(directory, 'backlog.json')
+
+        backlog = Backlog(size=10, file_name=file_name)
+        backlog.add('#c', 'notification', '', 'joined', timestamp=5)
+        backlog.save()
+
+        self.assertEqual(Backlog(size=10, file_name=file_name).lines('#c'), [(5, 'notification', '', 'joined')])
+
+
+    def test_failed_save_is_tried_again(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        file_name = os.path.join(directory, 'missing', 'backlog.json')
+
+        backlog = Backlog(size=10, file_name=file_name)
+        backlog.add('#c', 'msg', 'ada', 'hello', timestamp=5)
+        backlog.save()
+        self.assertFalse(os.path.exists(file_name))
+
+        # no new line, the next save still writes the one that failed
+        os.mkdir(os.path.dirname(file_name))
+        backlog.save()
+        self.assertEqual(Backlog(size=10, file_name=file_name).lines('#c'), [(5, 'msg', 'ada', 'hello')])
+
+class BacklogCommandTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        config = configparser.ConfigParser()
+        config.read_dict({'Telegram': {'user_file': os.path.join(directory, 'users.save')},
+                          'Relay': {'per_chat_rate': '1000', 'rate': '1000'}})
+        self.bot = TelegramBot('123:abc', config)
+        self.bot.add_channel('#c', None, '#c')
+        for i in range(30):
+            self.bot.backlog.add('#c', 'msg', 'nick', 'line {0:d}'.format(i))
+
+    def test_backlog_lines(self):
+        replies = self.bot.replies('1', '/backlog 3')
+        self.assertEqual(len(replies), 1)
+        self.assertEqual([line.split('> ')[1] for line in replies[0].split('\n')], ['line 27', 'line 28', 'line 29'])
+
+    def test_backlog_zero_is_nothing(self):
+        self.assertEqual(self.bot.replies('1', '/backlog 0'), ['Nothing to catch up on.'])
+
+    def test_replies_are_rate_limited(self):
+        sent = []
+        reserved = []
+        self.bot.telegram.sendMessage = lambda chat_id, text: sent.append((chat_id, text))
+        reserve = self.bot.limiter.reserve
+        self.bot.limiter.reserve = lambda chat_id: reserved.append(chat_id) or reserve(chat_id)
+
+        self.bot.telegram_handle({'message_id': 1, 'date': 0, 'text': '/backlog 3',
+                                  'chat': {'id': 1, 'type': 'private'}})
+
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(reserved, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import threading
+import collections
+import unittest
+
+import telepot
+from telepot.delegate import per_chat_id
+
+
+def message(chat_id):
+    return {'message_id': 1, 'date': 0, 'text': 'x', 'chat': {'id': chat_id, 'type': 'private'}}
+
+
+class DelegateRegistryTest(unittest.TestCase):
+    def test_sweep_keeps_delegates_just_created(self):
+        # more chats than the first sweep looks at, every delegate alive until released
+        release = threading.Event()
+        started = collections.Counter()
+        lock = threading.Lock()
+
+        def run(chat_id):
+            with lock:
+                started[chat_id] += 1
+            release.wait()
+
+        bot = telepot.DelegatorBot('123:abc', [(per_chat_id(), lambda seed_tuple: (run, [seed_tuple[2]], {}))])
+        try:
+            for n in range(2):
+                for chat_id in range(200):
+                    bot.handle(message(chat_id))
+
+            self.assertEqual(set(started.values()), {1})
+            self.assertEqual(len(started), 200)
+            self.assertEqual(bot.delegate_stats()['live'], 200)
+        finally:
+            release.set()
+
+    def test_finished_delegates_are_replaced(self):
+        done = []
+        bot = telepot.DelegatorBot('123:abc', [(per_chat_id(), lambda seed_tuple: (done.append, [seed_tuple[2]], {}))])
+
+        for n in range(3):
+            bot.handle(message(1))
+            for t in threading.enumerate():
+                if t is not threading.current_thread() and not t.daemon:
+                    t.join(1)
+
+        self.assertEqual(done, [1, 1, 1])
+
+    def test_eviction_keeps_the_most_recent(self):
+        release = threading.Event()
+        bot = telepot.DelegatorBot('123:abc', [(per_chat_id(), lambda seed_tuple: (release.wait, [], {}))],
+                                   max_delegates=10)
+        try:
+            for chat_id in range(30):
+                bot.handle(message(chat_id))
+
+            stats = bot.delegate_stats()
+            self.assertEqual(stats['live'], 10)
+            self.assertEqual(stats['evicted'], 20)
+        finally:
+            release.set()
+
+
+if __name__ == '__main__':
+    unittest.main()
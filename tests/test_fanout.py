@@ -0,0 +1,109 @@
+import time
+import unittest
+import concurrent.futures
+
+import telepot.exception
+
+from fanout import FanOut
+
+
+def error(cls, description, code, parameters=None):
+    return cls(description, code, {'ok': False, 'description': description, 'error_code': code,
+                                   'parameters': parameters or {}})
+
+
+class FanOutTest(unittest.TestCase):
+    def fanout(self, send, **kwargs):
+        self.dead = []
+        self.moved = []
+        fanout = FanOut(send, on_dead=lambda chat_id, e: self.dead.append(chat_id),
+                        on_migrated=lambda chat_id, new_chat_id: self.moved.append((chat_id, new_chat_id)), **kwargs)
+        self.addCleanup(fanout.shutdown)
+        return fanout
+
+    def broadcast(self, fanout, chat_ids, message='line'):
+        futures = fanout.broadcast(chat_ids, message)
+        concurrent.futures.wait(futures, 10)
+        return [future.result() for future in futures]
+
+    def test_bad_messages_do_not_count_against_chats(self):
+        def send(chat_id, message):
+            raise error(telepot.exception.TelegramError, 'Bad Request: message is too long', 400)
+
+        fanout = self.fanout(send, max_failures=5)
+        for i in range(10):
+            self.assertEqual(self.broadcast(fanout, range(10)), [None] * 10)
+
+        self.assertEqual(self.dead, [])
+        self.assertEqual(fanout.stats()['failing_chats'], 0)
+
+    def test_unauthorized_does_not_count(self):
+        def send(chat_id, message):
+            raise error(telepot.exception.UnauthorizedError, 'Unauthorized', 401)
+
+        fanout = self.fanout(send, max_failures=2)
+        for i in range(5):
+            self.broadcast(fanout, range(10))
+        self.assertEqual(self.dead, [])
+
+    def test_chat_errors_count(self):
+        def send(chat_id, message):
+            if chat_id == 3:
+                raise error(telepot.exception.TelegramError, 'Forbidden: bot is not a member of the channel chat', 403)
+
+        fanout = self.fanout(send, max_failures=3)
+        for i in range(3):
+            self.broadcast(fanout, range(5))
+        self.assertEqual(self.dead, [3])
+
+    def test_dead_chats_are_pruned_at_once(self):
+        def send(chat_id, message):
+            if chat_id == 1:
+                raise error(telepot.exception.BotWasBlockedError, 'Forbidden: bot was blocked by the user', 403)
+
+        fanout = self.fanout(send)
+        self.broadcast(fanout, range(3))
+        self.assertEqual(self.dead, [1])
+
+    def test_migrated_groups_are_followed(self):
+        sent = []
+
+        def send(chat_id, message):
+            if chat_id == -1:
+                raise error(telepot.exception.MigratedToSupergroupChatError,
+                            'Bad Request: group chat was migrated to a supergroup chat', 400,
+                            {'migrate_to_chat_id': -1001})
+            sent.append(chat_id)
+
+        fanout = self.fanout(send)
+        self.assertEqual(self.broadcast(fanout, [-1, 2]), [None, None])
+        self.assertEqual(sorted(sent), [-1001, 2])
+        self.assertEqual(self.moved, [(-1, -1001)])
+        self.assertEqual(self.dead, [])
+
+    def test_retries_do_not_hold_up_workers(self):
+        failed = set()
+
+        def send(chat_id, message):
+            if chat_id not in failed:
+                failed.add(chat_id)
+                raise ConnectionError('network down')
+
+        # sleeping on the only worker would take 10 x 0.2s
+        fanout = self.fanout(send, workers=1, backoff=0.2)
+        start = time.time()
+        self.assertEqual(self.broadcast(fanout, range(10)), [None] * 10)
+        self.assertLess(time.time() - start, 1.0)
+        self.assertEqual(fanout.stats()['retried'], 10)
+
+    def test_outages_are_left_to_the_spool(self):
+        def send(chat_id, message):
+            raise ConnectionError('network down')
+
+        fanout = self.fanout(send, retries=1, backoff=0.01)
+        self.assertEqual(self.broadcast(fanout, range(3)), [0, 1, 2])
+        self.assertEqual(self.dead, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import warnings
+import unittest
+
+from telepot import namedtuple
+
+
+def message(**fields):
+    return dict({'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'}}, **fields)
+
+
+class ViewTest(unittest.TestCase):
+    def views(self, messages):
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            views = [namedtuple.Message.View(msg) for msg in messages]
+        return views, [str(w.message).split('\n')[0] for w in caught]
+
+    def test_nested_fields(self):
+        [view], warned = self.views([message(text='hi', reply_to_message=message(text='earlier'))])
+        self.assertEqual((view.chat.id, view.text, view.reply_to_message.text), (7, 'hi', 'earlier'))
+        self.assertIs(view.chat, view.chat)
+        self.assertIsNone(view.from_)
+        self.assertEqual(warned, [])
+
+    def test_unexpected_fields_warned_once(self):
+        views, warned = self.views([message(text='hi'), message(zz_new=1), message(zz_new=2, text='x'),
+                                    message(zz_new=3, zz_newer=4)])
+        self.assertEqual(warned, ['Unexpected fields: zz_new', 'Unexpected fields: zz_newer'])
+        self.assertEqual(views[1]._data['zz_new'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
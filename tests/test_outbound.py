@@ -0,0 +1,167 @@
+import shutil
+import asyncio
+import concurrent.futures
+import tempfile
+import threading
+import unittest
+
+from spool import Spool
+from outbound import OutboundQueue, AsyncOutboundQueue
+
+
+class Users:
+    def __init__(self, chat_ids):
+        self.chat_ids = chat_ids
+        self.lookups = 0
+
+    def recipients(self, channel, audience):
+        self.lookups += 1
+        return tuple(self.chat_ids.get(channel, ()) if isinstance(self.chat_ids, dict) else self.chat_ids)
+
+
+class Telegram:
+    # the parts of TelegramBot the replay uses, sends to `down` fail
+    def __init__(self, chat_ids, down=()):
+        self.users = Users(chat_ids)
+        self.down = set(down)
+        self.sent = []
+
+    def send_to(self, chat_ids, text):
+        futures = []
+        for chat_id in chat_ids:
+            future = concurrent.futures.Future()
+            if chat_id in self.down:
+                future.set_result(chat_id)
+            else:
+                self.sent.append((chat_id, text))
+                future.set_result(None)
+            futures.append(future)
+        return futures
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool = Spool(directory, sync_interval=3600)
+
+        for i in range(10):
+            channel = '#a' if i % 2 == 0 else '#b'
+            self.spool.done(self.spool.append(channel, 'msg', '{0:s} {1:d}'.format(channel, i)))
+
+    def replay(self, telegram):
+        # the queue without its threads, the replay is run by hand
+        outbound = OutboundQueue.__new__(OutboundQueue)
+        outbound.telegram = telegram
+        outbound.spool = self.spool
+        outbound.lock = threading.Lock()
+        outbound.replayed = 0
+        return outbound.replay()
+
+    def test_lagging_users_get_their_channels_in_order(self):
+        self.spool.fell_behind(1, 3)
+        self.spool.fell_behind(2, 8)
+        telegram = Telegram({'#a': [1, 2], '#b': [1]})
+
+        self.assertTrue(self.replay(telegram))
+        self.assertEqual([text for chat_id, text in telegram.sent if chat_id == 1],
+                         ['#a 2', '#b 3', '#a 4', '#b 5', '#a 6', '#b 7', '#a 8', '#b 9'])
+        self.assertEqual([text for chat_id, text in telegram.sent if chat_id == 2], ['#a 8'])
+        self.assertEqual(self.spool.cursors(), {})
+        # looked up once per channel and audience, not per entry
+        self.assertEqual(telegram.users.lookups, 2)
+
+    def test_failing_users_stay_behind(self):
+        self.spool.fell_behind(1, 5)
+        self.spool.fell_behind(2, 5)
+        telegram = Telegram({'#a': [1, 2], '#b': [1, 2]}, down=[2])
+
+        self.assertFalse(self.replay(telegram))
+        self.assertEqual(self.spool.cursors(), {2: 4})
+        self.assertEqual(len(telegram.sent), 6)
+
+        telegram.down.clear()
+        self.assertTrue(self.replay(telegram))
+        self.assertEqual([text for chat_id, text in telegram.sent if chat_id == 2],
+                         ['#a 4', '#b 5', '#a 6', '#b 7', '#a 8', '#b 9'])
+        self.assertEqual(self.spool.cursors(), {})
+
+
+class AsyncTelegram:
+    # the parts of AsyncTelegramBot the outbound queue uses, sends recorded
+    def __init__(self, loop, chat_ids):
+        self.loop = loop
+        self.users = Users(chat_ids)
+        self.sent = []
+
+    def channel_header(self, channel):
+        return None
+
+    def deliver(self, channel, audience, text, skip=None):
+        return self.send_to([chat_id for chat_id in self.users.recipients(channel, audience)
+                             if not skip or chat_id not in skip], text)
+
+    def send_to(self, chat_ids, text):
+        async def send(chat_id):
+            self.sent.append((chat_id, text))
+        return [self.loop.create_task(send(chat_id)) for chat_id in chat_ids]
+
+
+class AsyncOutboundQueueTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.spool = Spool(directory, sync_interval=60)
+
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.stop_loop)
+        self.telegram = AsyncTelegram(self.loop, [1, 2])
+
+    def stop_loop(self):
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
+
+    def test_spool_is_written_off_the_loop(self):
+        threads = []
+        append = self.spool.append
+
+        def spy(*args):
+            threads.append(threading.current_thread())
+            return append(*args)
+        self.spool.append = spy
+
+        async def run():
+            outbound = AsyncOutboundQueue(self.telegram, spool=self.spool, loop=self.loop)
+            await outbound.deliver('#c', 'msg', 'hello')
+            return outbound
+
+        outbound = self.loop.run_until_complete(run())
+        self.assertEqual(sorted(self.telegram.sent), [(1, 'hello'), (2, 'hello')])
+        self.assertEqual(len(threads), 1)
+        self.assertIsNot(threads[0], threading.main_thread())
+        self.assertEqual(self.spool.stats()['head'], 1)
+        outbound.disk.shutdown()
+
+    def test_replay_reads_the_spool_in_batches(self):
+        for i in range(250):
+            self.spool.append('#c', 'msg', 'line {0:d}'.format(i))
+            self.spool.done(i + 1)
+        self.spool.fell_behind(2, 1)
+
+        async def run():
+            # the replay task catches the chat up
+            outbound = AsyncOutboundQueue(self.telegram, spool=self.spool, loop=self.loop, replay_interval=60)
+            while self.spool.cursors():
+                await asyncio.sleep(0.01)
+            return outbound
+
+        outbound = self.loop.run_until_complete(asyncio.wait_for(run(), 5))
+        self.assertEqual(self.telegram.sent, [(2, 'line {0:d}'.format(i)) for i in range(250)])
+        outbound.disk.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
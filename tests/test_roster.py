@@ -0,0 +1,49 @@
+import unittest
+
+from roster import Roster, OPER, VOICED, USER
+
+
+class RosterTest(unittest.TestCase):
+    def test_ranks_are_sorted(self):
+        roster = Roster()
+        roster.reset([('bob', USER), ('[alice]', USER), ('op1', OPER), ('carol', VOICED)])
+        roster.set('adam', USER)
+
+        self.assertEqual(roster.nicks(USER), ['adam', '[alice]', 'bob'])
+        self.assertEqual(roster.chunks(), ['Operators:\nop1\nModerators:\ncarol\nUsers:\nadam, [alice], bob'])
+
+    def test_case_only_nick_change(self):
+        roster = Roster()
+        roster.reset([('Zed', OPER), ('op1', OPER)])
+
+        # what the irc bot does on a nick change: both nicks looked up again
+        roster.set('Zed', OPER)
+        roster.set('zed', OPER)
+
+        self.assertEqual(roster.nicks(OPER), ['op1', 'zed'])
+        self.assertEqual(len(roster), 2)
+        self.assertIn('ZED', roster)
+
+    def test_nicks_are_told_apart_without_case(self):
+        roster = Roster()
+        roster.set('Nick[a]', USER)
+        roster.set('nick{a}', VOICED)
+
+        self.assertEqual(roster.nicks(USER), [])
+        self.assertEqual(roster.nicks(VOICED), ['nick{a}'])
+
+        roster.discard('NICK[A]')
+        self.assertEqual(len(roster), 0)
+        self.assertEqual(roster.nicks(VOICED), [])
+
+    def test_long_replies_are_split(self):
+        roster = Roster(size=20)
+        roster.reset([('user{0:02d}'.format(i), USER) for i in range(6)])
+
+        chunks = roster.chunks()
+        self.assertTrue(all(len(chunk) <= 20 for chunk in chunks))
+        self.assertEqual(''.join(chunks).count('user'), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
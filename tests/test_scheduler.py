@@ -0,0 +1,84 @@
+import time
+import queue
+import unittest
+
+import telepot
+from telepot import exception
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.output = queue.Queue()
+        self.scheduler = telepot.Bot.Scheduler()
+        self.scheduler._output_queue = self.output
+        self.scheduler.daemon = True
+
+    def test_events_come_in_time_order(self):
+        now = time.time()
+        self.scheduler.event_at(now + 0.2, {'n': 2})
+        self.scheduler.event_at(now + 0.1, {'n': 1})
+        self.scheduler.start()
+
+        self.assertEqual(self.output.get(timeout=2), {'n': 1})
+        self.assertEqual(self.output.get(timeout=2), {'n': 2})
+
+    def test_equal_timestamps_keep_insertion_order(self):
+        when = time.time()
+        for n in range(100):
+            self.scheduler.event_at(when, {'n': n})
+        self.scheduler.start()
+
+        self.assertEqual([self.output.get(timeout=2)['n'] for n in range(100)], list(range(100)))
+
+    def test_cancel_before_emission(self):
+        event = self.scheduler.event_later(0.1, {'n': 1})
+        self.scheduler.event_later(0.2, {'n': 2})
+        self.scheduler.cancel(event)
+        self.scheduler.start()
+
+        self.assertEqual(self.output.get(timeout=2), {'n': 2})
+        self.assertTrue(self.output.empty())
+
+        # only once
+        with self.assertRaises(exception.EventNotFound):
+            self.scheduler.cancel(event)
+
+    def test_cancel_after_emission(self):
+        event = self.scheduler.event_now({'n': 1})
+        self.scheduler.start()
+        self.assertEqual(self.output.get(timeout=2), {'n': 1})
+
+        with self.assertRaises(exception.EventNotFound):
+            self.scheduler.cancel(event)
+
+    def test_insert_wakes_the_waiting_thread(self):
+        # the thread sleeps until the far event, an earlier one must not wait for it
+        self.scheduler.event_later(3600, {'n': 'later'})
+        self.scheduler.start()
+        time.sleep(0.1)
+
+        start = time.time()
+        self.scheduler.event_later(0.05, {'n': 'soon'})
+        self.assertEqual(self.output.get(timeout=2), {'n': 'soon'})
+        self.assertLess(time.time() - start, 0.5)
+
+        # so does one on an empty scheduler
+        scheduler = telepot.Bot.Scheduler()
+        scheduler._output_queue = self.output
+        scheduler.daemon = True
+        scheduler.start()
+        time.sleep(0.1)
+        scheduler.event_now({'n': 'now'})
+        self.assertEqual(self.output.get(timeout=2), {'n': 'now'})
+
+    def test_cancelled_events_are_compacted(self):
+        events = [self.scheduler.event_later(3600, {'n': n}) for n in range(3000)]
+        for event in events[:2500]:
+            self.scheduler.cancel(event)
+
+        self.assertLess(len(self.scheduler._eventq), 3000)
+        self.assertEqual(len(self.scheduler._pending), 500)
+
+
+if __name__ == '__main__':
+    unittest.main()
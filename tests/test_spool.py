@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from spool import Spool
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def open(self):
+        return Spool(self.directory, sync_interval=3600)
+
+    def entries(self, spool, after=0):
+        return [(seq, channel, audience, text) for seq, timestamp, channel, audience, text in spool.read(after)]
+
+    def test_torn_last_line_is_cut_off(self):
+        spool = self.open()
+        spool.append('#c', 'msg', 'one')
+        spool.append('#c', 'msg', 'two')
+        spool.sync()
+
+        # a crash in the middle of the next append
+        segment = os.path.join(self.directory, '{0:020d}.log'.format(1))
+        with open(segment, 'a') as file:
+            file.write('[3, 1.0, "#c", "ms')
+
+        spool = self.open()
+        self.assertEqual(spool.last, 2)
+        with open(segment, 'rb') as file:
+            self.assertTrue(file.read().endswith(b'\n'))
+
+        self.assertEqual(spool.append('#c', 'msg', 'three'), 3)
+        self.assertEqual(self.entries(spool), [(1, '#c', 'msg', 'one'), (2, '#c', 'msg', 'two'),
+                                               (3, '#c', 'msg', 'three')])
+
+    def test_unfinished_deliveries_are_made_again(self):
+        spool = self.open()
+        for text in ['one', 'two', 'three']:
+            spool.append('#c', 'msg', text)
+        spool.done(1)
+        spool.done(3)
+        spool.sync()
+
+        # restarted with 2 (and so 3, past the head) not known to be delivered
+        spool = self.open()
+        self.assertEqual(spool.head, 1)
+        self.assertEqual([entry[0] for entry in spool.unfinished()], [2, 3])
+
+        spool.done(2)
+        spool.done(3)
+        self.assertEqual(spool.head, 3)
+
+        # appended after the restart, not unfinished
+        spool.append('#c', 'msg', 'four')
+        self.assertEqual(list(spool.unfinished()), [])
+
+    def test_cursors_are_kept(self):
+        spool = self.open()
+        for text in ['one', 'two', 'three']:
+            spool.done(spool.append('#c', 'msg', text))
+        spool.fell_behind(7, 2)
+        spool.fell_behind(7, 3)  # stays at the first entry missed
+        spool.fell_behind(8, 3)
+        spool.advance(8, 3)
+        spool.sync()
+
+        spool = self.open()
+        self.assertEqual(spool.head, 3)
+        self.assertEqual(spool.cursors(), {7: 1, 8: 3})
+        self.assertEqual(self.entries(spool, spool.cursors()[7]), [(2, '#c', 'msg', 'two'), (3, '#c', 'msg', 'three')])
+
+        self.assertTrue(spool.caught_up(8))
+        self.assertFalse(spool.caught_up(7))
+        spool.sync()
+        self.assertEqual(self.open().cursors(), {7: 1})
+
+    def test_old_segments_are_dropped(self):
+        spool = Spool(self.directory, segment_size=100, max_size=300, sync_interval=3600)
+        for i in range(50):
+            spool.done(spool.append('#c', 'msg', 'line {0:d}'.format(i)))
+
+        self.assertLessEqual(len(spool.segments), 4)
+        entries = self.entries(spool)
+        self.assertEqual(entries[-1], (50, '#c', 'msg', 'line 49'))
+        self.assertEqual([seq for seq, c, a, t in entries], list(range(entries[0][0], 51)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import userstore
+from subscribers import SubscriberRegistry
+
+
+class JournalUserStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.file_name = os.path.join(self.directory, 'users.save')
+
+    def store(self):
+        store = userstore.JournalUserStore(self.file_name)
+        self.addCleanup(store.close)
+        return store
+
+    def test_reloads_snapshot_and_journal(self):
+        store = self.store()
+        store.load()
+        store.put('1', {'enabled': True})
+        store.compact()
+        store.put('2', {'enabled': False})
+
+        self.assertEqual(self.store().load(), {'1': {'enabled': True}, '2': {'enabled': False}})
+
+    def test_corrupt_snapshot_is_set_aside(self):
+        with open(self.file_name, 'w') as file:
+            file.write('{corrupt')
+        with open(self.file_name + '.journal', 'w') as file:
+            file.write('["1", {"enabled": true}]\n')
+
+        store = self.store()
+        with self.assertRaises(ValueError):
+            store.load()
+
+        # the store goes on with no users, and keeps the files it couldn't read
+        store.put('2', {'enabled': True})
+        store.compact()
+        set_aside = sorted(name for name in os.listdir(self.directory) if '.corrupt-' in name)
+        self.assertEqual([name.split('.corrupt-')[0] for name in set_aside], ['users.save', 'users.save.journal'])
+        with open(os.path.join(self.directory, set_aside[0])) as file:
+            self.assertEqual(file.read(), '{corrupt')
+
+        self.assertEqual(self.store().load(), {'2': {'enabled': True}})
+
+    def test_registry_goes_on_after_a_corrupt_snapshot(self):
+        with open(self.file_name, 'w') as file:
+            file.write('{corrupt')
+
+        errors = []
+        users = SubscriberRegistry(self.store(), on_load_error=errors.append)
+        self.assertTrue(users.add('1'))
+        users.update('1', enabled=False)
+
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(self.store().load()['1']['enabled'])
+
+    def test_user_store_is_abstract(self):
+        with self.assertRaises(TypeError):
+            userstore.UserStore()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import ssl
+import queue
+import shutil
+import socket
+import tempfile
+import unittest
+import subprocess
+import urllib.error
+import urllib.request
+
+import webhook
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class WebhookServerTest(unittest.TestCase):
+    def serve(self, **kwargs):
+        port = free_port()
+        server = webhook.WebhookServer(queue.Queue(), 'https://example.org/hook', listen='127.0.0.1', port=port,
+                                       secret_token='s3cret', **kwargs)
+        server.start_thread()
+        return server, port
+
+    def post(self, url, context=None, secret_token='s3cret'):
+        request = urllib.request.Request(url, data=b'{"update_id": 1}', method='POST',
+                                         headers={'X-Telegram-Bot-Api-Secret-Token': secret_token})
+        with urllib.request.urlopen(request, timeout=5, context=context) as response:
+            return response.read()
+
+    def test_plain_http_without_a_key(self):
+        server, port = self.serve()
+        self.assertEqual(self.post('http://127.0.0.1:{0:d}/hook'.format(port)), b'OK')
+        self.assertEqual(server.updates.get(timeout=1), b'{"update_id": 1}')
+
+    @unittest.skipIf(shutil.which('openssl') is None, 'needs openssl to make a certificate')
+    def test_https_with_a_key(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        certificate = os.path.join(directory, 'cert.pem')
+        key = os.path.join(directory, 'key.pem')
+        subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                               '-subj', '/CN=127.0.0.1', '-keyout', key, '-out', certificate],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        server, port = self.serve(certificate=certificate, key=key)
+        context = ssl.create_default_context(cafile=certificate)
+        context.check_hostname = False
+        self.assertEqual(self.post('https://127.0.0.1:{0:d}/hook'.format(port), context), b'OK')
+        self.assertEqual(server.updates.get(timeout=1), b'{"update_id": 1}')
+
+    def test_refuses_posts_without_the_secret(self):
+        server, port = self.serve()
+        for secret_token in ['', 'guess']:
+            with self.assertRaises(urllib.error.HTTPError) as cm:
+                self.post('http://127.0.0.1:{0:d}/hook'.format(port), secret_token=secret_token)
+            self.assertEqual(cm.exception.code, 403)
+
+        self.assertTrue(server.updates.empty())
+        self.assertEqual(server.stats()['refused'], 2)
+
+    def test_registers_a_secret(self):
+        server = webhook.WebhookServer(queue.Queue(), 'https://example.org/hook')
+        registration = server.registration()
+        self.assertEqual(registration['secret_token'], server.secret_token)
+        self.assertRegex(server.secret_token, '^[A-Za-z0-9_-]{1,256}$')
+
+    def test_key_needs_a_certificate(self):
+        with self.assertRaises(ValueError):
+            webhook.WebhookServer(queue.Queue(), 'https://example.org/', key='key.pem')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,188 @@
+import os
+import abc
+import json
+import time
+import logging
+import sqlite3
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class UserStore(abc.ABC):
+    """
+    Keeps the telegram user settings on disk. Every update writes only the user it
+    changed, so saving a setting costs the same no matter how many users there are.
+    """
+
+    @abc.abstractmethod
+    def load(self):
+        # returns a dict of user id -> settings
+        pass
+
+    @abc.abstractmethod
+    def put(self, id, settings):
+        pass
+
+    def close(self):
+        pass
+
+
+class JournalUserStore(UserStore):
+    """
+    A json snapshot of all users (the format the bot always used) plus an append-only
+    journal with one line per update. Once the journal grows long it is folded into
+    a new snapshot, which replaces the old one by an atomic rename.
+
+    A snapshot that cannot be read is renamed, along with its journal, so that the
+    next snapshot doesn't overwrite it. The store then starts out empty.
+    """
+
+    def __init__(self, file_name, compact_every=1000):
+        self.file_name = file_name
+        self.journal_file_name = file_name + '.journal'
+        self.compact_every = compact_every
+
+        self.users = {}
+        self.journal = None
+        self.journal_entries = 0
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            try:
+                return self.read()
+            finally:
+                # updates are saved even when the users could not be read
+                if self.journal is None:
+                    self.journal = open(self.journal_file_name, 'a')
+
+    def read(self):
+        try:
+            with open(self.file_name, 'r') as file:
+                self.users = json.load(file)
+        except FileNotFoundError:
+            self.users = {}
+        except (EnvironmentError, ValueError):
+            self.set_aside()
+            raise
+
+        torn = False
+        try:
+            with open(self.journal_file_name, 'r') as file:
+                for line in file:
+                    try:
+                        id, settings = json.loads(line)
+                    except ValueError:
+                        # a crash in the middle of an append leaves a torn last line
+                        logger.warning('skipping broken journal entry: {0:s}'.format(line))
+                        torn = True
+                        continue
+                    self.users[id] = settings
+                    self.journal_entries += 1
+        except FileNotFoundError:
+            pass
+
+        self.journal = open(self.journal_file_name, 'a')
+        if torn:
+            # start a clean journal, new entries must not be appended to a torn line
+            self.compact()
+
+        return {id: dict(settings) for id, settings in self.users.items()}
+
+    def set_aside(self):
+        suffix = time.strftime('.corrupt-%Y%m%d-%H%M%S')
+        logger.error('cannot read {0:s}, moving it to {0:s}{1:s}'.format(self.file_name, suffix))
+        for file_name in [self.file_name, self.journal_file_name]:
+            if os.path.exists(file_name):
+                os.replace(file_name, file_name + suffix)
+
+        self.users = {}
+        self.journal_entries = 0
+
+    def put(self, id, settings):
+        with self.lock:
+            self.users[id] = dict(settings)
+
+            self.journal.write(json.dumps([id, settings]) + '\n')
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal_entries += 1
+
+            if self.journal_entries >= self.compact_every:
+                self.compact()
+
+    def compact(self):
+        logger.debug('compacting telegram user journal into {0:s}'.format(self.file_name))
+
+        temp_file_name = self.file_name + '.tmp'
+        with open(temp_file_name, 'w') as file:
+            json.dump(self.users, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temp_file_name, self.file_name)
+
+        # replaying the journal on top of the new snapshot would be harmless,
+        # so a crash before the truncate loses nothing
+        self.journal.close()
+        self.journal = open(self.journal_file_name, 'w')
+        self.journal_entries = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.compact()
+                self.journal.close()
+                self.journal = None
+
+
+class SQLiteUserStore(UserStore):
+    """
+    One row per user in an sqlite database running in WAL mode.
+    """
+
+    def __init__(self, file_name, import_file_name=None):
+        self.file_name = file_name
+        # the json save file of older versions, imported once into an empty database
+        self.import_file_name = import_file_name
+
+        self.db = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            self.db = sqlite3.connect(self.file_name, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS users (id TEXT PRIMARY KEY, settings TEXT NOT NULL)')
+
+            users = {id: json.loads(settings) for id, settings in self.db.execute('SELECT id, settings FROM users')}
+
+            if not users and self.import_file_name and os.path.exists(self.import_file_name):
+                logger.info('importing telegram users from {0:s}'.format(self.import_file_name))
+                with open(self.import_file_name, 'r') as file:
+                    users = json.load(file)
+                with self.db:
+                    self.db.executemany('INSERT OR REPLACE INTO users VALUES (?, ?)',
+                                        [(id, json.dumps(settings)) for id, settings in users.items()])
+
+            return users
+
+    def put(self, id, settings):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO users VALUES (?, ?)', (id, json.dumps(settings)))
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+def create(kind='journal', file_name=None):
+    if kind == 'journal':
+        return JournalUserStore(file_name or 'telegram_bot_users.save')
+    elif kind == 'sqlite':
+        return SQLiteUserStore(file_name or 'telegram_bot_users.db', import_file_name='telegram_bot_users.save')
+    else:
+        raise ValueError('unknown user store: {0:s}'.format(kind))
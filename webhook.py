@@ -0,0 +1,133 @@
+import ssl
+import hmac
+import asyncio
+import logging
+import secrets
+import threading
+import urllib.parse
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_options(config):
+    # the webhook settings of the config, None to long-poll
+    url = config.get('Telegram', 'webhook_url', fallback='')
+    if not url:
+        return None
+
+    return {'url': url,
+            'listen': config.get('Telegram', 'webhook_listen', fallback='0.0.0.0'),
+            'port': config.getint('Telegram', 'webhook_port', fallback=8443),
+            'certificate': config.get('Telegram', 'webhook_certificate', fallback='') or None,
+            'key': config.get('Telegram', 'webhook_key', fallback='') or None,
+            'secret_token': config.get('Telegram', 'webhook_secret', fallback='') or None,
+            'max_connections': config.getint('Telegram', 'webhook_max_connections', fallback=40)}
+
+
+class WebhookServer:
+    """
+    Receives the updates telegram posts to the webhook and puts them, undecoded,
+    into `updates`, the queue message_loop(source=...) takes them from. The server
+    runs on an event loop: the relay's in the asyncio relay, a thread of its own
+    otherwise.
+
+    Telegram posts to `url`; the server answers on its path. Telegram sends the
+    `secret_token` given to setWebhook along with every update, posts without it
+    are refused. A secret is made up if none is given.
+
+    Telegram only posts to https. With the private `key` of the `certificate` the
+    server speaks https itself, without it plain http: then it has to be behind a
+    reverse proxy that terminates tls.
+    """
+
+    def __init__(self, updates, url, listen='0.0.0.0', port=8443, certificate=None, key=None, max_connections=40,
+                 secret_token=None, loop=None):
+        if key is not None and certificate is None:
+            raise ValueError('a webhook key needs the certificate it belongs to')
+
+        self.updates = updates
+        self.url = url
+        self.path = urllib.parse.urlparse(url).path or '/'
+        self.listen = listen
+        self.port = port
+        self.certificate = certificate
+        self.key = key
+        self.max_connections = max_connections
+        self.secret_token = secret_token or secrets.token_urlsafe(32)
+        self.loop = loop
+
+        self.runner = None
+        self.received = 0
+        self.refused = 0
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post(self.path, self.receive)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port, ssl_context=self.ssl_context()).start()
+        logger.info('webhook listening on {0:s}://{1:s}:{2:d}{3:s}'
+                    .format('https' if self.key else 'http', self.listen, self.port, self.path))
+
+    def ssl_context(self):
+        if self.key is None:
+            return None
+
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(self.certificate, self.key)
+        return context
+
+    def start_thread(self):
+        # for the threaded relay: serve from a thread running an event loop of its own
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self.start())
+            finally:
+                started.set()
+            self.loop.run_forever()
+
+        server = threading.Thread(target=serve, name='webhook')
+        server.daemon = True
+        server.start()
+        started.wait()
+
+        if self.runner is None:
+            raise RuntimeError('the webhook server did not start, see the log')
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def receive(self, request):
+        secret_token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(secret_token.encode('utf-8'), self.secret_token.encode('utf-8')):
+            self.refused += 1
+            return web.Response(status=403)
+
+        # decoding and ordering are left to message_loop, answer telegram right away
+        self.updates.put_nowait(await request.read())
+        self.received += 1
+        return web.Response(text='OK')
+
+    def registration(self):
+        """
+        The arguments of setWebhook telling telegram about this server. The
+        certificate file is opened, close it once the webhook is set.
+        """
+        return {'url': self.url,
+                'certificate': open(self.certificate, 'rb') if self.certificate else None,
+                'max_connections': self.max_connections,
+                'secret_token': self.secret_token}
+
+    def stats(self):
+        return {'received': self.received,
+                'refused': self.refused,
+                'queued': self.updates.qsize()}